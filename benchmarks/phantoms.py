@@ -0,0 +1,174 @@
+"""
+Synthetic brain-like phantoms with known tumor volumes and displacement
+"""
+
+import numpy as np
+import itk
+
+
+# Brain ellipsoid semi-axes as a fraction of the field of view (x, y, z)
+BRAIN_AXES = (0.28, 0.34, 0.31)
+
+# Head layers outside the brain, with thicknesses relative to the brain
+# radius: a dark CSF rim and a bright scalp, thick enough for the brain to
+# fall inside the 15-85 percentile band used by the skull stripping
+CSF_THICKNESS = 0.08
+SCALP_THICKNESS = 0.06
+
+BRAIN_INTENSITY = 500.0
+TEXTURE_AMPLITUDE = 40.0
+CSF_INTENSITY = 150.0
+SCALP_INTENSITY = 1200.0
+TUMOR_INTENSITY = 1000.0
+NOISE_STD = 20.0
+
+# Tumor centre offset from the volume centre, as a fraction of the field of view
+TUMOR_OFFSET = (0.04, -0.05, 0.06)
+
+
+def rotation_matrix(angles_deg):
+    """Rotation about x, then y, then z (angles in degrees), in (x, y, z) order"""
+    ax, ay, az = np.radians(angles_deg)
+    rx = np.array([[1, 0, 0], [0, np.cos(ax), -np.sin(ax)], [0, np.sin(ax), np.cos(ax)]])
+    ry = np.array([[np.cos(ay), 0, np.sin(ay)], [0, 1, 0], [-np.sin(ay), 0, np.cos(ay)]])
+    rz = np.array([[np.cos(az), -np.sin(az), 0], [np.sin(az), np.cos(az), 0], [0, 0, 1]])
+    return rz @ ry @ rx
+
+
+class PhantomCase:
+    """Baseline and follow-up phantoms of one synthetic patient.
+
+    The follow-up shows the same anatomy moved by a rigid displacement
+    ``D(p) = R (p - c) + c + t`` (physical (x, y, z) coordinates, ``c`` the
+    volume centre), so a perfect registration transform maps every fixed
+    point ``p`` to ``D(p)``. The tumor is a sphere whose radius grows from
+    ``tumor_radius`` to ``followup_tumor_radius`` (in voxels, so that it
+    stays inside the 20-2000 voxel limits of the segmentation).
+    """
+
+    def __init__(self, size=128, spacing=1.0, tumor_radius=5.0, followup_tumor_radius=6.5,
+                 rotation_deg=(3.0, -2.0, 4.0), translation_mm=(4.0, -3.0, 2.0), seed=0):
+        self.size = int(size)
+        self.spacing = float(spacing)
+        self.tumor_radius = float(tumor_radius)
+        self.followup_tumor_radius = float(followup_tumor_radius)
+        self.rotation = rotation_matrix(rotation_deg)
+        self.translation = np.asarray(translation_mm, dtype=np.float64)
+        self.seed = seed
+
+        fov = self.size * self.spacing
+        self.origin = np.full(3, -fov / 2.0)
+        self.center = self.origin + (self.size - 1) / 2.0 * self.spacing
+        self.brain_axes = np.array(BRAIN_AXES) * fov
+        self.tumor_center = self.center + np.array(TUMOR_OFFSET) * fov
+
+        # Fixed random phases for the tissue texture
+        rng = np.random.default_rng(seed)
+        self.texture_waves = [
+            (rng.uniform(0.5, 1.5, 3) * 2 * np.pi / (fov * 0.15), rng.uniform(0, 2 * np.pi))
+            for _ in range(4)
+        ]
+
+    def displace(self, points):
+        """Apply the known displacement D to (N, 3) physical points"""
+        return (np.asarray(points) - self.center) @ self.rotation.T + self.center + self.translation
+
+    def _undisplace(self, points):
+        return (points - self.center - self.translation) @ self.rotation + self.center
+
+    def _physical_points(self, z_start, z_stop):
+        index = np.arange(self.size, dtype=np.float64) * self.spacing
+        z, y, x = np.meshgrid(
+            index[z_start:z_stop] + self.origin[2], index + self.origin[1], index + self.origin[0],
+            indexing='ij'
+        )
+        return np.stack([x, y, z], axis=-1)
+
+    def _anatomy(self, points, tumor_radius):
+        """Intensity of the undisplaced anatomy at (..., 3) physical points"""
+        relative = (points - self.center) / self.brain_axes
+        radius = np.sqrt(np.sum(relative ** 2, axis=-1))
+
+        texture = np.zeros(points.shape[:-1])
+        for wave_vector, phase in self.texture_waves:
+            texture += np.sin(points @ wave_vector + phase)
+        texture /= np.sqrt(len(self.texture_waves) / 2.0)
+
+        csf_radius = 1.0 + CSF_THICKNESS
+        head_radius = csf_radius + SCALP_THICKNESS
+        values = np.zeros(points.shape[:-1], dtype=np.float32)
+        values[radius < head_radius] = SCALP_INTENSITY
+        values[radius < csf_radius] = CSF_INTENSITY
+        brain = radius < 1.0
+        values[brain] = BRAIN_INTENSITY + TEXTURE_AMPLITUDE * texture[brain]
+
+        tumor_distance = np.sqrt(np.sum((points - self.tumor_center) ** 2, axis=-1))
+        values[tumor_distance < tumor_radius * self.spacing] = TUMOR_INTENSITY
+        # Noise only inside the head, air stays at zero
+        return values, values > 0
+
+    def _generate(self, followup, slab_depth=32):
+        rng = np.random.default_rng(self.seed + (1 if followup else 0))
+        tumor_radius = self.followup_tumor_radius if followup else self.tumor_radius
+        array = np.empty((self.size,) * 3, dtype=np.float32)
+
+        # Slab by slab so that 512^3 phantoms do not need several full-size temporaries
+        for z_start in range(0, self.size, slab_depth):
+            z_stop = min(z_start + slab_depth, self.size)
+            points = self._physical_points(z_start, z_stop)
+            if followup:
+                points = self._undisplace(points)
+            values, signal = self._anatomy(points, tumor_radius)
+            noise = rng.normal(0.0, NOISE_STD, values.shape).astype(np.float32)
+            array[z_start:z_stop] = np.clip(values + noise * signal, 0, None)
+
+        return array
+
+    def _ground_truth(self, tumor_radius):
+        index = np.arange(self.size) * self.spacing
+        z, y, x = np.ogrid[:self.size, :self.size, :self.size]
+        distance2 = (
+            (index[x] + self.origin[0] - self.tumor_center[0]) ** 2
+            + (index[y] + self.origin[1] - self.tumor_center[1]) ** 2
+            + (index[z] + self.origin[2] - self.tumor_center[2]) ** 2
+        )
+        return distance2 < (tumor_radius * self.spacing) ** 2
+
+    def to_itk(self, array):
+        image = itk.GetImageFromArray(array)
+        image.SetOrigin(self.origin.tolist())
+        image.SetSpacing([self.spacing] * 3)
+        return image
+
+    def baseline(self):
+        return self.to_itk(self._generate(followup=False))
+
+    def followup(self):
+        return self.to_itk(self._generate(followup=True))
+
+    def baseline_tumor_mask(self):
+        """Ground-truth baseline tumor in baseline space"""
+        return self._ground_truth(self.tumor_radius)
+
+    def followup_tumor_mask(self):
+        """Ground-truth follow-up tumor in baseline (registered) space"""
+        return self._ground_truth(self.followup_tumor_radius)
+
+    def voxel_volume(self):
+        return self.spacing ** 3
+
+    def landmarks(self):
+        """Physical points inside the brain used to measure registration error"""
+        offsets = np.array([
+            [0, 0, 0], [0.6, 0, 0], [-0.6, 0, 0], [0, 0.6, 0],
+            [0, -0.6, 0], [0, 0, 0.6], [0, 0, -0.6],
+        ])
+        return np.vstack([self.tumor_center, self.center + offsets * self.brain_axes])
+
+    def write(self, output_dir):
+        """Write baseline and follow-up NRRD files, return their paths"""
+        baseline_path = output_dir / f"phantom_{self.size}_baseline.nrrd"
+        followup_path = output_dir / f"phantom_{self.size}_followup.nrrd"
+        itk.imwrite(self.baseline(), str(baseline_path), compression=True)
+        itk.imwrite(self.followup(), str(followup_path), compression=True)
+        return baseline_path, followup_path
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Reproducible pipeline benchmarks on synthetic phantoms.
+
+Times registration, segmentation, analysis and offscreen rendering at
+several volume sizes, checks recovered volume, Dice and transform
+accuracy against the known ground truth, and writes everything to a
+JSON file that can be compared against a previous run with --baseline.
+"""
+
+from pathlib import Path
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+# Add src directory to path
+sys.path.append(str(Path(__file__).parent.parent / "src"))
+sys.path.append(str(Path(__file__).parent))
+
+from registration import ImageRegistration
+from segmentation import TumorSegmentation
+from analysis import TumorAnalysis
+from sparse_mask import SparseMask
+from profiling import PipelineProfiler
+from phantoms import PhantomCase
+
+
+DEFAULT_SIZES = [128, 256]
+
+# Preview triage check: on phantoms of this size, a stable tumor of this radius
+# (voxels) must stay below the upgrade threshold (percent), a growing one be upgraded
+PREVIEW_CHECK_SIZE = 128
+PREVIEW_CHECK_TUMOR_RADIUS = 7.0
+PREVIEW_CHECK_THRESHOLD = 25.0
+
+
+def environment_info():
+    import itk
+    import scipy
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'itk': itk.Version.GetITKVersion(),
+        'git_commit': commit,
+    }
+
+
+def dice(a, b):
+    total = np.sum(a) + np.sum(b)
+    return float(2.0 * np.sum(a & b) / total) if total > 0 else 1.0
+
+
+def timed(profiler, name, function):
+    """Run function inside a profiler stage and return (result, wall time)"""
+    with profiler.stage(name) as step:
+        result = function()
+    return result, step.record['wall_time_s']
+
+
+def run_case(phantom, work_dir, profiler, render=True):
+    """Run every benchmarked operation once on a phantom case"""
+    baseline_path, followup_path = phantom.write(work_dir)
+    registered_path = work_dir / f"phantom_{phantom.size}_registered.nrrd"
+    mask1_path = work_dir / f"phantom_{phantom.size}_mask1.nrrd"
+    mask2_path = work_dir / f"phantom_{phantom.size}_mask2.nrrd"
+    change_map_path = work_dir / f"phantom_{phantom.size}_change_map.nrrd"
+
+    timings = {}
+
+    registrator = ImageRegistration()
+    (registered, transform), timings['register_images'] = timed(
+        profiler, "register_images",
+        lambda: registrator.register_images(baseline_path, followup_path, registered_path)
+    )
+
+    segmenter = TumorSegmentation()
+    mask1, timings['segment_baseline'] = timed(
+        profiler, "segment_baseline",
+        lambda: segmenter.segment_tumor_automatic(baseline_path, mask1_path)
+    )
+    mask2, timings['segment_followup'] = timed(
+        profiler, "segment_followup",
+        lambda: segmenter.segment_tumor_automatic(registered_path, mask2_path)
+    )
+
+    analyzer = TumorAnalysis()
+    results, timings['compare_tumors'] = timed(
+        profiler, "compare_tumors",
+        lambda: analyzer.compare_tumors(baseline_path, mask1_path, registered_path, mask2_path,
+                                        change_map_path=change_map_path)
+    )
+
+    if render:
+        from visualization import TumorVisualization
+
+        def render_scene():
+            visualizer = TumorVisualization(offscreen=True)
+            visualizer.visualize_tumor_evolution(baseline_path, mask1, mask2, results,
+                                                 change_map=change_map_path)
+            visualizer.save_screenshot(work_dir / f"phantom_{phantom.size}_render.png")
+
+        _, timings['render'] = timed(profiler, "render", render_scene)
+
+    return timings, accuracy(phantom, transform, mask1, mask2, results)
+
+
+def accuracy(phantom, transform, mask1, mask2, results):
+    """Compare pipeline outputs with the phantom ground truth"""
+    truth1 = phantom.baseline_tumor_mask()
+    truth2 = phantom.followup_tumor_mask()
+    voxel_volume = phantom.voxel_volume()
+
+    true_volume1 = float(np.sum(truth1) * voxel_volume)
+    true_volume2 = float(np.sum(truth2) * voxel_volume)
+    true_change = (true_volume2 - true_volume1) / true_volume1 * 100
+
+    segmented1 = SparseMask.from_itk(mask1).to_array() > 0
+    segmented2 = SparseMask.from_itk(mask2).to_array() > 0
+
+    report = {
+        'true_volume1_mm3': true_volume1,
+        'true_volume2_mm3': true_volume2,
+        'volume1_mm3': results['tumor1']['volume_mm3'],
+        'volume2_mm3': results['tumor2']['volume_mm3'],
+        'volume1_error_percent': (results['tumor1']['volume_mm3'] - true_volume1) / true_volume1 * 100,
+        'volume2_error_percent': (results['tumor2']['volume_mm3'] - true_volume2) / true_volume2 * 100,
+        'true_volume_change_percent': true_change,
+        'volume_change_percent': results['comparison']['volume_change_percent'],
+        'dice_baseline_vs_truth': dice(segmented1, truth1),
+        'dice_followup_vs_truth': dice(segmented2, truth2),
+        'true_dice': dice(truth1, truth2),
+        'dice': results['comparison']['dice_coefficient'],
+    }
+
+    # Target registration error at landmarks inside the brain
+    if transform is not None:
+        landmarks = phantom.landmarks()
+        expected = phantom.displace(landmarks)
+        mapped = np.array([list(transform.TransformPoint([float(v) for v in p])) for p in landmarks])
+        errors = np.linalg.norm(mapped - expected, axis=1)
+        report['registration_error_mean_mm'] = float(np.mean(errors))
+        report['registration_error_max_mm'] = float(np.max(errors))
+    else:
+        report['registration_error_mean_mm'] = None
+        report['registration_error_max_mm'] = None
+
+    return report
+
+
+def preview_check(work_dir, seed=0):
+    """Preview triage on a stable and a growing phantom pair.
+
+    Passes when the stable pair's preview is trusted to stay below
+    PREVIEW_CHECK_THRESHOLD (the full pipeline is skipped) and the growing
+    pair's is not.
+    """
+    from preview import preview_tumor_change, needs_full_resolution
+
+    radius = PREVIEW_CHECK_TUMOR_RADIUS
+    phantoms = {
+        'stable': PhantomCase(size=PREVIEW_CHECK_SIZE, tumor_radius=radius, followup_tumor_radius=radius,
+                              seed=seed),
+        'growing': PhantomCase(size=PREVIEW_CHECK_SIZE, seed=seed),
+    }
+    report = {'size': PREVIEW_CHECK_SIZE, 'threshold_percent': PREVIEW_CHECK_THRESHOLD}
+    for name, phantom in phantoms.items():
+        case_dir = work_dir / f"preview_{name}"
+        case_dir.mkdir(parents=True, exist_ok=True)
+        preview = preview_tumor_change(*phantom.write(case_dir))
+        comparison = preview['comparison']
+        report[name] = {
+            'volume_change_percent': comparison['volume_change_percent'],
+            'volume_change_percent_bounds': comparison['volume_change_percent_bounds'],
+            'dice_bounds': comparison['dice_bounds'],
+            'voxels_across': [preview[tumor]['voxels_across'] for tumor in ('tumor1', 'tumor2')],
+            'upgrade': needs_full_resolution(preview, PREVIEW_CHECK_THRESHOLD),
+        }
+    report['passed'] = not report['stable']['upgrade'] and report['growing']['upgrade']
+    return report
+
+
+def cold_start(repeat=3):
+    """Wall time of a fresh `main.py --help` (interpreter start-up included)"""
+    main_path = Path(__file__).parent.parent / "main.py"
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, str(main_path), "--help"], capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return {'min_s': min(times), 'median_s': statistics.median(times), 'runs_s': times}
+
+
+def summarize_timings(runs):
+    """Min and median wall time per operation over repeated runs"""
+    summary = {}
+    for name in runs[0]:
+        values = [run[name] for run in runs]
+        summary[name] = {
+            'min_s': min(values),
+            'median_s': statistics.median(values),
+            'runs_s': values,
+        }
+    return summary
+
+
+def compare_to_baseline(report, baseline):
+    """Speed-up per operation (baseline median / current median)"""
+    baseline_cases = {case['size']: case for case in baseline['cases']}
+    comparison = []
+    for case in report['cases']:
+        reference = baseline_cases.get(case['size'])
+        if reference is None:
+            continue
+        for name, timing in case['timings'].items():
+            if name not in reference['timings']:
+                continue
+            before = reference['timings'][name]['median_s']
+            after = timing['median_s']
+            comparison.append({
+                'size': case['size'],
+                'operation': name,
+                'baseline_s': before,
+                'current_s': after,
+                'speedup': before / after if after > 0 else None,
+            })
+    return comparison
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic phantoms")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="Phantom edge lengths in voxels (e.g. 128 256 512)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per size")
+    parser.add_argument("--seed", type=int, default=0, help="Phantom random seed")
+    parser.add_argument("--no-render", action="store_true", help="Skip the offscreen render")
+    parser.add_argument("--output", type=Path, default=None,
+                        help="Result file (default: benchmarks/results/benchmark_<timestamp>.json)")
+    parser.add_argument("--baseline", type=Path, default=None,
+                        help="Previous result file to compute speed-ups against")
+    parser.add_argument("--work-dir", type=Path, default=None,
+                        help="Directory for phantom and intermediate files (default: temporary)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    output_path = args.output
+    if output_path is None:
+        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        output_path = Path(__file__).parent / "results" / f"benchmark_{timestamp}.json"
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'environment': environment_info(),
+        'settings': {'sizes': args.sizes, 'repeat': args.repeat, 'seed': args.seed},
+        'cases': [],
+    }
+
+    report['cold_start'] = cold_start()
+    print(f"Cold start (main.py --help): {report['cold_start']['median_s']:.2f} s")
+
+    with tempfile.TemporaryDirectory(prefix="vitk_bench_") as temp_dir:
+        work_dir = args.work_dir or Path(temp_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+        for size in args.sizes:
+            print(f"Phantom {size}^3...")
+            phantom = PhantomCase(size=size, seed=args.seed)
+
+            runs = []
+            for repeat in range(args.repeat):
+                profiler = PipelineProfiler().activate()
+                start = time.perf_counter()
+                timings, case_accuracy = run_case(phantom, work_dir, profiler, render=not args.no_render)
+                profiler.deactivate()
+                runs.append(timings)
+                print(f"   run {repeat + 1}: {time.perf_counter() - start:.1f} s "
+                      f"(registration error {case_accuracy['registration_error_mean_mm']} mm, "
+                      f"Dice {case_accuracy['dice_baseline_vs_truth']:.3f} / "
+                      f"{case_accuracy['dice_followup_vs_truth']:.3f})")
+
+            report['cases'].append({
+                'size': size,
+                'timings': summarize_timings(runs),
+                'accuracy': case_accuracy,
+                'stages': profiler.summary()['stages'],
+            })
+
+        report['preview_check'] = preview_check(work_dir, args.seed)
+        for name in ('stable', 'growing'):
+            check = report['preview_check'][name]
+            low, high = check['volume_change_percent_bounds']
+            bounds = "unbounded" if low is None else f"{low:.1f} to {high:.1f}%"
+            print(f"Preview {name} pair: change {check['volume_change_percent']:.1f}% ({bounds}), "
+                  f"full resolution {'needed' if check['upgrade'] else 'skipped'}")
+        if not report['preview_check']['passed']:
+            print(f"   Warning: preview triage check failed at {PREVIEW_CHECK_THRESHOLD:g}%")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            report['comparison'] = compare_to_baseline(report, json.load(f))
+        for entry in report['comparison']:
+            print(f"   {entry['size']}^3 {entry['operation']}: "
+                  f"{entry['baseline_s']:.3f} s -> {entry['current_s']:.3f} s "
+                  f"(x{entry['speedup']:.2f})")
+
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to: {output_path}")
+
+
+if __name__ == "__main__":
+    main()
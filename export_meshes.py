@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Export compact tumor meshes (VTP and binary glTF) for a cohort of pipeline results
+"""
+
+from pathlib import Path
+import argparse
+import json
+import sys
+import time
+
+# Add src directory to path
+sys.path.append(str(Path(__file__).parent / "src"))
+
+from mesh_export import export_cohort, DEFAULT_TRIANGLE_BUDGET
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Decimated tumor meshes for review clients")
+    parser.add_argument(
+        "results_dirs", nargs="+", type=Path,
+        help="Pipeline results directories (tumor masks and tumor_analysis.json)"
+    )
+    parser.add_argument("--output", type=Path, default=Path("review_meshes"), help="Output directory")
+    parser.add_argument("--triangle-budget", type=int, default=DEFAULT_TRIANGLE_BUDGET,
+                        help="Triangles per tumor surface")
+    parser.add_argument("--formats", nargs="+", choices=["vtp", "glb"], default=["vtp", "glb"])
+    parser.add_argument("--workers", type=int, default=None, help="Processes (default: one per CPU)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    start = time.perf_counter()
+    reports = export_cohort(args.results_dirs, args.output, args.triangle_budget,
+                            tuple(args.formats), args.workers)
+    elapsed = time.perf_counter() - start
+
+    total_bytes = 0
+    for results_dir, report in reports.items():
+        if 'error' in report:
+            print(f"{results_dir}: failed ({report['error']})")
+            continue
+        total_bytes += report['bytes']
+        print(f"{results_dir}: {len(report['files'])} meshes, {report['bytes'] / 1024:.1f} KB "
+              f"in {report['time_s']:.2f} s")
+    print(f"Exported {len(reports)} cases, {total_bytes / 1024:.1f} KB in {elapsed:.1f} s to {args.output}")
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    with open(args.output / "export_report.json", 'w') as f:
+        json.dump({'cases': reports, 'total_bytes': total_bytes, 'wall_time_s': elapsed}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,135 @@
 #!/usr/bin/env python3
 
+import time
+
+# Measured from here: interpreter start-up itself is outside the budget
+_START_TIME = time.perf_counter()
+
 from pathlib import Path
+import argparse
+import json
 import sys
 import os
 
 # Add src directory to path
 sys.path.append(str(Path(__file__).parent / "src"))
 
-from registration import ImageRegistration
-from segmentation import TumorSegmentation
-from analysis import TumorAnalysis
-from visualization import TumorVisualization
+# Only light modules at start-up: ITK, VTK and SciPy are imported by the
+# stages that need them, so e.g. a run without visualization never loads VTK
+from profiling import PipelineProfiler
+from async_io import AsyncImageIO
+
+
+STAGES = ["registration", "segmentation", "analysis", "visualization", "export"]
+
+# Seconds from the start of main.py to the first stage (argument parsing,
+# path setup); heavy imports in here would show up as a warning
+STARTUP_BUDGET_S = 0.5
+
+# Sequence of the case6 images: further sequences (--sequence) follow its transform
+REFERENCE_SEQUENCE = "gre"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tumor evolution analysis pipeline")
+    parser.add_argument(
+        "--stages", nargs="+", choices=STAGES, default=STAGES[:4],
+        help="Stages to run; skipped stages reuse the outputs of a previous run in results/ "
+             "(export, the decimated review meshes, only runs when listed)"
+    )
+    parser.add_argument(
+        "--storage", choices=["nrrd", "chunked"], default="nrrd",
+        help="Format for registered image and tumor masks (chunked = .vol directories)"
+    )
+    parser.add_argument(
+        "--sparse-masks", action="store_true",
+        help="Store tumor masks as sparse bounding-box bitmaps (.npz)"
+    )
+    parser.add_argument(
+        "--cprofile", action="store_true",
+        help="Run under cProfile and save statistics to results/pipeline.prof"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="Threads for smoothing and morphology (default: one per CPU)"
+    )
+    parser.add_argument(
+        "--recompute-brain-mask", action="store_true",
+        help="Skull-strip the registered follow-up instead of reusing the baseline brain mask"
+    )
+    parser.add_argument(
+        "--streaming", action="store_true",
+        help="Segment slab by slab with disk-backed intermediates (volumes larger than memory)"
+    )
+    parser.add_argument(
+        "--results-store", type=Path, default=None, metavar="PATH",
+        help="SQLite cohort store the analysis is added to (default: results/results.sqlite)"
+    )
+    parser.add_argument(
+        "--execution-report", action="store_true",
+        help="Also write a timestamped markdown execution report to results/"
+    )
+    parser.add_argument(
+        "--triangle-budget", type=int, default=None,
+        help="Triangles per tumor surface in the export stage (default: 5000)"
+    )
+    parser.add_argument(
+        "--multistart", action="store_true",
+        help="Register from several initial rotations in parallel (large misalignments)"
+    )
+    parser.add_argument(
+        "--preview", action="store_true",
+        help="Quick-look volumes, change and Dice on a coarse pyramid level, with error bounds"
+    )
+    parser.add_argument(
+        "--preview-shrink", type=int, choices=[2, 4], default=2,
+        help="Pyramid level of the preview (4 may miss small tumors)"
+    )
+    parser.add_argument(
+        "--upgrade-threshold", type=float, default=None, metavar="PCT",
+        help="After --preview, run the full pipeline when the volume change may reach PCT percent"
+    )
+    parser.add_argument(
+        "--sequence", nargs=3, action="append", default=[], metavar=("NAME", "BASELINE", "FOLLOWUP"),
+        help="A further co-acquired sequence (e.g. flair); registered with the GRE transform "
+             "and described under the GRE tumor masks (repeatable)"
+    )
+    parser.add_argument(
+        "--sync-io", action="store_true",
+        help="Read and write images in the foreground (no prefetch or write-behind)"
+    )
+    return parser.parse_args()
+
+
+def print_registration_qa(qa):
+    print(f"   Registration QA: NCC {qa['ncc']:.3f}, NMI {qa['normalized_mutual_information']:.3f}, "
+          f"mask Dice {qa['mask_dice']:.3f} ({qa['samples']} samples)")
+    if qa['suspect']:
+        print(f"   Warning: suspect registration ({', '.join(qa['reasons'])})")
+    if qa.get('retried'):
+        print(f"   Multi-start retry run, kept the {qa['retry']['kept']} registration")
+
+
+def print_preview(preview):
+    def bounds(values, unit, digits=1):
+        low, high = values
+        if low is None:
+            return "unbounded"
+        return f"{low:.{digits}f} to {high:.{digits}f}{unit}"
+    
+    comparison = preview['comparison']
+    for name in ('tumor1', 'tumor2'):
+        tumor = preview[name]
+        print(f"   {name} volume: {tumor['volume_mm3']:.1f} mm3 "
+              f"({bounds(tumor['volume_bounds_mm3'], ' mm3')}), {tumor['voxels_across']} voxels across")
+    print(f"   Volume change: {comparison['volume_change_percent']:.1f}% "
+          f"({bounds(comparison['volume_change_percent_bounds'], '%')})")
+    print(f"   Dice: {comparison['dice_coefficient']:.3f} ({bounds(comparison['dice_bounds'], '', 3)})")
 
 
 def main():
+    args = parse_args()
+    
     # Setup paths
     project_root = Path(__file__).parent
     data_dir = project_root / "Data"
@@ -22,88 +138,371 @@ def main():
     # Input files
     image1_path = data_dir / "case6_gre1.nrrd"
     image2_path = data_dir / "case6_gre2.nrrd"
+    # Case files are named <patient>_<timepoint>
+    patient = image1_path.stem.split("_")[0]
     
     # Output files
-    registered_image_path = results_dir / "registered_case6_gre2.nrrd"
-    tumor1_mask_path = results_dir / "tumor_mask_scan1.nrrd"
-    tumor2_mask_path = results_dir / "tumor_mask_scan2.nrrd"
+    volume_suffix = ".vol" if args.storage == "chunked" else ".nrrd"
+    registered_image_path = results_dir / f"registered_case6_gre2{volume_suffix}"
+    mask_suffix = ".npz" if args.sparse_masks else volume_suffix
+    tumor1_mask_path = results_dir / f"tumor_mask_scan1{mask_suffix}"
+    tumor2_mask_path = results_dir / f"tumor_mask_scan2{mask_suffix}"
     transform_path = results_dir / "registration_transform.tfm"
+    transforms_dir = results_dir / "transforms"
     analysis_report_path = results_dir / "tumor_analysis.json"
+    change_map_path = results_dir / "tumor_change_map.nrrd"
     screenshot_path = results_dir / "tumor_evolution_3d.png"
     
+    # Further sequences: (baseline, follow-up) files, and where they go on the baseline grid
+    sequence_files = {name: (Path(baseline), Path(followup)) for name, baseline, followup in args.sequence}
+    sequence_outputs = {
+        name: (results_dir / f"resampled_{baseline.stem}{volume_suffix}",
+               results_dir / f"registered_{followup.stem}{volume_suffix}")
+        for name, (baseline, followup) in sequence_files.items()
+    }
+    # (baseline, follow-up) images or files per sequence for the analysis
+    sequences = {}
+    
     # Create results directory
     results_dir.mkdir(exist_ok=True)
     
     print("Starting tumor evolution analysis pipeline...")
+    profiler = PipelineProfiler(cprofile=args.cprofile).activate()
+    startup_time = time.perf_counter() - _START_TIME
+    if startup_time > STARTUP_BUDGET_S:
+        print(f"   Warning: start-up took {startup_time:.2f} s (budget {STARTUP_BUDGET_S:.2f} s)")
     
-    # Step 1: Image Registration
-    print("1. Performing image registration...")
-    registrator = ImageRegistration()
-    registered_image, transform = registrator.register_images(
-        image1_path, image2_path, registered_image_path
-    )
+    if args.preview:
+        print(f"0. Preview at 1/{args.preview_shrink} resolution...")
+        with profiler.stage("preview"):
+            from preview import preview_tumor_change, needs_full_resolution
+            
+            preview = preview_tumor_change(image1_path, image2_path, args.preview_shrink, workers=args.workers)
+        print_preview(preview)
+        preview['profiling'] = profiler.summary()
+        with open(results_dir / "tumor_preview.json", 'w') as f:
+            json.dump(preview, f, indent=2)
+        print(f"   Preview saved to: {results_dir / 'tumor_preview.json'}")
+        
+        if args.upgrade_threshold is None or not needs_full_resolution(preview, args.upgrade_threshold):
+            profiler.deactivate()
+            print(f"   Total preview time: {preview['profiling']['total_wall_time_s']:.1f} s")
+            return
+        print(f"   Change may reach {args.upgrade_threshold:g}%: running the full-resolution pipeline")
     
-    if transform:
-        registrator.save_transform(transform, transform_path)
-        print(f"   Registration completed. Registered image saved to: {registered_image_path}")
+    # Images are decoded ahead of the stage that reads them, and outputs are
+    # written behind the computation; everything is flushed before the reports
+    io = None if args.sync_io else AsyncImageIO().activate()
+    
+    # Step 1: Image Registration
+    registered = False
+    registration_qa = None
+    if "registration" in args.stages:
+        print("1. Performing image registration...")
+        with profiler.stage("registration"):
+            with profiler.stage("import"):
+                from registration import ImageRegistration, registration_qa_score
+            
+            registrator = ImageRegistration()
+            if io is not None and not args.multistart:
+                # Decoded while the fixed image is read
+                io.prefetch(image2_path, registrator.ImageType)
+            
+            def register(multistart, write=True):
+                """(registered image, transform, sequence images) of one registration attempt,
+                written to the results unless ``write`` is False"""
+                output_path = registered_image_path if write else None
+                if sequence_files:
+                    # Registered once on the GRE pair, then all follow-up sequences in one resample pass
+                    output_paths = {REFERENCE_SEQUENCE: output_path, **{n: o[1] for n, o in sequence_outputs.items()}}
+                    baseline, followup, sequence_transform = registrator.register_sequences(
+                        {REFERENCE_SEQUENCE: image1_path, **{n: f[0] for n, f in sequence_files.items()}},
+                        {REFERENCE_SEQUENCE: image2_path, **{n: f[1] for n, f in sequence_files.items()}},
+                        REFERENCE_SEQUENCE,
+                        output_paths if write else None,
+                        {n: o[0] for n, o in sequence_outputs.items()},
+                        multistart=multistart, workers=args.workers
+                    )
+                    return (followup[REFERENCE_SEQUENCE], sequence_transform,
+                            {name: (baseline[name], followup[name]) for name in sequence_files})
+                if multistart:
+                    return (*registrator.register_multistart(
+                        image1_path, image2_path, output_path, workers=args.workers
+                    ), {})
+                return (*registrator.register_images(image1_path, image2_path, output_path), {})
+            
+            if args.multistart:
+                registered_image, transform, sequences = register(multistart=True)
+            else:
+                registered_image, transform, sequences = register(multistart=False)
+                if transform:
+                    registration_qa = registrator.assess_registration(image1_path, registered_image)
+                # A failed or suspect single-start registration gets a multi-start retry,
+                # kept only if its QA is better
+                if transform is None or registration_qa['suspect']:
+                    print("   Retrying registration from several starts...")
+                    with profiler.stage("multistart"):
+                        retry_image, retry_transform, retry_sequences = register(multistart=True, write=False)
+                    retry_qa = None
+                    if retry_transform:
+                        retry_qa = registrator.assess_registration(image1_path, retry_image)
+                    first_qa = registration_qa
+                    kept = "first"
+                    if retry_transform and registration_qa_score(retry_qa) > registration_qa_score(first_qa):
+                        from storage import write_image
+                        
+                        registered_image, transform, sequences = retry_image, retry_transform, retry_sequences
+                        registration_qa = retry_qa
+                        kept = "multistart"
+                        write_image(registered_image, registered_image_path, registrator.ImageType)
+                        for name, (_, followup) in sequences.items():
+                            write_image(followup, sequence_outputs[name][1], registrator.ImageType)
+                    elif transform:
+                        print("   Keeping the first registration, the retry did not score better")
+                    if registration_qa is not None:
+                        registration_qa = dict(registration_qa, retried=True,
+                                               retry={'first': first_qa, 'multistart': retry_qa, 'kept': kept})
+            
+            if transform:
+                from transforms import TransformService
+                
+                registrator.save_transform(transform, transform_path)
+                # Baseline to follow-up space, for mapping results without resampling
+                TransformService(transforms_dir).add(
+                    patient, image1_path.stem, image2_path.stem, transform, source=transform_path.name
+                )
+                registered = True
+                print(f"   Registration completed. Registered image saved to: {registered_image_path}")
+                if registration_qa is None:
+                    registration_qa = registrator.assess_registration(image1_path, registered_image)
+                registration_qa.setdefault('retried', False)
+                print_registration_qa(registration_qa)
+            else:
+                print("   Registration failed, using original image")
+                registered_image_path = image2_path
     else:
-        print("   Registration failed, using original image")
-        registered_image_path = image2_path
+        from storage import resolve_result_path
+        
+        previous = resolve_result_path(results_dir, "registered_case6_gre2")
+        if previous.exists():
+            registered_image_path = previous
+            registered = True
+            print(f"1. Skipping registration, using {registered_image_path}")
+        else:
+            registered_image_path = image2_path
+            print("1. Skipping registration, no registered image found: using original image")
+        for name, (baseline, followup) in sequence_files.items():
+            resampled = resolve_result_path(results_dir, sequence_outputs[name][0].stem)
+            previous = resolve_result_path(results_dir, sequence_outputs[name][1].stem)
+            sequences[name] = (resampled if resampled.exists() else baseline,
+                               previous if registered and previous.exists() else followup)
     
     # Step 2: Tumor Segmentation
-    print("2. Segmenting tumors...")
-    segmenter = TumorSegmentation()
-    
-    # Segment tumor in first scan
-    tumor1_mask = segmenter.segment_tumor_automatic(image1_path, tumor1_mask_path)
-    print(f"   Tumor segmentation for scan 1 completed: {tumor1_mask_path}")
-    
-    # Segment tumor in registered second scan
-    tumor2_mask = segmenter.segment_tumor_automatic(registered_image_path, tumor2_mask_path)
-    print(f"   Tumor segmentation for scan 2 completed: {tumor2_mask_path}")
+    # Masks for the 3D scene: in memory when segmented in this run, else their files
+    tumor_masks = None
+    if "segmentation" in args.stages:
+        print("2. Segmenting tumors...")
+        # Segment tumor in first scan
+        with profiler.stage("segmentation_scan1"):
+            with profiler.stage("import"):
+                from segmentation import TumorSegmentation
+            
+            segmenter = TumorSegmentation(workers=args.workers)
+            if io is not None and not args.streaming:
+                # The registered image is read back, as soon as written, while scan 1 segments
+                io.prefetch(registered_image_path, segmenter.ImageType)
+            if args.streaming:
+                tumor1_mask = segmenter.segment_tumor_streaming(image1_path, tumor1_mask_path)
+            else:
+                tumor1_mask, brain_masks = segmenter.segment_tumor_automatic(
+                    image1_path, tumor1_mask_path, sparse=args.sparse_masks, return_brain_masks=True
+                )
+        print(f"   Tumor segmentation for scan 1 completed: {tumor1_mask_path}")
+        
+        # The registered scan lies in baseline space: reuse the baseline brain masks
+        # instead of skull stripping it again
+        if args.streaming or not registered or args.recompute_brain_mask:
+            brain_masks = None
+        
+        # Segment tumor in registered second scan
+        with profiler.stage("segmentation_scan2"):
+            if io is not None and "analysis" in args.stages:
+                # Intensity statistics read both images again
+                for path in (image1_path, registered_image_path):
+                    if Path(path).suffix == ".nrrd":
+                        io.prefetch(path, segmenter.ImageType)
+            if args.streaming:
+                tumor2_mask = segmenter.segment_tumor_streaming(registered_image_path, tumor2_mask_path)
+            else:
+                tumor2_mask = segmenter.segment_tumor_automatic(
+                    registered_image_path, tumor2_mask_path, sparse=args.sparse_masks,
+                    brain_masks=brain_masks, refine_brain_mask=True
+                )
+        print(f"   Tumor segmentation for scan 2 completed: {tumor2_mask_path}")
+        tumor_masks = (tumor1_mask, tumor2_mask)
+    else:
+        from storage import resolve_result_path
+        
+        tumor1_mask_path = resolve_result_path(results_dir, "tumor_mask_scan1")
+        tumor2_mask_path = resolve_result_path(results_dir, "tumor_mask_scan2")
+        print(f"2. Skipping segmentation, using {tumor1_mask_path.name} and {tumor2_mask_path.name}")
+        if not (tumor1_mask_path.exists() and tumor2_mask_path.exists()):
+            if "analysis" in args.stages or "visualization" in args.stages:
+                print("Error: no tumor masks found, run the segmentation stage first")
+                sys.exit(1)
     
     # Step 3: Quantitative Analysis
-    print("3. Performing quantitative analysis...")
-    analyzer = TumorAnalysis()
-    analysis_results = analyzer.compare_tumors(
-        image1_path, tumor1_mask_path,
-        registered_image_path, tumor2_mask_path
-    )
-    
-    text_report_path = analyzer.save_analysis_report(analysis_results, analysis_report_path)
-    print(f"   Analysis completed. Report saved to: {text_report_path}")
+    analysis_results = None
+    if "analysis" in args.stages:
+        print("3. Performing quantitative analysis...")
+        with profiler.stage("analysis"):
+            with profiler.stage("import"):
+                from analysis import TumorAnalysis
+            
+            analyzer = TumorAnalysis()
+            analysis_results = analyzer.compare_tumors(
+                image1_path, tumor1_mask_path,
+                registered_image_path, tumor2_mask_path,
+                change_map_path=change_map_path, sequences=sequences
+            )
+            
+            # A registration from a previous run is checked here instead
+            if registered and registration_qa is None:
+                from registration import ImageRegistration
+                
+                registration_qa = ImageRegistration().assess_registration(image1_path, registered_image_path)
+                print_registration_qa(registration_qa)
+            analysis_results['registration_qa'] = registration_qa
+            
+            # Follow-up lesions were measured in baseline space: add their native scanner coordinates
+            if registered:
+                from transforms import TransformService
+                
+                TransformService(transforms_dir).add_native_coordinates(
+                    analysis_results, patient, image1_path.stem, image2_path.stem
+                )
+        
+        # Print key results
+        volume1 = analysis_results['tumor1']['volume_mm3']
+        volume2 = analysis_results['tumor2']['volume_mm3']
+        volume_change = analysis_results['comparison']['volume_change_percent']
+        dice_score = analysis_results['comparison']['dice_coefficient']
+        
+        print(f"   Key Results:")
+        print(f"   - Initial tumor volume: {volume1:.1f} mm³")
+        print(f"   - Follow-up tumor volume: {volume2:.1f} mm³")
+        print(f"   - Volume change: {volume_change:.1f}%")
+        print(f"   - Dice coefficient: {dice_score:.3f}")
+        change_volumes = analysis_results['comparison']['change_volumes_mm3']
+        print(f"   - Grown / regressed / stable: {change_volumes['grown']:.1f} / "
+              f"{change_volumes['regressed']:.1f} / {change_volumes['stable']:.1f} mm³")
+        for name, sequence in analysis_results.get('sequences', {}).items():
+            print(f"   - {name} tumor mean intensity: {sequence['tumor1']['mean']:.1f} -> "
+                  f"{sequence['tumor2']['mean']:.1f}")
+    elif analysis_report_path.exists():
+        print(f"3. Skipping analysis, using {analysis_report_path.name}")
+        with open(analysis_report_path, 'r') as f:
+            analysis_results = json.load(f)
+    else:
+        print("3. Skipping analysis")
     
-    # Generate timestamped execution report
-    execution_report_path = analyzer.create_execution_report(analysis_results, results_dir)
-    print(f"   Execution report saved to: {execution_report_path}")
+    # Step 4: 3D Visualization (screenshot only)
+    if "visualization" in args.stages and analysis_results is not None:
+        print("4. Creating 3D visualization...")
+        try:
+            with profiler.stage("visualization"):
+                with profiler.stage("import"):
+                    from visualization import TumorVisualization
+                
+                if io is not None:
+                    # The change map may still be in the write-behind queue
+                    io.wait_for_write(change_map_path)
+                visualizer = TumorVisualization()
+                visualizer.visualize_tumor_evolution(
+                    image1_path, *(tumor_masks or (tumor1_mask_path, tumor2_mask_path)),
+                    analysis_results, change_map=change_map_path if change_map_path.exists() else None
+                )
+                
+                # Save screenshot only (avoid interactive mode)
+                visualizer.save_screenshot(screenshot_path)
+            print(f"   3D visualization screenshot saved to: {screenshot_path}")
+        
+        except Exception as e:
+            print(f"   Visualization warning: {e}")
+            print("   Continuing without interactive visualization...")
+    elif "visualization" in args.stages:
+        print("4. Skipping visualization: no analysis results")
+    else:
+        print("4. Skipping visualization")
     
-    # Print key results
-    volume1 = analysis_results['tumor1']['volume_mm3']
-    volume2 = analysis_results['tumor2']['volume_mm3']
-    volume_change = analysis_results['comparison']['volume_change_percent']
-    dice_score = analysis_results['comparison']['dice_coefficient']
+    # Step 5: Compact review meshes
+    if "export" in args.stages and analysis_results is not None:
+        print("5. Exporting review meshes...")
+        with profiler.stage("export"):
+            from mesh_export import export_tumor_meshes, DEFAULT_TRIANGLE_BUDGET
+            from transforms import TransformService
+            
+            native_matrix = None
+            if registered:
+                try:
+                    native_matrix = TransformService(transforms_dir).chain(patient, image1_path.stem, image2_path.stem)
+                except KeyError:
+                    pass
+            export_report = export_tumor_meshes(
+                *(tumor_masks or (tumor1_mask_path, tumor2_mask_path)), analysis_results,
+                results_dir / "meshes", args.triangle_budget or DEFAULT_TRIANGLE_BUDGET,
+                native_matrix=native_matrix
+            )
+        print(f"   {len(export_report['files'])} meshes, {export_report['bytes'] / 1024:.1f} KB "
+              f"in {export_report['time_s']:.2f} s, saved to: {results_dir / 'meshes'}")
+    elif "export" in args.stages:
+        print("5. Skipping export: no analysis results")
     
-    print(f"   Key Results:")
-    print(f"   - Initial tumor volume: {volume1:.1f} mm³")
-    print(f"   - Follow-up tumor volume: {volume2:.1f} mm³")
-    print(f"   - Volume change: {volume_change:.1f}%")
-    print(f"   - Dice coefficient: {dice_score:.3f}")
+    # Step 6: Reports, including per-stage timings
+    if io is not None:
+        # Every output is on disk (and fsynced) before it is reported
+        with profiler.stage("flush"):
+            io.deactivate()
+        io_summary = io.summary()
+        print(f"   Background I/O: {io_summary['prefetch_hits']}/{io_summary['reads']} reads prefetched, "
+              f"{io_summary['writes']} files written behind ({io_summary['bytes_written'] / 2**20:.1f} MB), "
+              f"flush waited {io_summary['flush_wait_s']:.2f} s")
+    profiler.deactivate()
+    summary = profiler.summary()
+    summary['startup_time_s'] = startup_time
+    summary['startup_budget_s'] = STARTUP_BUDGET_S
+    summary['stages_run'] = list(args.stages)
+    if io is not None:
+        summary['io'] = io_summary
+    if args.cprofile:
+        profile_path = profiler.save_cprofile(results_dir / "pipeline.prof")
+        print(f"   cProfile statistics saved to: {profile_path}")
     
-    # Step 4: 3D Visualization (screenshot only)
-    print("4. Creating 3D visualization...")
-    try:
-        visualizer = TumorVisualization()
-        visualizer.visualize_tumor_evolution(
-            image1_path, tumor1_mask_path, tumor2_mask_path, analysis_results
-        )
+    if "analysis" in args.stages:
+        print("6. Writing reports...")
+        from segmentation import DEFAULT_TUMOR_PARAMETERS
+        from results_store import ResultsStore
+        
+        analysis_results['profiling'] = summary
+        analysis_results['parameters'] = {
+            'tumor': DEFAULT_TUMOR_PARAMETERS,
+            'recompute_brain_mask': args.recompute_brain_mask,
+            'streaming': args.streaming,
+        }
+        text_report_path = analyzer.save_analysis_report(analysis_results, analysis_report_path)
+        print(f"   Analysis report saved to: {text_report_path}")
         
-        # Save screenshot only (avoid interactive mode)
-        visualizer.save_screenshot(screenshot_path)
-        print(f"   3D visualization screenshot saved to: {screenshot_path}")
+        # One indexed row per patient, timepoint pair and parameter set
+        store_path = args.results_store or results_dir / "results.sqlite"
+        with ResultsStore(store_path) as store:
+            store.add(patient, image1_path.stem, image2_path.stem, analysis_results)
+        print(f"   Results added to: {store_path}")
         
-    except Exception as e:
-        print(f"   Visualization warning: {e}")
-        print("   Continuing without interactive visualization...")
+        if args.execution_report:
+            execution_report_path = analyzer.create_execution_report(analysis_results, results_dir)
+            print(f"   Execution report saved to: {execution_report_path}")
+    print(f"   Start-up time: {startup_time:.2f} s")
+    print(f"   Total pipeline time: {summary['total_wall_time_s']:.1f} s")
     
     print("Tumor evolution analysis pipeline completed successfully!")
     print(f"Results saved in: {results_dir}")
@@ -113,4 +512,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Persistent pipeline service: pre-warmed workers behind a local Unix socket
+"""
+
+from pathlib import Path
+import argparse
+import json
+import sys
+
+# Add src directory to path
+sys.path.append(str(Path(__file__).parent / "src"))
+
+from job_service import JobService, ServiceClient, JOB_STAGES, DEFAULT_SOCKET_PATH
+from results_store import DEFAULT_STORE_PATH
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tumor evolution pipeline service")
+    parser.add_argument(
+        "--socket", type=Path, default=Path(__file__).parent / DEFAULT_SOCKET_PATH,
+        help="Unix socket path"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="Start the service")
+    serve.add_argument("--max-jobs", type=int, default=1, help="Worker processes (concurrent jobs)")
+    serve.add_argument("--queue-limit", type=int, default=64, help="Queued jobs before submissions are refused")
+    serve.add_argument("--threads-per-job", type=int, default=None,
+                       help="Smoothing/morphology threads per job (default: CPUs / max jobs)")
+    serve.add_argument("--results-store", type=Path, default=Path(__file__).parent / DEFAULT_STORE_PATH,
+                       help="SQLite store finished jobs are added to")
+
+    submit = commands.add_parser("submit", help="Submit a case and wait for its results")
+    submit.add_argument("image1", type=Path, help="Baseline image")
+    submit.add_argument("image2", type=Path, help="Follow-up image")
+    submit.add_argument("output_dir", type=Path, help="Directory for the job outputs")
+    submit.add_argument("--patient", default=None, help="Patient id in the results store (default: image1 name prefix)")
+    submit.add_argument("--stages", nargs="+", choices=JOB_STAGES, default=JOB_STAGES[:3])
+    submit.add_argument("--sparse-masks", action="store_true")
+    submit.add_argument("--no-wait", action="store_true", help="Print the job id and return")
+
+    for name in ("status", "result"):
+        command = commands.add_parser(name, help=f"Show the {name} of a job")
+        command.add_argument("job_id")
+    commands.add_parser("stats", help="Show worker and queue statistics")
+    commands.add_parser("shutdown", help="Stop the service")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.command == "serve":
+        service = JobService(args.socket, max_jobs=args.max_jobs, queue_limit=args.queue_limit,
+                             threads_per_job=args.threads_per_job, results_store=args.results_store)
+        print("Starting workers...")
+        service.start_workers()
+        service.run()
+        return
+
+    client = ServiceClient(args.socket)
+    try:
+        run_command(client, args)
+    except (OSError, RuntimeError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+def run_command(client, args):
+    if args.command == "submit":
+        job_id = client.submit(
+            args.image1.resolve(), args.image2.resolve(), args.output_dir.resolve(),
+            stages=args.stages, sparse_masks=args.sparse_masks, patient=args.patient
+        )
+        if args.no_wait:
+            print(job_id)
+            return
+        print(json.dumps(client.wait(job_id), indent=2))
+    elif args.command == "status":
+        print(json.dumps(client.status(args.job_id), indent=2))
+    elif args.command == "result":
+        print(json.dumps(client.result(args.job_id), indent=2))
+    elif args.command == "stats":
+        print(json.dumps(client.request({'action': 'stats'}), indent=2))
+    elif args.command == "shutdown":
+        client.shutdown()
+
+
+if __name__ == "__main__":
+    main()
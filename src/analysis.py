@@ -3,6 +3,21 @@ import numpy as np
 from pathlib import Path
 import json
 
+from storage import ChunkedVolume, is_chunked_volume, read_image, wait_for_write, write_image
+from sparse_mask import SparseMask, SPARSE_SUFFIX
+from profiling import profile_step
+
+
+# Change map labels: bit 0 = tumor in the baseline, bit 1 = tumor in the follow-up
+CHANGE_LABELS = {'regressed': 1, 'grown': 2, 'stable': 3}
+
+# Partial-volume error of a boundary voxel, in voxels: its tumor fraction is
+# anywhere in [0, 1] (uniform, standard deviation 1/sqrt(12))
+PARTIAL_VOLUME_STD = 12 ** -0.5
+
+# Preview bounds span this many standard deviations (about 95%)
+PREVIEW_BOUND_SIGMAS = 2.0
+
 
 class TumorAnalysis:
     def __init__(self):
@@ -11,18 +26,25 @@ class TumorAnalysis:
         self.ImageType = itk.Image[self.PixelType, self.Dimension]
         
     def load_image(self, image_path):
-        reader = itk.ImageFileReader[self.ImageType].New()
-        reader.SetFileName(str(image_path))
-        reader.Update()
-        return reader.GetOutput()
+        return read_image(image_path, self.ImageType)
     
     def load_mask(self, mask_path):
-        reader = itk.ImageFileReader[itk.Image[itk.UC, self.Dimension]].New()
-        reader.SetFileName(str(mask_path))
-        reader.Update()
-        return reader.GetOutput()
+        return read_image(mask_path, itk.Image[itk.UC, self.Dimension])
+    
+    def load_sparse_mask(self, mask_path):
+        if isinstance(mask_path, SparseMask):
+            return mask_path
+        if not isinstance(mask_path, (str, Path)):
+            return SparseMask.from_itk(mask_path)
+        if Path(mask_path).suffix == SPARSE_SUFFIX:
+            wait_for_write(mask_path)
+            return SparseMask.load(mask_path)
+        return SparseMask.from_itk(self.load_mask(mask_path))
     
     def calculate_volume(self, mask_image):
+        if isinstance(mask_image, SparseMask):
+            return mask_image.volume_mm3()
+        
         mask_array = itk.GetArrayFromImage(mask_image)
         spacing = mask_image.GetSpacing()
         voxel_volume = spacing[0] * spacing[1] * spacing[2]
@@ -31,10 +53,27 @@ class TumorAnalysis:
         return volume_mm3
     
     def calculate_intensity_statistics(self, image, mask_image):
-        image_array = itk.GetArrayFromImage(image)
-        mask_array = itk.GetArrayFromImage(mask_image)
-        
-        tumor_intensities = image_array[mask_array > 0]
+        if isinstance(mask_image, SparseMask):
+            # Restrict the lookup to the mask bounding box
+            if mask_image.is_empty:
+                tumor_intensities = np.array([])
+            elif isinstance(image, ChunkedVolume):
+                tumor_intensities = image.read(mask_image.bbox)[mask_image.crop()]
+            else:
+                image_array = itk.GetArrayViewFromImage(image)
+                tumor_intensities = image_array[mask_image.bbox][mask_image.crop()]
+        elif isinstance(image, ChunkedVolume):
+            mask_array = itk.GetArrayFromImage(mask_image)
+            # Only decode the chunks under the mask bounding box
+            tumor_intensities = np.array([], dtype=image.dtype)
+            coords = np.nonzero(mask_array)
+            if len(coords[0]) > 0:
+                roi = tuple(slice(c.min(), c.max() + 1) for c in coords)
+                tumor_intensities = image.read(roi)[mask_array[roi] > 0]
+        else:
+            image_array = itk.GetArrayFromImage(image)
+            mask_array = itk.GetArrayFromImage(mask_image)
+            tumor_intensities = image_array[mask_array > 0]
         
         if len(tumor_intensities) == 0:
             return {
@@ -53,28 +92,106 @@ class TumorAnalysis:
             'median': float(np.median(tumor_intensities))
         }
     
-    def calculate_dice_coefficient(self, mask1, mask2):
-        array1 = itk.GetArrayFromImage(mask1)
-        array2 = itk.GetArrayFromImage(mask2)
+    def calculate_sequence_statistics(self, images, mask):
+        """Intensity statistics of several sequences under one tumor mask.
         
-        intersection = np.sum((array1 > 0) & (array2 > 0))
-        total = np.sum(array1 > 0) + np.sum(array2 > 0)
+        ``images`` maps sequence names to images on the mask's grid (ITK
+        images, chunked volumes or paths). The mask bounding box and voxel
+        selection are computed once and shared by all sequences, whose
+        tumor intensities are reduced together. Returns a dict of
+        calculate_intensity_statistics() dicts.
+        """
+        if not isinstance(mask, SparseMask):
+            mask = SparseMask.from_itk(mask)
+        if mask.is_empty:
+            return {name: self.calculate_intensity_statistics(None, mask) for name in images}
         
-        if total == 0:
-            return 1.0
+        crop = mask.crop()
+        rows = []
+        for image in images.values():
+            if isinstance(image, (str, Path)):
+                image = self.load_image_for_statistics(image)
+            if isinstance(image, ChunkedVolume):
+                rows.append(image.read(mask.bbox)[crop])
+            else:
+                rows.append(itk.GetArrayViewFromImage(image)[mask.bbox][crop])
+        values = np.stack(rows).astype(np.float64)
         
-        dice = 2.0 * intersection / total
-        return float(dice)
+        statistics = zip(values.mean(axis=1), values.std(axis=1), values.min(axis=1), values.max(axis=1),
+                         np.median(values, axis=1))
+        return {
+            name: {'mean': float(mean), 'std': float(std), 'min': float(low), 'max': float(high),
+                   'median': float(median)}
+            for name, (mean, std, low, high, median) in zip(images, statistics)
+        }
+    
+    def calculate_lesion_features(self, images, masks):
+        """Radiomics features of every lesion, for each (image, sparse mask) pair.
+        
+        Each mask is split into connected lesions, cropped to their bounding
+        boxes; the lesions of all pairs go through radiomics.extract_features
+        as one batch. Returns one list of lesion dicts (largest first) per
+        pair, with the lesion's bounding box offset in the volume and its
+        physical centroid and bounding box (``centroid_mm``, ``bbox_mm``).
+        """
+        from radiomics import lesion_rois, extract_features
+        
+        batches = []
+        for image, mask in zip(images, masks):
+            rois = []
+            if not mask.is_empty:
+                if isinstance(image, ChunkedVolume):
+                    image_crop = image.read(mask.bbox)
+                else:
+                    image_crop = itk.GetArrayViewFromImage(image)[mask.bbox]
+                rois = lesion_rois(image_crop, mask.crop())
+            batches.append(rois)
+        
+        all_rois = [roi for rois in batches for roi in rois]
+        if not all_rois:
+            return [[] for _ in batches]
+        # The masks share one grid: (z, y, x) spacing of the first
+        features = extract_features(all_rois, masks[0].spacing[::-1])
+        
+        lesions = []
+        start = 0
+        for mask, rois in zip(masks, batches):
+            lesions.append([
+                dict(offset=[int(o + m) for o, m in zip(roi['offset'], mask.offset)],
+                     **self._lesion_position(mask, roi), **feature)
+                for roi, feature in zip(rois, features[start:start + len(rois)])
+            ])
+            start += len(rois)
+        return lesions
+    
+    def _lesion_position(self, mask, roi):
+        # Voxel centroid, and the corners of the voxel bounding box, in physical space
+        offset = np.asarray(roi['offset']) + np.asarray(mask.offset)
+        centroid = np.argwhere(roi['mask']).mean(axis=0) + offset
+        last = offset + np.asarray(roi['mask'].shape) - 1
+        corners = np.array([mask.index_to_physical(np.where(bits, last, offset)) for bits in np.ndindex(2, 2, 2)])
+        return {
+            'centroid_mm': mask.index_to_physical(centroid).tolist(),
+            'bbox_mm': [corners.min(axis=0).tolist(), corners.max(axis=0).tolist()],
+        }
+    
+    def calculate_dice_coefficient(self, mask1, mask2):
+        if not isinstance(mask1, SparseMask):
+            mask1 = SparseMask.from_itk(mask1)
+        if not isinstance(mask2, SparseMask):
+            mask2 = SparseMask.from_itk(mask2)
+        return mask1.dice(mask2)
     
     def calculate_hausdorff_distance(self, mask1, mask2):
         from scipy.spatial.distance import directed_hausdorff
         
-        array1 = itk.GetArrayFromImage(mask1)
-        array2 = itk.GetArrayFromImage(mask2)
-        
-        # Get surface points
-        points1 = np.array(np.where(array1 > 0)).T
-        points2 = np.array(np.where(array2 > 0)).T
+        if not isinstance(mask1, SparseMask):
+            mask1 = SparseMask.from_itk(mask1)
+        if not isinstance(mask2, SparseMask):
+            mask2 = SparseMask.from_itk(mask2)
+        points1 = mask1.points()
+        points2 = mask2.points()
+        spacing = mask1.spacing
         
         if len(points1) == 0 or len(points2) == 0:
             return float('inf')
@@ -83,58 +200,239 @@ class TumorAnalysis:
         hausdorff_1to2 = directed_hausdorff(points1, points2)[0]
         hausdorff_2to1 = directed_hausdorff(points2, points1)[0]
         
-        spacing = mask1.GetSpacing()
         voxel_size = min(spacing)
         
         return float(max(hausdorff_1to2, hausdorff_2to1) * voxel_size)
     
-    def compare_tumors(self, image1_path, mask1_path, image2_path, mask2_path):
-        image1 = self.load_image(image1_path)
-        mask1 = self.load_mask(mask1_path)
-        image2 = self.load_image(image2_path)
-        mask2 = self.load_mask(mask2_path)
+    def compute_change_map(self, mask1, mask2, padding=1):
+        """Labeled change map of two masks on the same grid, with region volumes.
+
+        Each voxel is regressed (baseline only), grown (follow-up only) or
+        stable (both), see CHANGE_LABELS. The map covers the union of the two
+        bounding boxes plus ``padding`` background voxels so that contours
+        close. Returns it as an ITK image with the masks' geometry, and the
+        volume of each region in mm³.
+        """
+        if not isinstance(mask1, SparseMask):
+            mask1 = SparseMask.from_itk(mask1)
+        if not isinstance(mask2, SparseMask):
+            mask2 = SparseMask.from_itk(mask2)
+        if mask1.shape != mask2.shape:
+            raise ValueError(f"Mask shapes differ: {mask1.shape} vs {mask2.shape}")
+        
+        masks = [m for m in (mask1, mask2) if not m.is_empty]
+        start = np.zeros(3, dtype=np.int64)
+        stop = np.zeros(3, dtype=np.int64)
+        if masks:
+            start = np.min([m.offset for m in masks], axis=0)
+            stop = np.max([np.add(m.offset, m.bbox_shape) for m in masks], axis=0)
+        start -= padding
+        stop += padding
+        
+        # Both masks OR-ed into one label array, then a single bincount
+        labels = np.zeros(stop - start, dtype=np.uint8)
+        for bit, mask in enumerate((mask1, mask2)):
+            if not mask.is_empty:
+                region = tuple(slice(o - s, o - s + n) for o, s, n in zip(mask.offset, start, mask.bbox_shape))
+                labels[region] |= mask.crop().astype(np.uint8) << bit
+        counts = np.bincount(labels.ravel(), minlength=len(CHANGE_LABELS) + 1)
+        volumes = {name: float(counts[label] * mask1.voxel_volume()) for name, label in CHANGE_LABELS.items()}
+        
+        change_map = itk.GetImageFromArray(labels)
+        change_map.SetOrigin(mask1.index_to_physical(start).tolist())
+        change_map.SetSpacing(mask1.spacing)
+        change_map.SetDirection(itk.matrix_from_array(mask1.direction))
+        return change_map, volumes
+    
+    def load_image_for_statistics(self, image_path):
+        if not isinstance(image_path, (str, Path)):
+            return image_path
+        # Chunked volumes are read lazily, region by region
+        wait_for_write(image_path)
+        if is_chunked_volume(image_path):
+            return ChunkedVolume(image_path)
+        return self.load_image(image_path)
+    
+    def compare_tumors(self, image1_path, mask1_path, image2_path, mask2_path, change_map_path=None,
+                       radiomics=True, sequences=None):
+        """Volumes, intensities, lesions, overlap and change map of two tumor masks.
+        
+        Images and masks are paths, or ITK images and SparseMasks in memory.
+        ``sequences`` optionally maps further sequence names to (baseline,
+        follow-up) images or paths on the grids of image1 and image2; their
+        intensity statistics under the same masks go into ``sequences``.
+        """
+        with profile_step("load"):
+            image1 = self.load_image_for_statistics(image1_path)
+            mask1 = self.load_sparse_mask(mask1_path)
+            image2 = self.load_image_for_statistics(image2_path)
+            mask2 = self.load_sparse_mask(mask2_path)
         
         # Volume analysis
-        volume1 = self.calculate_volume(mask1)
-        volume2 = self.calculate_volume(mask2)
-        volume_change = volume2 - volume1
-        volume_change_percent = (volume_change / volume1 * 100) if volume1 > 0 else 0
+        with profile_step("volume"):
+            volume1 = self.calculate_volume(mask1)
+            volume2 = self.calculate_volume(mask2)
+            volume_change = volume2 - volume1
+            volume_change_percent = (volume_change / volume1 * 100) if volume1 > 0 else 0
         
         # Intensity analysis
-        stats1 = self.calculate_intensity_statistics(image1, mask1)
-        stats2 = self.calculate_intensity_statistics(image2, mask2)
+        with profile_step("intensity"):
+            stats1 = self.calculate_intensity_statistics(image1, mask1)
+            stats2 = self.calculate_intensity_statistics(image2, mask2)
+        
+        sequence_results = None
+        if sequences:
+            with profile_step("sequences"):
+                sequence_stats1 = self.calculate_sequence_statistics(
+                    {name: pair[0] for name, pair in sequences.items()}, mask1
+                )
+                sequence_stats2 = self.calculate_sequence_statistics(
+                    {name: pair[1] for name, pair in sequences.items()}, mask2
+                )
+            sequence_results = {
+                name: {
+                    'tumor1': sequence_stats1[name],
+                    'tumor2': sequence_stats2[name],
+                    'mean_change': sequence_stats2[name]['mean'] - sequence_stats1[name]['mean'],
+                }
+                for name in sequences
+            }
+        
+        # Per-lesion first-order, shape and texture features
+        lesions1 = lesions2 = None
+        if radiomics:
+            with profile_step("radiomics"):
+                lesions1, lesions2 = self.calculate_lesion_features((image1, image2), (mask1, mask2))
         
         # Overlap analysis
-        dice_score = self.calculate_dice_coefficient(mask1, mask2)
+        with profile_step("overlap"):
+            dice_score = self.calculate_dice_coefficient(mask1, mask2)
+            
+            try:
+                hausdorff_dist = self.calculate_hausdorff_distance(mask1, mask2)
+            except:
+                hausdorff_dist = None
         
-        try:
-            hausdorff_dist = self.calculate_hausdorff_distance(mask1, mask2)
-        except:
-            hausdorff_dist = None
+        # Where the tumor grew or regressed; the map itself is saved for rendering
+        with profile_step("change_map"):
+            change_map, change_volumes = self.compute_change_map(mask1, mask2)
+            if change_map_path:
+                write_image(change_map, change_map_path, itk.Image[itk.UC, self.Dimension])
         
         analysis_results = {
             'tumor1': {
                 'volume_mm3': volume1,
-                'intensity_stats': stats1
+                'intensity_stats': stats1,
+                'lesions': lesions1
             },
             'tumor2': {
                 'volume_mm3': volume2,
-                'intensity_stats': stats2
+                'intensity_stats': stats2,
+                'lesions': lesions2
             },
             'comparison': {
                 'volume_change_mm3': volume_change,
                 'volume_change_percent': volume_change_percent,
                 'dice_coefficient': dice_score,
                 'hausdorff_distance_mm': hausdorff_dist,
+                'change_volumes_mm3': change_volumes,
                 'intensity_change': {
                     'mean_change': stats2['mean'] - stats1['mean'],
                     'std_change': stats2['std'] - stats1['std']
                 }
             }
         }
+        if sequence_results:
+            analysis_results['sequences'] = sequence_results
         
         return analysis_results
     
+    def volume_bounds(self, mask):
+        """Voxels of a mask and the standard deviation of their count.
+
+        Only boundary voxels (in the mask next to the background, or in the
+        background next to the mask) can be partly tumor. Their errors are
+        taken as independent, each of PARTIAL_VOLUME_STD voxels, so they add
+        in quadrature: the spread grows with the square root of the number
+        of boundary voxels. Returns the boolean array, that spread and the
+        voxel volume.
+        """
+        if not isinstance(mask, SparseMask):
+            mask = SparseMask.from_itk(mask)
+        array = mask.to_array() > 0
+        return array, self._count_std(array), mask.voxel_volume()
+    
+    def _count_std(self, array):
+        from scipy.ndimage import binary_dilation, binary_erosion, generate_binary_structure
+        
+        structure = generate_binary_structure(3, 1)
+        boundary = binary_dilation(array, structure) & ~binary_erosion(array, structure)
+        return PARTIAL_VOLUME_STD * float(np.sqrt(np.sum(boundary)))
+    
+    def _voxels_across(self, array):
+        # Diameter of the largest ball inside the mask, in voxels (0 when empty)
+        from scipy.ndimage import distance_transform_edt
+        
+        if not array.any():
+            return 0
+        return int(round(2 * float(distance_transform_edt(array).max()) - 1))
+    
+    def compare_preview(self, mask1, mask2):
+        """compare_tumors() for coarse masks on a shared grid, with error bounds.
+
+        Volumes, volume change and Dice come with a [low, high] range of
+        PREVIEW_BOUND_SIGMAS standard deviations of the partial-volume error
+        (see volume_bounds()), propagated to the change and the Dice to
+        first order. A change bound is None when the baseline volume may be
+        zero. Each tumor also gets ``voxels_across``, the diameter of the
+        largest ball inside its mask, in coarse voxels.
+        """
+        array1, std1, voxel_volume = self.volume_bounds(mask1)
+        array2, std2, _ = self.volume_bounds(mask2)
+        count1 = float(np.sum(array1))
+        count2 = float(np.sum(array2))
+        k = PREVIEW_BOUND_SIGMAS
+        
+        volume1 = count1 * voxel_volume
+        volume2 = count2 * voxel_volume
+        bounds1 = [max(0.0, count1 - k * std1) * voxel_volume, (count1 + k * std1) * voxel_volume]
+        bounds2 = [max(0.0, count2 - k * std2) * voxel_volume, (count2 + k * std2) * voxel_volume]
+        
+        if count1 - k * std1 > 0:
+            volume_change_percent = (count2 - count1) / count1 * 100
+            change_std = 100 * float(np.hypot(std2 / count1, count2 * std1 / count1 ** 2))
+            change_bounds = [max(-100.0, volume_change_percent - k * change_std),
+                             volume_change_percent + k * change_std]
+        else:
+            volume_change_percent = (count2 - count1) / count1 * 100 if count1 > 0 else 0
+            change_bounds = [None, None]
+        
+        total = count1 + count2
+        if total > 0:
+            intersection = array1 & array2
+            overlap = float(np.sum(intersection))
+            dice = 2.0 * overlap / total
+            # The overlap and the two volumes move with their own boundary voxels
+            dice_std = 2.0 * float(np.hypot(self._count_std(intersection) / total,
+                                            overlap * np.hypot(std1, std2) / total ** 2))
+            dice_bounds = [max(0.0, dice - k * dice_std), min(1.0, dice + k * dice_std)]
+        else:
+            dice, dice_bounds = 1.0, [1.0, 1.0]
+        
+        return {
+            'tumor1': {'volume_mm3': volume1, 'volume_bounds_mm3': bounds1,
+                       'voxels_across': self._voxels_across(array1)},
+            'tumor2': {'volume_mm3': volume2, 'volume_bounds_mm3': bounds2,
+                       'voxels_across': self._voxels_across(array2)},
+            'comparison': {
+                'volume_change_mm3': volume2 - volume1,
+                'volume_change_percent': volume_change_percent,
+                'volume_change_percent_bounds': change_bounds,
+                'dice_coefficient': dice,
+                'dice_bounds': dice_bounds,
+            }
+        }
+    
     def save_analysis_report(self, analysis_results, output_path):
         with open(output_path, 'w') as f:
             json.dump(analysis_results, f, indent=2)
@@ -154,9 +452,46 @@ class TumorAnalysis:
             if analysis_results['comparison']['hausdorff_distance_mm']:
                 f.write(f"Hausdorff Distance: {analysis_results['comparison']['hausdorff_distance_mm']:.2f} mm\n")
             
+            qa = analysis_results.get('registration_qa')
+            if qa:
+                f.write(f"Registration QA: NCC {qa['ncc']:.3f}, NMI {qa['normalized_mutual_information']:.3f}, "
+                        f"mask Dice {qa['mask_dice']:.3f}")
+                f.write(f" - SUSPECT ({', '.join(qa['reasons'])})\n" if qa['suspect'] else "\n")
+                if qa.get('retried'):
+                    for name in ('first', 'multistart'):
+                        attempt = qa['retry'][name]
+                        summary = f"NCC {attempt['ncc']:.3f}, mask Dice {attempt['mask_dice']:.3f}" if attempt else "failed"
+                        f.write(f"  {name.title()} attempt: {summary}\n")
+                    f.write(f"  Kept: {qa['retry']['kept']} registration\n")
+            
+            change_volumes = analysis_results['comparison'].get('change_volumes_mm3')
+            if change_volumes:
+                f.write(f"\nChange Map:\n")
+                for name in CHANGE_LABELS:
+                    f.write(f"  {name.title()}: {change_volumes[name]:.2f} mm³\n")
+            
+            for name, label in (('tumor1', 'Initial'), ('tumor2', 'Follow-up')):
+                lesions = analysis_results[name].get('lesions')
+                if lesions:
+                    largest = lesions[0]
+                    f.write(f"\n{label} Lesions: {len(lesions)} (largest {largest['shape']['volume_mm3']:.2f} mm³, "
+                            f"sphericity {largest['shape']['sphericity']:.2f}")
+                    if 'glcm' in largest:
+                        f.write(f", GLCM contrast {largest['glcm']['contrast']:.2f}, "
+                                f"entropy {largest['glcm']['joint_entropy']:.2f}")
+                    f.write(")\n")
+                    if 'native_centroid_mm' in largest:
+                        x, y, z = largest['native_centroid_mm']
+                        f.write(f"  Largest lesion centroid in {analysis_results[name]['native_space']} "
+                                f"scanner coordinates: ({x:.1f}, {y:.1f}, {z:.1f}) mm\n")
+            
             f.write(f"\nIntensity Changes:\n")
             f.write(f"  Mean intensity change: {analysis_results['comparison']['intensity_change']['mean_change']:.2f}\n")
             f.write(f"  Std intensity change: {analysis_results['comparison']['intensity_change']['std_change']:.2f}\n")
+            
+            for name, sequence in analysis_results.get('sequences', {}).items():
+                f.write(f"  {name} mean intensity: {sequence['tumor1']['mean']:.2f} -> "
+                        f"{sequence['tumor2']['mean']:.2f} ({sequence['mean_change']:+.2f})\n")
         
         return text_report_path
     
@@ -221,5 +556,34 @@ class TumorAnalysis:
             f.write("- **Segmentation**: Statistical outlier detection (3+ std dev)\n")
             f.write("- **Validation**: Size (20-2000 voxels), shape, and location filtering\n")
             f.write("- **Visualization**: Enhanced 3D rendering with interactive controls\n")
+            
+            profiling = analysis_results.get('profiling')
+            if profiling:
+                self.write_profiling_section(f, profiling)
         
         return report_path
+    
+    def write_profiling_section(self, f, profiling):
+        """Write per-stage timings as a markdown table"""
+        def fmt(value, scale=1.0, digits=2):
+            return f"{value / scale:.{digits}f}" if value is not None else "n/a"
+        
+        f.write(f"\n## Performance\n\n")
+        f.write(f"- **Total Wall Time**: {fmt(profiling['total_wall_time_s'])} s\n")
+        f.write(f"- **Total CPU Time**: {fmt(profiling['total_cpu_time_s'])} s\n")
+        f.write(f"- **Peak RSS**: {fmt(profiling['peak_rss_mb'], digits=1)} MB\n\n")
+        
+        f.write("| Stage | Wall (s) | CPU (s) | Peak RSS (MB) | Read (MB) | Written (MB) |\n")
+        f.write("|---|---:|---:|---:|---:|---:|\n")
+        for stage in profiling['stages']:
+            name = "&nbsp;&nbsp;" * stage['depth'] + stage['name'].split("/")[-1]
+            f.write(
+                f"| {name} | {fmt(stage['wall_time_s'], digits=3)} | {fmt(stage['cpu_time_s'], digits=3)} "
+                f"| {fmt(stage['peak_rss_mb'], digits=1)} | {fmt(stage['bytes_read'], 2**20)} "
+                f"| {fmt(stage['bytes_written'], 2**20)} |\n"
+            )
+        
+        if profiling.get('top_functions'):
+            f.write("\n### Top Functions (cProfile, cumulative)\n\n")
+            for entry in profiling['top_functions']:
+                f.write(f"- `{entry['function']}`: {entry['cumulative_time_s']:.3f} s ({entry['calls']} calls)\n")
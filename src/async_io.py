@@ -0,0 +1,249 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+
+# Images waiting to be written before write_image() blocks the caller
+WRITE_QUEUE_DEPTH = 4
+
+# Threads decoding prefetched volumes
+PREFETCH_WORKERS = 1
+
+# Block size when pulling files into the page cache
+WARM_BLOCK_BYTES = 8 * 2**20
+
+_active_io = None
+
+
+def active_io():
+    """The AsyncImageIO that read_image() and write_image() go through, if any"""
+    return _active_io
+
+
+def _key(path):
+    return str(Path(path).absolute())
+
+
+def _files(path):
+    path = Path(path)
+    if path.is_dir():
+        return sorted(p for p in path.rglob("*") if p.is_file())
+    return [path] if path.exists() else []
+
+
+def _fsync(path):
+    # Directories are synced too, so that new entries survive a crash
+    flags = (os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)) if Path(path).is_dir() else os.O_RDONLY
+    try:
+        fd = os.open(path, flags)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def warm_files(paths):
+    """Pull files (or chunked volume directories) into the OS page cache.
+
+    Useful across processes: the reader that comes next, e.g. the worker
+    running the next job, finds the bytes in memory instead of waiting on
+    network storage. Returns the number of bytes touched.
+    """
+    total = 0
+    for path in paths:
+        for file in _files(path):
+            try:
+                with open(file, 'rb', buffering=0) as f:
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    while True:
+                        block = f.read(WARM_BLOCK_BYTES)
+                        if not block:
+                            break
+                        total += len(block)
+            except OSError:
+                continue
+    return total
+
+
+class AsyncImageIO:
+    """Background reads and write-behind for the pipeline images.
+
+    While active, storage.read_image() and storage.write_image() go through
+    it. prefetch() decodes a volume on a background thread; each prefetch
+    serves the next read of that path with the same image type. write()
+    queues the image and returns, a writer thread encodes, writes and
+    fsyncs it; at most ``queue_depth`` images wait, after which write()
+    blocks. A read of a path with a pending write waits for that write.
+    flush() waits for every queued write, syncs the directories and raises
+    the first write error; deactivate() flushes.
+
+    Images handed to write() must not be modified afterwards.
+    """
+
+    def __init__(self, queue_depth=WRITE_QUEUE_DEPTH, prefetch_workers=PREFETCH_WORKERS):
+        self.stats = {
+            'prefetched': 0, 'prefetch_hits': 0, 'reads': 0,
+            'writes': 0, 'bytes_written': 0, 'write_wait_s': 0.0, 'flush_wait_s': 0.0,
+        }
+        self._lock = threading.Lock()
+        self._prefetched = {}
+        self._pending_writes = {}
+        self._written_dirs = set()
+        self._errors = []
+        self._readers = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="prefetch")
+        self._queue = queue.Queue(maxsize=max(1, queue_depth))
+        self._writer = threading.Thread(target=self._write_loop, name="write-behind", daemon=True)
+        self._writer.start()
+        self._closed = False
+
+    def _read(self, path, image_type):
+        from storage import read_image_file
+
+        self.wait_for_write(path)
+        return read_image_file(path, image_type)
+
+    def prefetch(self, path, image_type):
+        """Start decoding ``path`` in the background for the next read_image()"""
+        future = self._readers.submit(self._read, Path(path).absolute(), image_type)
+        with self._lock:
+            self._prefetched.setdefault((_key(path), str(image_type)), []).append(future)
+            self.stats['prefetched'] += 1
+        return future
+
+    def warm(self, paths):
+        """Pull files into the page cache in the background (see warm_files)"""
+        return self._readers.submit(warm_files, [Path(p) for p in paths])
+
+    def read(self, path, image_type):
+        with self._lock:
+            self.stats['reads'] += 1
+            futures = self._prefetched.get((_key(path), str(image_type)))
+            future = futures.pop(0) if futures else None
+            if future is not None:
+                self.stats['prefetch_hits'] += 1
+        if future is not None:
+            try:
+                return future.result()
+            except Exception as e:
+                print(f"Warning: prefetch of {path} failed ({e}), reading again")
+        return self._read(path, image_type)
+
+    def write(self, image, path, image_type, **chunk_options):
+        if self._closed:
+            raise RuntimeError("AsyncImageIO is closed")
+        if getattr(image, 'GetSource', None) is not None and image.GetSource() is not None:
+            # Detach from the filter that produced it: the caller may run the
+            # pipeline again while the writer thread reads the image
+            import itk
+
+            duplicator = itk.ImageDuplicator[image_type].New()
+            duplicator.SetInputImage(image)
+            duplicator.Update()
+            image = duplicator.GetOutput()
+
+        future = Future()
+        with self._lock:
+            self._pending_writes[_key(path)] = future
+        start = time.perf_counter()
+        # Resolved now: the working directory the caller meant is the current one
+        self._queue.put((image, Path(path).absolute(), image_type, chunk_options, future))
+        with self._lock:
+            self.stats['write_wait_s'] += time.perf_counter() - start
+        return future
+
+    def _write_loop(self):
+        from storage import write_image_file
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            image, path, image_type, chunk_options, future = item
+            try:
+                write_image_file(image, path, image_type, **chunk_options)
+                written = _files(path)
+                for file in written:
+                    _fsync(file)
+                with self._lock:
+                    self.stats['writes'] += 1
+                    self.stats['bytes_written'] += sum(f.stat().st_size for f in written)
+                    self._written_dirs.add(path.parent)
+                    if path.is_dir():
+                        self._written_dirs.add(path)
+                future.set_result(path)
+            except Exception as e:
+                with self._lock:
+                    self._errors.append((path, e))
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    if self._pending_writes.get(_key(path)) is future:
+                        del self._pending_writes[_key(path)]
+                del image
+                self._queue.task_done()
+
+    def wait_for_write(self, path):
+        """Block until a queued write of ``path`` is on disk (no-op otherwise)"""
+        with self._lock:
+            future = self._pending_writes.get(_key(path))
+        if future is not None:
+            future.result()
+
+    def flush(self):
+        """Wait for the queued writes, fsync their directories and raise the first error"""
+        start = time.perf_counter()
+        self._queue.join()
+        with self._lock:
+            directories, self._written_dirs = self._written_dirs, set()
+            errors, self._errors = self._errors, []
+        for directory in sorted(directories):
+            _fsync(directory)
+        self.stats['flush_wait_s'] += time.perf_counter() - start
+        if errors:
+            path, error = errors[0]
+            raise IOError(f"Write-behind of {path} failed ({len(errors)} failed writes): {error}") from error
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._queue.put(None)
+            self._writer.join()
+            self._readers.shutdown(wait=False, cancel_futures=True)
+            with self._lock:
+                self._prefetched.clear()
+
+    def summary(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def activate(self):
+        global _active_io
+        _active_io = self
+        return self
+
+    def deactivate(self):
+        """Stop routing storage calls here, then flush and close"""
+        global _active_io
+        if _active_io is self:
+            _active_io = None
+        self.close()
+
+    def __enter__(self):
+        return self.activate()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.deactivate()
+        return False
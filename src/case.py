@@ -0,0 +1,185 @@
+import json
+import time
+from pathlib import Path
+
+
+# Parameters of a Case, with their defaults
+DEFAULT_PARAMETERS = {
+    'multistart': False,            # registration from several starts (see register_multistart)
+    'smoothing_sigma': None,        # segmentation smoothing in voxels (None: TumorSegmentation default)
+    'recompute_brain_mask': False,  # skull strip the follow-up instead of reusing the baseline masks
+    'tumor_parameters': {},         # overrides of DEFAULT_TUMOR_PARAMETERS
+    'radiomics': True,              # per-lesion features in the analysis
+    'triangle_budget': None,        # triangles per tumor mesh (None: mesh_export default)
+}
+
+# Results of a Case: the parameters each one reads and the results it is computed from
+STEPS = {
+    'image1': ((), ()),
+    'image2': ((), ()),
+    'registration': (('multistart',), ('image1', 'image2')),
+    'registration_qa': ((), ('image1', 'registration')),
+    'baseline_state': (('smoothing_sigma',), ('image1',)),
+    'followup_state': (('smoothing_sigma', 'recompute_brain_mask'), ('registration', 'baseline_state')),
+    'mask1': (('tumor_parameters',), ('baseline_state',)),
+    'mask2': (('tumor_parameters',), ('followup_state',)),
+    'analysis': (('radiomics',), ('image1', 'registration', 'mask1', 'mask2')),
+    'meshes': (('triangle_budget',), ('mask1', 'mask2')),
+}
+
+
+def _result(step, index=None):
+    def get(self):
+        value = self.get(step)
+        return value if index is None else value[index]
+    return property(get, doc=f"Result of the '{step}' step, computed on first use")
+
+
+class Case:
+    """A baseline / follow-up pair whose results are computed on first use and kept.
+
+    For notebooks and scripts: reading ``registered_image``, ``mask1``,
+    ``analysis``, ``meshes``, ... runs the step that produces it (see
+    STEPS), and the steps it needs, once; later reads return the kept
+    result. A result is keyed by the parameters its step reads and the keys
+    of the results it uses, so set() only recomputes what depends on the
+    changed parameters: ``set(tumor_parameters={'std_factor': 2.5})``
+    re-runs the tumor detection, the analysis and the meshes, not the
+    registration or the skull stripping. Everything stays in memory, nothing is written to disk.
+    """
+
+    image1 = _result('image1')
+    image2 = _result('image2')
+    registered_image = _result('registration', 0)
+    transform = _result('registration', 1)
+    registration_qa = _result('registration_qa')
+    baseline_state = _result('baseline_state')
+    followup_state = _result('followup_state')
+    mask1 = _result('mask1')
+    mask2 = _result('mask2')
+    analysis = _result('analysis')
+    meshes = _result('meshes')
+
+    def __init__(self, image1_path, image2_path, workers=None, **parameters):
+        self.image1_path = Path(image1_path)
+        self.image2_path = Path(image2_path)
+        # Threads for registration starts, smoothing and morphology (None = one per CPU)
+        self.workers = workers
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        # Seconds taken by the last computation of each step
+        self.timings = {}
+        self._results = {}
+        self.set(**parameters)
+
+    def set(self, **parameters):
+        """Change parameters; the results that depend on them are recomputed on next use"""
+        for name, value in parameters.items():
+            if name not in DEFAULT_PARAMETERS:
+                raise KeyError(f"Unknown parameter {name}, expected one of: {', '.join(DEFAULT_PARAMETERS)}")
+            self.parameters[name] = value
+        return self
+
+    def key(self, step):
+        parameter_names, dependencies = STEPS[step]
+        parameters = json.dumps([self.parameters[name] for name in parameter_names], sort_keys=True, default=str)
+        return (parameters, tuple(self.key(dependency) for dependency in dependencies))
+
+    def is_computed(self, step):
+        result = self._results.get(step)
+        return result is not None and result[0] == self.key(step)
+
+    def computed(self):
+        """Steps whose kept result is up to date with the parameters"""
+        return [step for step in STEPS if self.is_computed(step)]
+
+    def get(self, step):
+        key = self.key(step)
+        result = self._results.get(step)
+        if result is not None and result[0] == key:
+            return result[1]
+        # Dependencies first, so that the timing is this step's own
+        for dependency in STEPS[step][1]:
+            self.get(dependency)
+        start = time.perf_counter()
+        value = getattr(self, f"_compute_{step}")()
+        self.timings[step] = time.perf_counter() - start
+        self._results[step] = (key, value)
+        return value
+
+    def invalidate(self, *steps):
+        """Drop kept results (all by default), e.g. after the image files changed"""
+        for step in steps or list(self._results):
+            self._results.pop(step, None)
+
+    def _segmenter(self):
+        from segmentation import TumorSegmentation
+
+        return TumorSegmentation(workers=self.workers, smoothing_sigma=self.parameters['smoothing_sigma'])
+
+    def _compute_image1(self):
+        return self._segmenter().load_image(self.image1_path)
+
+    def _compute_image2(self):
+        return self._segmenter().load_image(self.image2_path)
+
+    def _compute_registration(self):
+        from registration import ImageRegistration
+
+        registrator = ImageRegistration()
+        if self.parameters['multistart']:
+            # The start workers read the images themselves
+            registered_image, transform = registrator.register_multistart(
+                self.image1_path, self.image2_path, workers=self.workers
+            )
+        else:
+            registered_image, transform = registrator.register_images(self.image1, self.image2)
+        if transform is None:
+            print("Warning: registration failed, using the original follow-up image")
+            return self.image2, None
+        return registered_image, transform
+
+    def _compute_registration_qa(self):
+        from registration import ImageRegistration
+
+        if self.transform is None:
+            return None
+        return ImageRegistration().assess_registration(self.image1, self.registered_image)
+
+    def _compute_baseline_state(self):
+        return self._segmenter().prepare_segmentation(self.image1)
+
+    def _compute_followup_state(self):
+        brain_masks = None
+        if self.transform is not None and not self.parameters['recompute_brain_mask']:
+            # The registered scan lies in baseline space: no second skull stripping
+            state = self.baseline_state
+            brain_masks = {'brain_mask': state['brain_mask'], 'inner_brain_mask': state['inner_brain_mask']}
+        return self._segmenter().prepare_segmentation(self.registered_image, brain_masks, refine_brain_mask=True)
+
+    def _compute_mask1(self):
+        return self._segmenter().segment_prepared(
+            self.baseline_state, sparse=True, parameters=self.parameters['tumor_parameters']
+        )
+
+    def _compute_mask2(self):
+        return self._segmenter().segment_prepared(
+            self.followup_state, sparse=True, parameters=self.parameters['tumor_parameters']
+        )
+
+    def _compute_analysis(self):
+        from analysis import TumorAnalysis
+
+        return TumorAnalysis().compare_tumors(
+            self.image1, self.mask1, self.registered_image, self.mask2, radiomics=self.parameters['radiomics']
+        )
+
+    def _compute_meshes(self):
+        """Decimated tumor surfaces (vtkPolyData) by timepoint, as written by mesh_export"""
+        from mesh_export import DEFAULT_TRIANGLE_BUDGET, decimate
+        from visualization import tumor_surface
+
+        triangle_budget = self.parameters['triangle_budget'] or DEFAULT_TRIANGLE_BUDGET
+        return {
+            timepoint: decimate(tumor_surface(mask), triangle_budget)
+            for timepoint, mask in (('scan1', self.mask1), ('scan2', self.mask2))
+        }
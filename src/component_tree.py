@@ -0,0 +1,163 @@
+import numpy as np
+
+
+class ComponentTree:
+    """Max-tree of the connected components of ``values > t`` inside a mask.
+
+    Built once by adding voxels in decreasing intensity order with a
+    union-find (face connectivity, as scipy.ndimage.label). Every added
+    voxel creates one node: the component containing it right after it was
+    added. Node ``i`` therefore holds the voxels ``0..i`` (in sorted order)
+    connected to voxel ``i``, and its parent is the node that absorbs it
+    later. The components at any threshold ``t >= min_threshold`` are the
+    nodes added while ``value > t`` whose parent was added after, so
+    thresholding, area, bounding box and centroid queries need no label().
+
+    Coordinates are voxel indices in (z, y, x) order, shifted by ``offset``
+    when the arrays are a crop of a larger volume.
+    """
+
+    def __init__(self, values, mask, min_threshold, offset=(0, 0, 0)):
+        self.min_threshold = float(min_threshold)
+        self.shape = values.shape
+        self.offset = np.asarray(offset, dtype=np.int64)
+
+        candidates = np.flatnonzero(mask & (values > min_threshold))
+        order = np.argsort(-values.ravel()[candidates], kind='stable')
+        self.voxels = candidates[order]
+        self.values = values.ravel()[self.voxels]
+        self.coords = np.array(np.unravel_index(self.voxels, self.shape)).T
+
+        self._build(self._neighbour_steps())
+        self._build_ancestor_table()
+
+    def __len__(self):
+        return len(self.voxels)
+
+    def _neighbour_steps(self):
+        """(N, 6) insertion step of each face neighbour, -1 outside the tree"""
+        step_of = np.full(int(np.prod(self.shape)), -1, dtype=np.int64)
+        step_of[self.voxels] = np.arange(len(self.voxels))
+
+        neighbours = np.full((len(self.voxels), 6), -1, dtype=np.int64)
+        strides = np.array([self.shape[1] * self.shape[2], self.shape[2], 1])
+        for axis in range(3):
+            for column, delta in ((2 * axis, -1), (2 * axis + 1, 1)):
+                moved = self.coords[:, axis] + delta
+                valid = (moved >= 0) & (moved < self.shape[axis])
+                neighbours[valid, column] = step_of[self.voxels[valid] + delta * strides[axis]]
+        return neighbours
+
+    def _build(self, neighbours):
+        count = len(self.voxels)
+        parent = [-1] * count
+        union = list(range(count))
+        area = [1] * count
+        low = self.coords.tolist()
+        high = self.coords.tolist()
+        sums = self.coords.tolist()
+
+        def find(node):
+            while union[node] != node:
+                union[node] = union[union[node]]
+                node = union[node]
+            return node
+
+        for i, row in enumerate(neighbours.tolist()):
+            node_low, node_high, node_sum = low[i], high[i], sums[i]
+            for j in row:
+                if j < 0 or j > i:
+                    continue
+                root = find(j)
+                if root == i:
+                    continue
+                # The union-find root is always the newest node of its component
+                union[root] = i
+                parent[root] = i
+                area[i] += area[root]
+                node_low = [min(a, b) for a, b in zip(node_low, low[root])]
+                node_high = [max(a, b) for a, b in zip(node_high, high[root])]
+                node_sum = [a + b for a, b in zip(node_sum, sums[root])]
+            low[i], high[i], sums[i] = node_low, node_high, node_sum
+
+        self.parent = np.array(parent, dtype=np.int64)
+        self.area = np.array(area, dtype=np.int64)
+        self.bbox_low = np.array(low, dtype=np.int64).reshape(-1, 3)
+        self.bbox_high = np.array(high, dtype=np.int64).reshape(-1, 3)
+        self.coord_sums = np.array(sums, dtype=np.int64).reshape(-1, 3)
+
+    def _build_ancestor_table(self):
+        """Binary lifting: row m holds each node's 2^m-th ancestor (roots map to themselves)"""
+        count = len(self.voxels)
+        up = np.where(self.parent >= 0, self.parent, np.arange(count))
+        table = [up]
+        for _ in range(max(1, int(count).bit_length())):
+            up = up[up]
+            table.append(up)
+        self._ancestors = table
+
+    def _check_threshold(self, threshold):
+        if threshold < self.min_threshold:
+            raise ValueError(
+                f"Threshold {threshold:.1f} is below the tree minimum {self.min_threshold:.1f}"
+            )
+
+    def count_above(self, threshold):
+        """Number of voxels with value > threshold (the first nodes in insertion order)"""
+        self._check_threshold(threshold)
+        # Same comparison as label(values > threshold); the values are sorted
+        return int(np.count_nonzero(self.values > threshold))
+
+    def components(self, threshold):
+        """Node indices of the connected components of ``values > threshold``"""
+        k = self.count_above(threshold)
+        parent = self.parent[:k]
+        return np.flatnonzero((parent < 0) | (parent >= k))
+
+    def bbox_ranges(self, nodes):
+        return self.bbox_high[nodes] - self.bbox_low[nodes] + 1
+
+    def centroids(self, nodes):
+        """Component centres in the coordinates of the full volume"""
+        area = self.area[nodes][:, None]
+        return (self.coord_sums[nodes] + area * self.offset) / area
+
+    def select(self, threshold, min_size=0, max_size=None, min_aspect_ratio=0.0,
+               min_compactness=0.0, center=None, max_distance=None):
+        """Components at threshold that pass the size, shape and location filters"""
+        nodes = self.components(threshold)
+        area = self.area[nodes]
+        keep = area >= min_size
+        if max_size is not None:
+            keep &= area <= max_size
+
+        ranges = self.bbox_ranges(nodes)
+        keep &= ranges.min(axis=1) / ranges.max(axis=1) >= min_aspect_ratio
+        keep &= area / np.prod(ranges, axis=1) >= min_compactness
+
+        if center is not None and max_distance is not None:
+            offsets = self.centroids(nodes) - np.asarray(center)
+            distance = np.sqrt(offsets[:, 0]**2 + offsets[:, 1]**2 + offsets[:, 2]**2)
+            keep &= distance <= max_distance
+        return nodes[keep]
+
+    def component_of(self, threshold):
+        """Node of the component each of the first count_above(threshold) voxels belongs to"""
+        k = self.count_above(threshold)
+        nodes = np.arange(k)
+        for up in reversed(self._ancestors):
+            # Ancestors have increasing indices, so the jumps that stay below k are safe
+            jumped = up[nodes]
+            nodes = np.where(jumped < k, jumped, nodes)
+        return nodes
+
+    def mask(self, threshold, nodes=None):
+        """Boolean mask (shape of the tree arrays) of the given components, or all of them"""
+        result = np.zeros(self.shape, dtype=bool)
+        k = self.count_above(threshold)
+        if nodes is None:
+            selected = self.voxels[:k]
+        else:
+            selected = self.voxels[:k][np.isin(self.component_of(threshold), nodes)]
+        result.ravel()[selected] = True
+        return result
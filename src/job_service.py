@@ -0,0 +1,457 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import multiprocessing
+
+from async_io import AsyncImageIO, warm_files
+
+
+DEFAULT_SOCKET_PATH = Path("results") / "vitk_service.sock"
+
+# Stages a job can run; visualization renders offscreen in the worker
+JOB_STAGES = ["registration", "segmentation", "analysis", "visualization"]
+
+# Jobs waiting for a worker before submissions are refused
+DEFAULT_QUEUE_LIMIT = 64
+
+# Finished jobs are added to the results store together, this long after the first
+STORE_BATCH_DELAY_S = 1.0
+
+# Set in each worker by _warm_worker: start_workers' probes wait on it for all workers
+_warm_barrier = None
+
+
+def _warm_worker(barrier=None):
+    """Process initializer: import the pipeline and instantiate its ITK templates once"""
+    global _warm_barrier
+    _warm_barrier = barrier
+
+    import itk
+    from registration import ImageRegistration
+    from segmentation import TumorSegmentation
+    from analysis import TumorAnalysis
+
+    image_type = ImageRegistration().ImageType
+    mask_type = itk.Image[itk.UC, 3]
+    TumorSegmentation()
+    TumorAnalysis()
+    # Template access is what costs seconds on first use, not the import
+    for image in (image_type, mask_type):
+        itk.ImageFileReader[image].New()
+        itk.ImageFileWriter[image].New()
+    itk.ImageRegistrationMethodv4[image_type, image_type].New()
+    itk.MattesMutualInformationImageToImageMetricv4[image_type, image_type].New()
+    itk.ResampleImageFilter[image_type, image_type].New()
+    itk.VersorRigid3DTransform[itk.D].New()
+
+
+def _worker_info():
+    # A probe holds its worker until every worker is warm, so each probe lands on a different one
+    if _warm_barrier is not None:
+        _warm_barrier.wait()
+    return os.getpid()
+
+
+def run_case(job):
+    """Run the pipeline stages of one job and return the compare_tumors results.
+
+    Runs in a worker process. Outputs are written to job['output_dir'] with
+    the names main.py uses; stages left out reuse the outputs already there.
+    """
+    from storage import resolve_result_path
+    from profiling import PipelineProfiler
+    from transforms import TransformService
+
+    image1_path = Path(job['image1'])
+    image2_path = Path(job['image2'])
+    output_dir = Path(job['output_dir'])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stages = job.get('stages') or JOB_STAGES[:3]
+
+    volume_suffix = ".vol" if job.get('storage') == "chunked" else ".nrrd"
+    mask_suffix = ".npz" if job.get('sparse_masks') else volume_suffix
+    registered_stem = f"registered_{image2_path.stem}"
+    registered_path = output_dir / f"{registered_stem}{volume_suffix}"
+    tumor1_mask_path = output_dir / f"tumor_mask_scan1{mask_suffix}"
+    tumor2_mask_path = output_dir / f"tumor_mask_scan2{mask_suffix}"
+    analysis_report_path = output_dir / "tumor_analysis.json"
+    change_map_path = output_dir / "tumor_change_map.nrrd"
+    transforms = TransformService(output_dir / "transforms")
+    patient = job.get('patient') or image1_path.stem.split("_")[0]
+
+    # Reads are prefetched and writes go behind the computation, flushed at the end
+    io = AsyncImageIO().activate()
+    profiler = PipelineProfiler().activate()
+    try:
+        registered = False
+        registration_qa = None
+        if "registration" in stages:
+            from registration import ImageRegistration
+
+            with profiler.stage("registration"):
+                registrator = ImageRegistration()
+                io.prefetch(image2_path, registrator.ImageType)
+                registered_image, transform = registrator.register_images(image1_path, image2_path, registered_path)
+                if transform:
+                    registrator.save_transform(transform, output_dir / "registration_transform.tfm")
+                    transforms.add(patient, image1_path.stem, image2_path.stem, transform,
+                                   source="registration_transform.tfm")
+                    registered = True
+                    registration_qa = registrator.assess_registration(image1_path, registered_image)
+                else:
+                    registered_path = image2_path
+        else:
+            previous = resolve_result_path(output_dir, registered_stem)
+            registered = previous.exists()
+            registered_path = previous if registered else image2_path
+
+        tumor_masks = None
+        if "segmentation" in stages:
+            from segmentation import TumorSegmentation
+
+            segmenter = TumorSegmentation(workers=job.get('workers'))
+            io.prefetch(registered_path, segmenter.ImageType)
+            with profiler.stage("segmentation_scan1"):
+                tumor1_mask, brain_masks = segmenter.segment_tumor_automatic(
+                    image1_path, tumor1_mask_path, sparse=job.get('sparse_masks', False),
+                    return_brain_masks=True
+                )
+            if not registered or job.get('recompute_brain_mask'):
+                brain_masks = None
+            with profiler.stage("segmentation_scan2"):
+                tumor2_mask = segmenter.segment_tumor_automatic(
+                    registered_path, tumor2_mask_path, sparse=job.get('sparse_masks', False),
+                    brain_masks=brain_masks, refine_brain_mask=True
+                )
+            tumor_masks = (tumor1_mask, tumor2_mask)
+        else:
+            tumor1_mask_path = resolve_result_path(output_dir, "tumor_mask_scan1")
+            tumor2_mask_path = resolve_result_path(output_dir, "tumor_mask_scan2")
+
+        if "analysis" in stages:
+            from analysis import TumorAnalysis
+
+            analyzer = TumorAnalysis()
+            with profiler.stage("analysis"):
+                results = analyzer.compare_tumors(
+                    image1_path, tumor1_mask_path, registered_path, tumor2_mask_path,
+                    change_map_path=change_map_path
+                )
+                if registered and registration_qa is None:
+                    from registration import ImageRegistration
+
+                    registration_qa = ImageRegistration().assess_registration(image1_path, registered_path)
+                results['registration_qa'] = registration_qa
+                if registered:
+                    transforms.add_native_coordinates(results, patient, image1_path.stem, image2_path.stem)
+        elif analysis_report_path.exists():
+            with open(analysis_report_path, 'r') as f:
+                results = json.load(f)
+        else:
+            raise FileNotFoundError(f"No analysis results in {output_dir}: include the analysis stage")
+
+        if "visualization" in stages:
+            from visualization import TumorVisualization
+
+            with profiler.stage("visualization"):
+                io.wait_for_write(change_map_path)
+                visualizer = TumorVisualization(offscreen=True)
+                # Masks segmented by this job are rendered from memory
+                visualizer.visualize_tumor_evolution(
+                    image1_path, *(tumor_masks or (tumor1_mask_path, tumor2_mask_path)), results,
+                    change_map=change_map_path if change_map_path.exists() else None
+                )
+                visualizer.save_screenshot(output_dir / "tumor_evolution_3d.png")
+
+        # The job is reported done only once its outputs are on disk
+        with profiler.stage("flush"):
+            io.flush()
+    finally:
+        io.deactivate()
+        profiler.deactivate()
+
+    if "analysis" in stages:
+        from segmentation import DEFAULT_TUMOR_PARAMETERS
+
+        results['profiling'] = profiler.summary()
+        results['profiling']['io'] = io.summary()
+        results['parameters'] = {
+            'tumor': DEFAULT_TUMOR_PARAMETERS,
+            'recompute_brain_mask': bool(job.get('recompute_brain_mask')),
+            'streaming': False,
+        }
+        analyzer.save_analysis_report(results, analysis_report_path)
+    return results
+
+
+class JobService:
+    """Long-lived pipeline service: a JSON-lines protocol over a Unix socket.
+
+    Jobs run in a pool of pre-warmed worker processes (ITK imported and its
+    templates instantiated once per process), at most ``max_jobs`` at a time;
+    further jobs wait in a queue of at most ``queue_limit``. Each request is
+    one JSON object per line with an ``action``:
+
+    - ``submit``: image1, image2, output_dir and optional patient, stages,
+      storage, sparse_masks, workers, recompute_brain_mask; returns the job id
+    - ``status``: job_id; returns the job state without its results
+    - ``result``: job_id; returns the state plus the compare_tumors results
+    - ``list``, ``stats`` and ``shutdown``
+
+    Every response has ``ok`` and, when it is false, an ``error`` message.
+    With ``results_store`` (a ResultsStore path), the results of finished
+    jobs are added to it in batches, one transaction per batch. When a job
+    starts, the input files of the next queued job are read into the page
+    cache, so that its worker does not wait on storage.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, max_jobs=None,
+                 queue_limit=DEFAULT_QUEUE_LIMIT, threads_per_job=None, results_store=None):
+        self.socket_path = Path(socket_path)
+        self.max_jobs = max(1, int(max_jobs or 1))
+        self.queue_limit = queue_limit
+        # Worker processes share the CPUs, so each job gets a share of the threads
+        self.threads_per_job = threads_per_job or max(1, (os.cpu_count() or 1) // self.max_jobs)
+        self.jobs = {}
+        self.results = {}
+        self.warm_up_time = None
+        self.warmed_bytes = 0
+        self.results_store = Path(results_store) if results_store else None
+        self._pending_records = []
+        self._pool = None
+        self._slots = None
+        self._stopped = None
+
+    def start_workers(self):
+        """Start the worker processes and wait until all of them are warm"""
+        start = time.perf_counter()
+        context = multiprocessing.get_context("spawn")
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.max_jobs, initializer=_warm_worker,
+            initargs=(context.Barrier(self.max_jobs),), mp_context=context
+        )
+        # Submitting while no worker is idle starts a new one, up to max_jobs
+        futures = [self._pool.submit(_worker_info) for _ in range(self.max_jobs)]
+        pids = {future.result() for future in futures}
+        self.warm_up_time = time.perf_counter() - start
+        return sorted(pids)
+
+    def _queued_count(self):
+        return sum(1 for job in self.jobs.values() if job['status'] == 'queued')
+
+    def submit(self, message):
+        missing = [key for key in ('image1', 'image2', 'output_dir') if not message.get(key)]
+        if missing:
+            raise ValueError(f"Missing job fields: {', '.join(missing)}")
+        for key in ('image1', 'image2'):
+            if not Path(message[key]).exists():
+                raise FileNotFoundError(f"{key} not found: {message[key]}")
+        stages = message.get('stages') or JOB_STAGES[:3]
+        unknown = [stage for stage in stages if stage not in JOB_STAGES]
+        if unknown:
+            raise ValueError(f"Unknown stages: {', '.join(unknown)}")
+        if self._queued_count() >= self.queue_limit:
+            raise RuntimeError(f"Job queue is full ({self.queue_limit} jobs waiting)")
+
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            'job_id': job_id,
+            'status': 'queued',
+            'image1': str(message['image1']),
+            'image2': str(message['image2']),
+            'output_dir': str(message['output_dir']),
+            # Case files are named <patient>_<timepoint> unless told otherwise
+            'patient': message.get('patient') or Path(message['image1']).stem.split("_")[0],
+            'stages': list(stages),
+            'storage': message.get('storage', 'nrrd'),
+            'sparse_masks': bool(message.get('sparse_masks', False)),
+            'workers': message.get('workers') or self.threads_per_job,
+            'recompute_brain_mask': bool(message.get('recompute_brain_mask', False)),
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'error': None,
+        }
+        self.jobs[job_id] = job
+        asyncio.get_running_loop().create_task(self._run(job))
+        return job_id
+
+    def _next_queued(self):
+        queued = [job for job in self.jobs.values() if job['status'] == 'queued']
+        return min(queued, key=lambda job: job['submitted']) if queued else None
+
+    async def _warm_next(self):
+        # Pull the next case into the page cache while this one computes
+        job = self._next_queued()
+        if job is None:
+            return
+        loop = asyncio.get_running_loop()
+        self.warmed_bytes += await loop.run_in_executor(None, warm_files, [job['image1'], job['image2']])
+
+    async def _run(self, job):
+        async with self._slots:
+            job['status'] = 'running'
+            job['started'] = time.time()
+            loop = asyncio.get_running_loop()
+            loop.create_task(self._warm_next())
+            try:
+                self.results[job['job_id']] = await loop.run_in_executor(self._pool, run_case, dict(job))
+                job['status'] = 'done'
+                self._store_results(job)
+            except Exception as e:
+                job['status'] = 'failed'
+                job['error'] = f"{type(e).__name__}: {e}"
+                print(f"Job {job['job_id']} failed:\n{traceback.format_exc()}")
+            job['finished'] = time.time()
+
+    def _store_results(self, job):
+        if self.results_store is None or "analysis" not in job['stages']:
+            return
+        from results_store import ResultsStore
+
+        self._pending_records.append(ResultsStore.record(
+            job['patient'], Path(job['image1']).stem, Path(job['image2']).stem,
+            self.results[job['job_id']]
+        ))
+        # The first finished job of a batch schedules the insert
+        if len(self._pending_records) == 1:
+            asyncio.get_running_loop().call_later(STORE_BATCH_DELAY_S, self._flush_results)
+
+    def _flush_results(self):
+        records, self._pending_records = self._pending_records, []
+        if not records:
+            return
+        from results_store import ResultsStore
+
+        try:
+            with ResultsStore(self.results_store) as store:
+                store.add_many(records)
+        except Exception:
+            print(f"Could not add {len(records)} results to {self.results_store}:\n{traceback.format_exc()}")
+
+    def _job(self, message):
+        job = self.jobs.get(message.get('job_id'))
+        if job is None:
+            raise KeyError(f"Unknown job: {message.get('job_id')}")
+        return job
+
+    def handle(self, message):
+        """Response dict for one request"""
+        action = message.get('action')
+        if action == 'submit':
+            return {'ok': True, 'job_id': self.submit(message)}
+        if action == 'status':
+            return {'ok': True, 'job': self._job(message)}
+        if action == 'result':
+            job = self._job(message)
+            return {'ok': True, 'job': job, 'results': self.results.get(job['job_id'])}
+        if action == 'list':
+            return {'ok': True, 'jobs': list(self.jobs.values())}
+        if action == 'stats':
+            counts = {}
+            for job in self.jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return {'ok': True, 'max_jobs': self.max_jobs, 'queue_limit': self.queue_limit,
+                    'warm_up_time_s': self.warm_up_time, 'jobs': counts,
+                    'warmed_bytes': self.warmed_bytes,
+                    'results_store': str(self.results_store) if self.results_store else None}
+        if action == 'shutdown':
+            self._stopped.set()
+            return {'ok': True}
+        raise ValueError(f"Unknown action: {action}")
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = self.handle(json.loads(line))
+                except Exception as e:
+                    response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """Serve requests until a shutdown request; workers must be started first"""
+        if self._pool is None:
+            self.start_workers()
+        self._slots = asyncio.Semaphore(self.max_jobs)
+        self._stopped = asyncio.Event()
+
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        server = await asyncio.start_unix_server(self._handle_connection, path=str(self.socket_path))
+        print(f"Serving on {self.socket_path} ({self.max_jobs} workers, "
+              f"warm-up {self.warm_up_time:.1f} s)")
+        try:
+            async with server:
+                await self._stopped.wait()
+        finally:
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+            self._flush_results()
+            # Running jobs are cancelled with the pool
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
+class ServiceClient:
+    """Blocking client for JobService, one connection per request"""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, timeout=30.0):
+        self.socket_path = Path(socket_path)
+        self.timeout = timeout
+
+    def request(self, message):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(self.timeout)
+            try:
+                connection.connect(str(self.socket_path))
+            except (FileNotFoundError, ConnectionRefusedError):
+                raise ConnectionError(f"No service listening on {self.socket_path}") from None
+            connection.sendall((json.dumps(message) + "\n").encode())
+            with connection.makefile('r') as stream:
+                response = json.loads(stream.readline())
+        if not response.get('ok'):
+            raise RuntimeError(response.get('error'))
+        return response
+
+    def submit(self, image1, image2, output_dir, **options):
+        message = dict(options, action='submit', image1=str(image1), image2=str(image2),
+                       output_dir=str(output_dir))
+        return self.request(message)['job_id']
+
+    def status(self, job_id):
+        return self.request({'action': 'status', 'job_id': job_id})['job']
+
+    def result(self, job_id):
+        return self.request({'action': 'result', 'job_id': job_id})['results']
+
+    def wait(self, job_id, poll_interval=0.5, timeout=None):
+        """Poll until the job is done and return its results"""
+        start = time.monotonic()
+        while True:
+            job = self.status(job_id)
+            if job['status'] == 'done':
+                return self.result(job_id)
+            if job['status'] == 'failed':
+                raise RuntimeError(f"Job {job_id} failed: {job['error']}")
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f"Job {job_id} still {job['status']} after {timeout} s")
+            time.sleep(poll_interval)
+
+    def shutdown(self):
+        return self.request({'action': 'shutdown'})
@@ -0,0 +1,295 @@
+import json
+import struct
+import time
+from pathlib import Path
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from profiling import profile_step
+
+
+# Triangles kept per tumor surface after decimation
+DEFAULT_TRIANGLE_BUDGET = 5000
+
+# Vertex positions are quantized to this many bits per axis over the mesh bounds
+# (at most 16: glTF stores them as unsigned shorts)
+POSITION_BITS = 16
+
+# Surface colors (RGB), as in the 3D scene: baseline red, follow-up green
+TIMEPOINT_COLORS = {'scan1': (1.0, 0.2, 0.2), 'scan2': (0.2, 1.0, 0.2)}
+
+# glTF constants
+_GLB_MAGIC = 0x46546C67
+_CHUNK_JSON = 0x4E4F534A
+_CHUNK_BIN = 0x004E4942
+_BYTE, _UNSIGNED_SHORT, _UNSIGNED_INT = 5120, 5123, 5125
+_ARRAY_BUFFER, _ELEMENT_ARRAY_BUFFER = 34962, 34963
+
+
+def decimate(surface, triangle_budget=DEFAULT_TRIANGLE_BUDGET):
+    """Quadric decimation of a triangle mesh down to about ``triangle_budget`` triangles"""
+    triangles = surface.GetNumberOfCells()
+    if triangles <= triangle_budget or triangles == 0:
+        return surface
+    decimation = vtk.vtkQuadricDecimation()
+    decimation.SetInputData(surface)
+    decimation.SetTargetReduction(1.0 - triangle_budget / triangles)
+    decimation.VolumePreservationOn()
+    decimation.Update()
+    return decimation.GetOutput()
+
+
+def quantize_positions(points, bits=POSITION_BITS):
+    """Integer positions over the bounds of ``points``, with the offset and scale to restore them.
+
+    One step size for all three axes, set by the longest side: a uniform
+    scale keeps normals valid under the glTF node transform, which viewers
+    apply to them through its inverse transpose.
+    """
+    low = points.min(axis=0)
+    extent = max(float((points.max(axis=0) - low).max()), 1e-9)
+    scale = np.full(3, extent / (2**bits - 1))
+    quantized = np.rint((points - low) / scale).astype(np.uint16)
+    return quantized, low, scale
+
+
+def mesh_arrays(surface):
+    """Positions (float), unit normals (float32) and triangle indices of a vtkPolyData"""
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputData(surface)
+    normals.SplittingOff()
+    normals.ConsistencyOn()
+    normals.Update()
+    mesh = normals.GetOutput()
+    if mesh.GetNumberOfPoints() == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.uint32)
+    points = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData()).astype(np.float64)
+    point_normals = numpy_support.vtk_to_numpy(mesh.GetPointData().GetNormals()).astype(np.float32)
+    polys = numpy_support.vtk_to_numpy(mesh.GetPolys().GetConnectivityArray())
+    return points, point_normals, polys.reshape(-1, 3).astype(np.uint32)
+
+
+def write_vtp(surface, path, metadata=None, bits=POSITION_BITS):
+    """Compressed binary VTP, positions snapped to the quantization grid, metadata as field data"""
+    output = vtk.vtkPolyData()
+    output.DeepCopy(surface)
+    if output.GetNumberOfPoints():
+        points = numpy_support.vtk_to_numpy(output.GetPoints().GetData()).astype(np.float64)
+        quantized, low, scale = quantize_positions(points, bits)
+        # Snapped float32 positions: the same precision as the glTF, and they compress well
+        snapped = (quantized * scale + low).astype(np.float32)
+        vtk_points = vtk.vtkPoints()
+        vtk_points.SetData(numpy_support.numpy_to_vtk(snapped, deep=True))
+        output.SetPoints(vtk_points)
+    output.GetPointData().Initialize()
+
+    for name, value in (metadata or {}).items():
+        if isinstance(value, (int, float)):
+            array = vtk.vtkDoubleArray()
+            array.SetName(name)
+            array.InsertNextValue(float(value))
+        else:
+            array = vtk.vtkStringArray()
+            array.SetName(name)
+            array.InsertNextValue(str(value))
+        output.GetFieldData().AddArray(array)
+
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetFileName(str(path))
+    writer.SetInputData(output)
+    writer.SetDataModeToAppended()
+    writer.EncodeAppendedDataOff()
+    writer.SetCompressorTypeToZLib()
+    writer.Write()
+    return path
+
+
+def write_glb(surface, path, color=(0.8, 0.8, 0.8), metadata=None, name="tumor", bits=POSITION_BITS):
+    """Binary glTF with quantized positions and normals (KHR_mesh_quantization).
+
+    Positions are unsigned shorts over the mesh bounds; the node transform,
+    a uniform scale and a translation, maps them back to millimetres, in
+    the image's physical frame. Normals are normalized bytes.
+    ``metadata`` goes into the node extras.
+    """
+    points, normals, triangles = mesh_arrays(surface)
+    chunks = []
+    views = []
+    accessors = []
+
+    def add_view(data, target, stride=None):
+        offset = sum(len(c) for c in chunks)
+        chunks.append(data.tobytes() + b'\0' * (-data.nbytes % 4))
+        view = {'buffer': 0, 'byteOffset': offset, 'byteLength': data.nbytes, 'target': target}
+        if stride:
+            view['byteStride'] = stride
+        views.append(view)
+        return len(views) - 1
+
+    def add_accessor(view, component_type, count, kind, normalized=False, **bounds):
+        accessor = {'bufferView': view, 'componentType': component_type, 'count': int(count), 'type': kind}
+        if normalized:
+            accessor['normalized'] = True
+        accessor.update(bounds)
+        accessors.append(accessor)
+        return len(accessors) - 1
+
+    node = {'name': name, 'extras': metadata or {}}
+    document = {
+        'asset': {'version': '2.0', 'generator': 'VITK mesh export', 'extras': {'units': 'mm'}},
+        'scene': 0,
+        'scenes': [{'nodes': [0]}],
+        'nodes': [node],
+    }
+    # An empty surface is a node without a mesh
+    if len(points):
+        quantized, low, scale = quantize_positions(points, bits)
+        # Vertex attributes are aligned to 4 bytes: pad the 3 components to 4
+        padded = np.zeros((len(quantized), 4), dtype=np.uint16)
+        padded[:, :3] = quantized
+        position = add_accessor(
+            add_view(padded, _ARRAY_BUFFER, stride=8), _UNSIGNED_SHORT, len(points), 'VEC3',
+            min=quantized.min(axis=0).tolist(), max=quantized.max(axis=0).tolist()
+        )
+        packed_normals = np.zeros((len(normals), 4), dtype=np.int8)
+        packed_normals[:, :3] = np.clip(np.rint(normals * 127), -127, 127)
+        normal = add_accessor(add_view(packed_normals, _ARRAY_BUFFER, stride=4), _BYTE,
+                              len(normals), 'VEC3', normalized=True)
+        index_type = np.uint16 if len(points) <= 65535 else np.uint32
+        indices = add_accessor(
+            add_view(triangles.astype(index_type).ravel(), _ELEMENT_ARRAY_BUFFER),
+            _UNSIGNED_SHORT if index_type is np.uint16 else _UNSIGNED_INT, triangles.size, 'SCALAR'
+        )
+        node.update(mesh=0, translation=low.tolist(), scale=scale.tolist())
+        document.update({
+            'extensionsUsed': ['KHR_mesh_quantization'],
+            'extensionsRequired': ['KHR_mesh_quantization'],
+            'meshes': [{'name': name, 'primitives': [{
+                'attributes': {'POSITION': position, 'NORMAL': normal},
+                'indices': indices, 'material': 0, 'mode': 4,
+            }]}],
+            'materials': [{'pbrMetallicRoughness': {
+                'baseColorFactor': [*color, 1.0], 'metallicFactor': 0.0, 'roughnessFactor': 0.6,
+            }}],
+            'buffers': [{'byteLength': sum(len(c) for c in chunks)}],
+            'bufferViews': views,
+            'accessors': accessors,
+        })
+
+    binary = b''.join(chunks)
+    text = json.dumps(document, separators=(',', ':')).encode()
+    text += b' ' * (-len(text) % 4)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<III', _GLB_MAGIC, 2, 12 + 8 + len(text) + (8 + len(binary) if binary else 0)))
+        f.write(struct.pack('<II', len(text), _CHUNK_JSON) + text)
+        if binary:
+            f.write(struct.pack('<II', len(binary), _CHUNK_BIN) + binary)
+    return path
+
+
+def case_metadata(analysis_results, timepoint):
+    """Volume and change figures of one timepoint, from compare_tumors results"""
+    tumor = analysis_results['tumor1' if timepoint == 'scan1' else 'tumor2']
+    comparison = analysis_results['comparison']
+    metadata = {
+        'timepoint': timepoint,
+        'volume_mm3': tumor['volume_mm3'],
+        'volume_change_mm3': comparison['volume_change_mm3'],
+        'volume_change_percent': comparison['volume_change_percent'],
+        'dice_coefficient': comparison['dice_coefficient'],
+    }
+    for region, volume in (comparison.get('change_volumes_mm3') or {}).items():
+        metadata[f'{region}_mm3'] = volume
+    return metadata
+
+
+def export_tumor_meshes(mask1, mask2, analysis_results, output_dir, triangle_budget=DEFAULT_TRIANGLE_BUDGET,
+                        formats=('vtp', 'glb'), prefix="tumor", native_matrix=None):
+    """Decimated, quantized surfaces of both tumor masks as VTP and/or binary glTF.
+
+    Writes <prefix>_scan1.<format> and <prefix>_scan2.<format> in
+    output_dir and returns a report: triangles before and after
+    decimation, file sizes and the time taken. With ``native_matrix``
+    (baseline to follow-up space, see TransformService.chain), the
+    follow-up surface is also written in its native scanner space as
+    <prefix>_scan2_native.<format>, by mapping the mesh points.
+    """
+    from visualization import tumor_surface
+
+    start = time.perf_counter()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    report = {'triangle_budget': triangle_budget, 'files': {}, 'triangles': {}}
+    for timepoint, mask in (('scan1', mask1), ('scan2', mask2)):
+        with profile_step("surface"):
+            surface = tumor_surface(mask)
+        with profile_step("decimate"):
+            decimated = decimate(surface, triangle_budget)
+        report['triangles'][timepoint] = [surface.GetNumberOfCells(), decimated.GetNumberOfCells()]
+        metadata = case_metadata(analysis_results, timepoint)
+        meshes = [(f"{prefix}_{timepoint}", decimated)]
+        if timepoint == 'scan2' and native_matrix is not None:
+            from transforms import map_polydata
+
+            meshes.append((f"{prefix}_{timepoint}_native", map_polydata(native_matrix, decimated)))
+        with profile_step("write"):
+            for name, mesh in meshes:
+                if 'vtp' in formats:
+                    path = write_vtp(mesh, output_dir / f"{name}.vtp", metadata)
+                    report['files'][path.name] = path.stat().st_size
+                if 'glb' in formats:
+                    path = write_glb(mesh, output_dir / f"{name}.glb", TIMEPOINT_COLORS[timepoint], metadata,
+                                     name=name)
+                    report['files'][path.name] = path.stat().st_size
+    report['bytes'] = sum(report['files'].values())
+    report['time_s'] = time.perf_counter() - start
+    return report
+
+
+def _export_case(results_dir, output_dir, triangle_budget, formats):
+    from storage import resolve_result_path
+
+    results_dir = Path(results_dir)
+    with open(results_dir / "tumor_analysis.json", 'r') as f:
+        analysis_results = json.load(f)
+    return export_tumor_meshes(
+        resolve_result_path(results_dir, "tumor_mask_scan1"),
+        resolve_result_path(results_dir, "tumor_mask_scan2"),
+        analysis_results, output_dir, triangle_budget, formats
+    )
+
+
+def export_cohort(result_dirs, output_dir, triangle_budget=DEFAULT_TRIANGLE_BUDGET,
+                  formats=('vtp', 'glb'), workers=None):
+    """export_tumor_meshes() for many pipeline result directories, in parallel processes.
+
+    Each case gets a subdirectory of output_dir named after the path of
+    its results directory below their common parent (``p01/results`` is
+    written to ``p01_results``). Returns {results directory: report}; a
+    failed case reports its error instead.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    import os
+
+    result_dirs = [str(d) for d in result_dirs]
+    resolved = [Path(d).absolute() for d in result_dirs]
+    parent = Path(os.path.commonpath(resolved))
+    if len(set(resolved)) == 1:
+        parent = parent.parent
+    names = ["_".join(d.relative_to(parent).parts) for d in resolved]
+    workers = max(1, min(len(result_dirs), workers or os.cpu_count() or 1))
+    reports = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {
+            d: pool.submit(_export_case, d, str(Path(output_dir) / name), triangle_budget, formats)
+            for d, name in zip(result_dirs, names)
+        }
+        for d, future in futures.items():
+            try:
+                reports[d] = future.result()
+            except Exception as e:
+                reports[d] = {'error': str(e)}
+    return reports
@@ -0,0 +1,81 @@
+import numpy as np
+
+from profiling import profile_step
+
+
+# Registration pyramid level used by default: 2x fewer voxels along each axis
+DEFAULT_PREVIEW_SHRINK_FACTOR = 2
+
+# Tumors fewer coarse voxels across than this are misjudged beyond the bounds:
+# on the 128³ phantoms a baseline 3 voxels across came out at 59% of its
+# full-resolution volume, so the full pipeline always runs for them
+MIN_PREVIEW_VOXELS_ACROSS = 5
+
+
+def preview_tumor_change(image1_path, image2_path, shrink_factor=DEFAULT_PREVIEW_SHRINK_FACTOR,
+                         workers=None, parameters=None):
+    """Quick-look tumor change on a coarse level of the registration pyramid.
+
+    Registers the two scans on the pyramid level only, segments both
+    levels with sizes scaled to the coarse voxels (the follow-up reuses the
+    baseline brain masks) and compares the masks with error bounds. The
+    bounds cover the partial volume of the boundary voxels only: tumors a
+    few coarse voxels across may be missed altogether, or misestimated
+    beyond the bounds, which is why 2 is the default factor. Returns
+    the TumorAnalysis.compare_preview() results plus a ``preview`` entry
+    with the shrink factor and whether registration succeeded; see
+    needs_full_resolution() for when they can be trusted.
+    """
+    from registration import ImageRegistration, PYRAMID_SHRINK_FACTORS, PYRAMID_SMOOTHING_SIGMAS
+    from segmentation import TumorSegmentation
+    from analysis import TumorAnalysis
+
+    with profile_step("registration"):
+        fixed_level, registered_level, transform = ImageRegistration().register_preview(
+            image1_path, image2_path, shrink_factor
+        )
+
+    # The pyramid level is already smoothed: only add what the full-resolution
+    # smoothing (1.5 voxels) has beyond it
+    full_sigma_mm = 1.5 * min(fixed_level.GetSpacing()) / shrink_factor
+    level_sigma_mm = PYRAMID_SMOOTHING_SIGMAS[PYRAMID_SHRINK_FACTORS.index(shrink_factor)]
+    sigma = np.sqrt(max(0.0, full_sigma_mm ** 2 - level_sigma_mm ** 2)) / min(fixed_level.GetSpacing())
+    segmenter = TumorSegmentation(workers=workers, shrink_factor=shrink_factor, smoothing_sigma=sigma)
+    with profile_step("segmentation"):
+        mask1, brain_masks = segmenter.segment_tumor_automatic(
+            fixed_level, sparse=True, parameters=parameters, return_brain_masks=True
+        )
+        mask2 = segmenter.segment_tumor_automatic(
+            registered_level, sparse=True, parameters=parameters,
+            brain_masks=brain_masks if transform is not None else None, refine_brain_mask=True
+        )
+
+    with profile_step("analysis"):
+        results = TumorAnalysis().compare_preview(mask1, mask2)
+    results['preview'] = {
+        'shrink_factor': shrink_factor,
+        'registered': transform is not None,
+        'shape': list(mask1.shape),
+        'smoothing_sigma': float(sigma),
+    }
+    return results
+
+
+def needs_full_resolution(preview, change_threshold):
+    """True when the preview's volume change may reach change_threshold percent, either way.
+
+    The bounds only cover the partial volume of boundary voxels, not the
+    bias of segmenting the coarse level, so the preview is not trusted
+    (True) when either tumor is fewer than MIN_PREVIEW_VOXELS_ACROSS coarse
+    voxels across or the Dice bounds collapse to a point, as they do when
+    a tumor is lost or the masks do not overlap at all.
+    """
+    if min(preview[name]['voxels_across'] for name in ('tumor1', 'tumor2')) < MIN_PREVIEW_VOXELS_ACROSS:
+        return True
+    dice_low, dice_high = preview['comparison']['dice_bounds']
+    if dice_low == dice_high:
+        return True
+    low, high = preview['comparison']['volume_change_percent_bounds']
+    if low is None or high is None:
+        return True
+    return max(abs(low), abs(high)) >= change_threshold
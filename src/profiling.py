@@ -0,0 +1,203 @@
+import time
+import threading
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Profiler that profile_step() reports to, set by PipelineProfiler.activate()
+_active_profiler = None
+
+
+def _read_proc_status():
+    """Current and peak resident set size in bytes, from /proc when available"""
+    values = {}
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, value = line.split(":", 1)
+                    values[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+
+    rss = values.get("VmRSS")
+    peak = values.get("VmHWM")
+    if peak is None and resource is not None:
+        # ru_maxrss is in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return rss, peak
+
+
+def _read_proc_io():
+    """Bytes read and written by this process (rchar/wchar), or None"""
+    try:
+        with open("/proc/self/io", 'r') as f:
+            values = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class ProfileStep:
+    """Context manager timing one stage or sub-step"""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        if self.profiler is None:
+            return self
+
+        stack = self.profiler._stack()
+        self.full_name = "/".join([step.name for step in stack] + [self.name])
+        stack.append(self)
+
+        _, self._peak_start = _read_proc_status()
+        self._read_start, self._write_start = _read_proc_io()
+        self._cpu_start = time.process_time()
+        self._wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profiler is None:
+            return False
+
+        wall = time.perf_counter() - self._wall_start
+        cpu = time.process_time() - self._cpu_start
+        rss, peak = _read_proc_status()
+        read_end, write_end = _read_proc_io()
+
+        stack = self.profiler._stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+
+        self.record = {
+            'name': self.full_name,
+            'depth': self.full_name.count("/"),
+            'start_s': self._wall_start - self.profiler._wall_start,
+            'wall_time_s': wall,
+            'cpu_time_s': cpu,
+            'rss_mb': rss / 2**20 if rss is not None else None,
+            'peak_rss_mb': peak / 2**20 if peak is not None else None,
+            'peak_rss_increase_mb': (
+                (peak - self._peak_start) / 2**20
+                if peak is not None and self._peak_start is not None else None
+            ),
+            'bytes_read': (
+                read_end - self._read_start if read_end is not None else None
+            ),
+            'bytes_written': (
+                write_end - self._write_start if write_end is not None else None
+            ),
+            'failed': exc_type is not None,
+        }
+        self.profiler._add_record(self.record)
+        return False
+
+
+class PipelineProfiler:
+    """Collects wall time, CPU time, peak RSS and I/O per pipeline stage.
+
+    Stages nest: a step opened inside another is recorded as
+    ``parent/child``. Library code reports sub-steps through
+    ``profile_step()``, which is a no-op unless a profiler is active.
+    Note that CPU time and I/O counters are process-wide, so steps running
+    concurrently in worker threads include each other's work.
+    """
+
+    def __init__(self, cprofile=False):
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._cprofile = None
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+        if cprofile:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _add_record(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def stage(self, name):
+        return ProfileStep(self, name)
+
+    def activate(self):
+        """Make this the profiler that profile_step() reports to"""
+        global _active_profiler
+        _active_profiler = self
+        if self._cprofile is not None:
+            self._cprofile.enable()
+        return self
+
+    def deactivate(self):
+        global _active_profiler
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        if _active_profiler is self:
+            _active_profiler = None
+
+    def __enter__(self):
+        return self.activate()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.deactivate()
+        return False
+
+    def save_cprofile(self, output_path):
+        """Dump cProfile statistics (readable with pstats or snakeviz)"""
+        if self._cprofile is None:
+            return None
+        self._cprofile.dump_stats(str(output_path))
+        return Path(output_path)
+
+    def top_functions(self, limit=15):
+        if self._cprofile is None:
+            return []
+        import pstats
+
+        stats = pstats.Stats(self._cprofile)
+        entries = []
+        for (filename, line, function), (_, calls, _, cumulative, _) in stats.stats.items():
+            entries.append({
+                'function': f"{Path(filename).name}:{line}({function})",
+                'calls': calls,
+                'cumulative_time_s': cumulative,
+            })
+        entries.sort(key=lambda e: e['cumulative_time_s'], reverse=True)
+        return entries[:limit]
+
+    def summary(self):
+        _, peak = _read_proc_status()
+        with self._lock:
+            stages = sorted(self.records, key=lambda r: r['start_s'])
+
+        return {
+            'total_wall_time_s': time.perf_counter() - self._wall_start,
+            'total_cpu_time_s': time.process_time() - self._cpu_start,
+            'peak_rss_mb': peak / 2**20 if peak is not None else None,
+            'stages': stages,
+            'top_functions': self.top_functions(),
+        }
+
+
+def profile_step(name):
+    """Time a sub-step against the active profiler, if there is one"""
+    return ProfileStep(_active_profiler, name)
+
+
+def get_active_profiler():
+    return _active_profiler
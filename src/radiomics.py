@@ -0,0 +1,262 @@
+import numpy as np
+import scipy.ndimage as ndi
+
+
+# Gray levels each ROI is quantized to (fixed bin count over the ROI's range)
+RADIOMICS_BIN_COUNT = 32
+
+# The 13 unique 3-D neighbour directions (the other 13 are their opposites),
+# each lexicographically positive so raster order follows the direction
+DIRECTIONS = np.array([
+    d for d in np.ndindex(3, 3, 3)
+    if tuple(np.subtract(d, 1)) > (0, 0, 0)
+]) - 1
+
+# Lesions smaller than this are listed but get no texture features
+MIN_TEXTURE_VOXELS = 8
+
+
+def lesion_rois(image_crop, mask_crop, min_voxels=1):
+    """(image, mask) crops of each connected lesion, largest first.
+
+    ``image_crop`` and ``mask_crop`` cover the same (z, y, x) region, such
+    as a mask's bounding box. Returns the crops with their offsets in that
+    region.
+    """
+    labels, count = ndi.label(mask_crop > 0)
+    rois = []
+    for label, box in enumerate(ndi.find_objects(labels), start=1):
+        lesion = labels[box] == label
+        if np.count_nonzero(lesion) >= min_voxels:
+            rois.append({
+                'offset': [b.start for b in box],
+                'image': np.asarray(image_crop[box], dtype=np.float32),
+                'mask': lesion,
+            })
+    rois.sort(key=lambda roi: -np.count_nonzero(roi['mask']))
+    return rois
+
+
+def quantize(values, bin_count=RADIOMICS_BIN_COUNT):
+    """Gray levels 1..bin_count over the range of ``values``"""
+    low, high = values.min(), values.max()
+    if high <= low:
+        return np.ones(values.shape, dtype=np.int32)
+    levels = np.floor((values - low) / (high - low) * bin_count).astype(np.int32) + 1
+    return np.minimum(levels, bin_count)
+
+
+def _pack(rois, bin_count):
+    """All ROIs quantized and stacked along z with a background gap.
+
+    Returns the gray levels (0 outside the lesions) and the ROI index of
+    every voxel (-1 in the gaps), so that one pass over the stack handles
+    every ROI: no neighbour pair at distance 1 crosses a gap.
+    """
+    height = max(roi['mask'].shape[1] for roi in rois)
+    width = max(roi['mask'].shape[2] for roi in rois)
+    depth = sum(roi['mask'].shape[0] + 1 for roi in rois)
+    levels = np.zeros((depth, height, width), dtype=np.int32)
+    owner = np.full((depth, height, width), -1, dtype=np.int32)
+    z = 0
+    for index, roi in enumerate(rois):
+        mask = roi['mask']
+        d, h, w = mask.shape
+        region = levels[z:z + d, :h, :w]
+        region[mask] = quantize(roi['image'][mask], bin_count)
+        owner[z:z + d, :h, :w][mask] = index
+        z += d + 1
+    return levels, owner
+
+
+def _shifted(array, direction):
+    """Views of ``array`` at p and p + direction, over every p where both exist"""
+    source = []
+    target = []
+    for step, size in zip(direction, array.shape):
+        source.append(slice(max(0, -step), size - max(0, step)))
+        target.append(slice(max(0, step), size - max(0, -step)))
+    return array[tuple(source)], array[tuple(target)]
+
+
+def glcm_matrices(levels, owner, roi_count, bin_count):
+    """Symmetric, normalized co-occurrence matrices: (ROIs, directions, bins, bins)"""
+    matrices = np.zeros((roi_count, len(DIRECTIONS), bin_count, bin_count))
+    for d, direction in enumerate(DIRECTIONS):
+        a, b = _shifted(levels, direction)
+        valid = (a > 0) & (b > 0)
+        roi = _shifted(owner, direction)[0][valid]
+        codes = (roi * bin_count + a[valid] - 1) * bin_count + b[valid] - 1
+        counts = np.bincount(codes, minlength=roi_count * bin_count * bin_count)
+        matrices[:, d] = counts.reshape(roi_count, bin_count, bin_count)
+    matrices += matrices.transpose(0, 1, 3, 2)
+    totals = matrices.sum(axis=(2, 3), keepdims=True)
+    return np.divide(matrices, totals, out=np.zeros_like(matrices), where=totals > 0)
+
+
+def glrlm_matrices(levels, owner, roi_count, bin_count, max_length):
+    """Run-length matrices: (ROIs, directions, bins, max_length), the longest possible run"""
+    matrices = np.zeros((roi_count, len(DIRECTIONS), bin_count, max_length))
+    shape = np.array(levels.shape)
+    padded = np.pad(levels, 1)
+    for d, direction in enumerate(DIRECTIONS):
+        # A run starts where the previous voxel along the direction differs, and ends
+        # where the next one does
+        previous = padded[tuple(slice(1 - s, 1 - s + n) for s, n in zip(direction, shape))]
+        following = padded[tuple(slice(1 + s, 1 + s + n) for s, n in zip(direction, shape))]
+        starts = np.nonzero((levels > 0) & (levels != previous))
+        ends = np.nonzero((levels > 0) & (levels != following))
+
+        # Starts and ends come in raster order, which is their order along each line:
+        # a stable sort by line pairs each start with its end
+        axis = int(np.flatnonzero(direction)[0])
+        sorted_positions = []
+        for coords in (starts, ends):
+            position = coords[axis]
+            # The line's point at position 0, shifted to non-negative indexes
+            line = np.ravel_multi_index(
+                [c - position * s + shape.max() for c, s in zip(coords, direction)], shape + 2 * shape.max()
+            )
+            order = np.argsort(line, kind='stable')
+            sorted_positions.append((order, position[order]))
+        (first, start_position), (_, end_position) = sorted_positions
+        lengths = end_position - start_position + 1
+        gray = levels[starts][first]
+        roi = owner[starts][first]
+
+        codes = (roi * bin_count + gray - 1) * max_length + lengths - 1
+        counts = np.bincount(codes, minlength=roi_count * bin_count * max_length)
+        matrices[:, d] = counts.reshape(roi_count, bin_count, max_length)
+    return matrices
+
+
+def glcm_features(matrices):
+    """GLCM features per ROI, averaged over directions"""
+    bins = matrices.shape[-1]
+    i = np.arange(1, bins + 1, dtype=np.float64)[:, None]
+    j = i.T
+    px = matrices.sum(axis=3)
+    py = matrices.sum(axis=2)
+    mu_x = (px * i[:, 0]).sum(axis=2)
+    mu_y = (py * j[0]).sum(axis=2)
+    sigma_x = np.sqrt((px * (i[:, 0] - mu_x[..., None]) ** 2).sum(axis=2))
+    sigma_y = np.sqrt((py * (j[0] - mu_y[..., None]) ** 2).sum(axis=2))
+    difference = np.abs(i - j)
+    cluster = i + j - mu_x[..., None, None] - mu_y[..., None, None]
+    logs = np.log2(matrices, out=np.zeros_like(matrices), where=matrices > 0)
+    covariance = (matrices * (i - mu_x[..., None, None]) * (j - mu_y[..., None, None])).sum(axis=(2, 3))
+    sigma = sigma_x * sigma_y
+    features = {
+        'autocorrelation': (matrices * i * j).sum(axis=(2, 3)),
+        'contrast': (matrices * difference ** 2).sum(axis=(2, 3)),
+        'dissimilarity': (matrices * difference).sum(axis=(2, 3)),
+        'homogeneity': (matrices / (1 + difference)).sum(axis=(2, 3)),
+        'joint_energy': (matrices ** 2).sum(axis=(2, 3)),
+        'joint_entropy': -(matrices * logs).sum(axis=(2, 3)),
+        'correlation': np.divide(covariance, sigma, out=np.ones_like(sigma), where=sigma > 0),
+        'cluster_shade': (matrices * cluster ** 3).sum(axis=(2, 3)),
+        'cluster_prominence': (matrices * cluster ** 4).sum(axis=(2, 3)),
+    }
+    return {name: values.mean(axis=1) for name, values in features.items()}
+
+
+def glrlm_features(matrices, voxel_counts):
+    """GLRLM features per ROI, averaged over directions"""
+    bins, max_length = matrices.shape[2:]
+    i = np.arange(1, bins + 1, dtype=np.float64)[:, None]
+    j = np.arange(1, max_length + 1, dtype=np.float64)[None, :]
+    runs = matrices.sum(axis=(2, 3))
+    safe_runs = np.maximum(runs, 1)
+    probabilities = matrices / safe_runs[..., None, None]
+    logs = np.log2(probabilities, out=np.zeros_like(probabilities), where=probabilities > 0)
+    features = {
+        'short_run_emphasis': (matrices / j ** 2).sum(axis=(2, 3)) / safe_runs,
+        'long_run_emphasis': (matrices * j ** 2).sum(axis=(2, 3)) / safe_runs,
+        'gray_level_nonuniformity': (matrices.sum(axis=3) ** 2).sum(axis=2) / safe_runs,
+        'run_length_nonuniformity': (matrices.sum(axis=2) ** 2).sum(axis=2) / safe_runs,
+        'run_percentage': runs / np.maximum(voxel_counts, 1)[:, None],
+        'low_gray_level_run_emphasis': (matrices / i ** 2).sum(axis=(2, 3)) / safe_runs,
+        'high_gray_level_run_emphasis': (matrices * i ** 2).sum(axis=(2, 3)) / safe_runs,
+        'run_entropy': -(probabilities * logs).sum(axis=(2, 3)),
+    }
+    return {name: values.mean(axis=1) for name, values in features.items()}
+
+
+def first_order_features(values, bin_count=RADIOMICS_BIN_COUNT):
+    mean = values.mean()
+    std = values.std()
+    centered = values - mean
+    histogram = np.bincount(quantize(values, bin_count), minlength=bin_count + 1)[1:] / len(values)
+    nonzero = histogram[histogram > 0]
+    p10, median, p90 = np.percentile(values, [10, 50, 90])
+    return {
+        'mean': float(mean),
+        'std': float(std),
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'median': float(median),
+        'percentile_10': float(p10),
+        'percentile_90': float(p90),
+        'skewness': float((centered ** 3).mean() / std ** 3) if std > 0 else 0.0,
+        'kurtosis': float((centered ** 4).mean() / std ** 4) if std > 0 else 0.0,
+        'energy': float((values.astype(np.float64) ** 2).sum()),
+        'entropy': float(-(nonzero * np.log2(nonzero)).sum()),
+        'uniformity': float((histogram ** 2).sum()),
+    }
+
+
+def shape_features(mask, spacing):
+    """Volume, voxel-face surface area, sphericity and principal axis lengths"""
+    spacing = np.asarray(spacing, dtype=np.float64)
+    volume = np.count_nonzero(mask) * spacing.prod()
+    # Exposed voxel faces, per axis, times their area
+    padded = np.pad(mask, 1)
+    area = 0.0
+    for axis in range(3):
+        faces = np.count_nonzero(np.diff(padded, axis=axis))
+        area += faces * spacing.prod() / spacing[axis]
+    coords = np.argwhere(mask) * spacing
+    axes = np.zeros(3)
+    if len(coords) > 1:
+        eigenvalues = np.sort(np.linalg.eigvalsh(np.cov(coords.T)))[::-1]
+        axes = 4 * np.sqrt(np.maximum(eigenvalues, 0))
+    return {
+        'volume_mm3': float(volume),
+        'surface_area_mm2': float(area),
+        'sphericity': float(np.pi ** (1 / 3) * (6 * volume) ** (2 / 3) / area) if area > 0 else 0.0,
+        'major_axis_mm': float(axes[0]),
+        'minor_axis_mm': float(axes[1]),
+        'least_axis_mm': float(axes[2]),
+        'elongation': float(axes[1] / axes[0]) if axes[0] > 0 else 0.0,
+        'flatness': float(axes[2] / axes[0]) if axes[0] > 0 else 0.0,
+    }
+
+
+def extract_features(rois, spacing, bin_count=RADIOMICS_BIN_COUNT):
+    """First-order, shape, GLCM and GLRLM features of a batch of ROIs.
+
+    ``rois`` come from lesion_rois(), possibly from several images; they
+    share one voxel ``spacing`` ((z, y, x) order). Every ROI is quantized
+    once, and the texture matrices of the whole batch are counted in one
+    pass per direction. Returns one feature dict per ROI.
+    """
+    results = [
+        {
+            'voxels': int(np.count_nonzero(roi['mask'])),
+            'first_order': first_order_features(roi['image'][roi['mask']], bin_count),
+            'shape': shape_features(roi['mask'], spacing),
+        }
+        for roi in rois
+    ]
+    textured = [k for k, roi in enumerate(rois) if results[k]['voxels'] >= MIN_TEXTURE_VOXELS]
+    if textured:
+        batch = [rois[k] for k in textured]
+        levels, owner = _pack(batch, bin_count)
+        voxel_counts = np.array([results[k]['voxels'] for k in textured])
+        glcm = glcm_features(glcm_matrices(levels, owner, len(batch), bin_count))
+        max_length = max(max(roi['mask'].shape) for roi in batch)
+        glrlm = glrlm_features(glrlm_matrices(levels, owner, len(batch), bin_count, max_length), voxel_counts)
+        for n, k in enumerate(textured):
+            results[k]['glcm'] = {name: float(values[n]) for name, values in glcm.items()}
+            results[k]['glrlm'] = {name: float(values[n]) for name, values in glrlm.items()}
+    return results
@@ -0,0 +1,154 @@
+import numpy as np
+
+from sparse_mask import SparseMask
+
+
+class RegionGrower:
+    """Connected-threshold region growing on an in-memory volume.
+
+    Thresholds come from the intensity statistics of a small cube around
+    each seed (mean +/- std_factor * std), so a single seed still gets a
+    usable range. Growth uses face connectivity, like ITK's
+    ConnectedThresholdImageFilter, and is a vectorised breadth-first search
+    that stops at ``max_extent`` voxels from the seeds' bounding box or once
+    ``max_volume`` voxels are reached (the last layer is cut to exactly
+    ``max_volume``). ``truncated`` is True when either limit clipped the
+    region: the volume was reached, or the region touches a face of the
+    search box that is not a border of the volume. Results are cached per
+    seed set, so re-seeding interactively only grows new seed sets.
+
+    Seeds are voxel indices in (x, y, z) order, as in
+    segment_tumor_region_growing; masks are SparseMasks (one bit per voxel
+    of the region's bounding box, uint8 when densified).
+    """
+
+    def __init__(self, array, origin=None, spacing=None, direction=None,
+                 radius=1, std_factor=2.0, max_extent=None, max_volume=None):
+        self.array = array
+        self.origin = origin
+        self.spacing = spacing
+        self.direction = direction
+        self.radius = radius
+        self.std_factor = std_factor
+        self.max_extent = max_extent
+        self.max_volume = max_volume
+        self._cache = {}
+
+    @classmethod
+    def from_itk(cls, image, **options):
+        import itk
+
+        return cls(itk.GetArrayViewFromImage(image), image.GetOrigin(), image.GetSpacing(),
+                   itk.array_from_matrix(image.GetDirection()), **options)
+
+    def _seed_indices(self, seeds):
+        """Valid seeds as (z, y, x) tuples, sorted and deduplicated"""
+        indices = set()
+        for seed in seeds:
+            z, y, x = int(seed[2]), int(seed[1]), int(seed[0])
+            if all(0 <= i < n for i, n in zip((z, y, x), self.array.shape)):
+                indices.add((z, y, x))
+        return sorted(indices)
+
+    def seed_statistics(self, seeds):
+        """Mean and std of the intensities in the cubes around the seeds"""
+        seed_indices = np.array(self._seed_indices(seeds), dtype=np.int64).reshape(-1, 3)
+        if len(seed_indices) == 0:
+            return None, None
+
+        r = self.radius
+        offsets = np.stack(np.meshgrid(*[np.arange(-r, r + 1)] * 3, indexing='ij'), axis=-1)
+        points = (seed_indices[:, None, :] + offsets.reshape(1, -1, 3)).reshape(-1, 3)
+        inside = np.all((points >= 0) & (points < np.array(self.array.shape)), axis=1)
+        # Overlapping cubes count each voxel once
+        points = np.unique(points[inside], axis=0)
+        values = self.array[tuple(points.T)].astype(np.float64)
+        return float(np.mean(values)), float(np.std(values))
+
+    def grow(self, seeds, lower=None, upper=None):
+        """Grow one seed set; returns a dict with the mask, thresholds and stop reason"""
+        seed_indices = self._seed_indices(seeds)
+        if lower is None or upper is None:
+            mean, std = self.seed_statistics(seeds)
+            if mean is not None:
+                lower = mean - self.std_factor * std if lower is None else lower
+                upper = mean + self.std_factor * std if upper is None else upper
+
+        key = (tuple(seed_indices), lower, upper,
+               self.radius, self.std_factor, self.max_extent, self.max_volume)
+        if key not in self._cache:
+            self._cache[key] = self._grow(seed_indices, lower, upper)
+        return self._cache[key]
+
+    def grow_many(self, seed_sets, workers=None):
+        """Grow several seed sets in one call (threads share the volume and cache)"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        if workers == 1 or len(seed_sets) < 2:
+            return [self.grow(seeds) for seeds in seed_sets]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(self.grow, seed_sets))
+
+    def _grow(self, seed_indices, lower, upper):
+        shape = self.array.shape
+        result = {'lower': lower, 'upper': upper, 'truncated': False, 'iterations': 0}
+
+        # Search box: the seeds' bounding box plus max_extent on every side
+        if seed_indices and self.max_extent is not None:
+            seeds = np.array(seed_indices)
+            box = tuple(
+                slice(max(0, int(low) - self.max_extent), min(n, int(high) + self.max_extent + 1))
+                for low, high, n in zip(seeds.min(axis=0), seeds.max(axis=0), shape)
+            )
+        else:
+            box = tuple(slice(0, n) for n in shape)
+        offset = np.array([s.start for s in box])
+
+        crop = self.array[box]
+        # One voxel of padding stops the flat-index neighbours from wrapping around
+        allowed = np.zeros(tuple(n + 2 for n in crop.shape), dtype=bool)
+        if lower is not None:
+            allowed[1:-1, 1:-1, 1:-1] = (crop >= lower) & (crop <= upper)
+
+        padded_shape = allowed.shape
+        flat_allowed = allowed.ravel()
+        strides = [padded_shape[1] * padded_shape[2], padded_shape[2], 1]
+        steps = np.array([-strides[0], strides[0], -strides[1], strides[1], -1, 1])
+
+        frontier = np.array([
+            np.ravel_multi_index(tuple(np.array(s) - offset + 1), padded_shape)
+            for s in seed_indices
+        ], dtype=np.int64)
+        frontier = frontier[flat_allowed[frontier]] if len(frontier) else frontier
+        if self.max_volume is not None and len(frontier) > self.max_volume:
+            frontier = frontier[:self.max_volume]
+            result['truncated'] = True
+        visited = np.zeros(flat_allowed.size, dtype=bool)
+        visited[frontier] = True
+        count = len(frontier)
+
+        while len(frontier):
+            neighbours = np.unique((frontier[:, None] + steps).ravel())
+            neighbours = neighbours[flat_allowed[neighbours] & ~visited[neighbours]]
+            if self.max_volume is not None and count + len(neighbours) > self.max_volume:
+                # Keep the first voxels of the last layer (in index order) up to max_volume
+                visited[neighbours[:self.max_volume - count]] = True
+                result['truncated'] = True
+                result['iterations'] += 1
+                break
+            visited[neighbours] = True
+            count += len(neighbours)
+            frontier = neighbours
+            result['iterations'] += 1
+
+        region = visited.reshape(padded_shape)[1:-1, 1:-1, 1:-1]
+        # A region reaching a face of the search box that is not a volume border was clipped by max_extent
+        for axis, (s, n) in enumerate(zip(box, shape)):
+            faces = ([0] if s.start > 0 else []) + ([-1] if s.stop < n else [])
+            if any(np.take(region, face, axis=axis).any() for face in faces):
+                result['truncated'] = True
+        result['mask'] = SparseMask.from_array(
+            region, self.origin, self.spacing, self.direction, offset=offset, shape=shape
+        )
+        result['voxel_count'] = result['mask'].voxel_count
+        return result
@@ -2,6 +2,132 @@ import itk
 import numpy as np
 from pathlib import Path
 
+from storage import read_image, write_image
+from sparse_mask import SparseMask
+from profiling import profile_step
+
+
+# Registration pyramid: shrink factor and smoothing sigma (mm) per level
+PYRAMID_SHRINK_FACTORS = [4, 2, 1]
+PYRAMID_SMOOTHING_SIGMAS = [2.0, 1.0, 0.0]
+
+# Preview registration: random metric samples and a shorter optimization
+PREVIEW_SAMPLING_PERCENTAGE = 0.1
+PREVIEW_ITERATIONS = 100
+
+# Registration QA: fraction of voxels sampled, and the values below which an
+# alignment is flagged as suspect
+QA_SAMPLE_FRACTION = 0.02
+QA_THRESHOLDS = {
+    'ncc': 0.8,
+    'normalized_mutual_information': 1.2,
+    'mask_dice': 0.9,
+}
+QA_HISTOGRAM_BINS = 32
+
+# Multi-start registration: (axis, degrees) rotations of the initial transform,
+# and translation offsets of this fraction of the fixed image extent, both ways
+# along each axis, each tried as a separate start. A start counts as clearly
+# losing after MULTISTART_MIN_ITERATIONS when its metric is worse, by more than
+# MULTISTART_CANCEL_MARGIN of its magnitude, than the best metric any start
+# reached at the same iteration
+MULTISTART_ROTATIONS_DEG = [(2, 0), (0, -20), (0, 20), (1, -20), (1, 20), (2, -20), (2, 20)]
+MULTISTART_TRANSLATION_FRACTION = 0.1
+MULTISTART_SAMPLING_PERCENTAGE = 0.2
+MULTISTART_ITERATIONS = 100
+MULTISTART_MIN_ITERATIONS = 5
+MULTISTART_CANCEL_MARGIN = 0.1
+
+# Sequences resampled in one pass: ITK wraps vector pixels of up to 4 components
+MAX_SEQUENCES_PER_PASS = 4
+
+# Best metric value reached at each iteration by any start, shared by the
+# multi-start workers
+_best_values = None
+
+
+def _itk_parameters(values):
+    parameters = itk.OptimizerParameters[itk.D](len(values))
+    for i, value in enumerate(values):
+        parameters[i] = float(value)
+    return parameters
+
+
+def _init_multistart(best_values):
+    global _best_values
+    _best_values = best_values
+
+
+def _coarse_start(fixed_image_path, moving_image_path, index, start):
+    """Optimize one multi-start candidate on the coarsest level (worker process)"""
+    registrator = ImageRegistration()
+    fixed_image = registrator.load_image(fixed_image_path)
+    moving_image = registrator.load_image(moving_image_path)
+    registration = registrator._create_registration(
+        fixed_image, moving_image, PYRAMID_SHRINK_FACTORS[:1], PYRAMID_SMOOTHING_SIGMAS[:1],
+        sampling_percentage=MULTISTART_SAMPLING_PERCENTAGE, iterations=MULTISTART_ITERATIONS,
+        initial_parameters=start, estimate_scales=True
+    )
+    optimizer = itk.down_cast(registration.GetOptimizer())
+    cancelled = []
+    
+    def on_iteration():
+        value = optimizer.GetValue()
+        # Compared at equal progress: a start still descending is not measured
+        # against starts that have already converged
+        iteration = min(int(optimizer.GetCurrentIteration()), len(_best_values) - 1)
+        with _best_values.get_lock():
+            _best_values[iteration] = min(_best_values[iteration], value)
+            best = _best_values[iteration]
+        if (iteration >= MULTISTART_MIN_ITERATIONS
+                and value - best > MULTISTART_CANCEL_MARGIN * abs(best)):
+            cancelled.append(True)
+            optimizer.StopOptimization()
+    
+    optimizer.AddObserver(itk.IterationEvent(), on_iteration)
+    try:
+        registration.Update()
+    except Exception as e:
+        print(f"Multi-start candidate failed: {e}")
+        return {'start': index, 'value': None, 'cancelled': False}
+    transform = registration.GetTransform()
+    return {
+        'start': index,
+        'value': float(optimizer.GetValue()),
+        'iterations': int(optimizer.GetCurrentIteration()),
+        'cancelled': bool(cancelled),
+        'fixed_parameters': list(transform.GetFixedParameters()),
+        'parameters': list(transform.GetParameters()),
+    }
+
+
+def _same_grid(image1, image2):
+    return (
+        tuple(image1.GetLargestPossibleRegion().GetSize()) == tuple(image2.GetLargestPossibleRegion().GetSize())
+        and np.allclose(image1.GetOrigin(), image2.GetOrigin())
+        and np.allclose(image1.GetSpacing(), image2.GetSpacing())
+        and np.allclose(itk.array_from_matrix(image1.GetDirection()), itk.array_from_matrix(image2.GetDirection()))
+    )
+
+
+def _otsu_threshold(values, bins=128):
+    """Intensity separating values into two classes with maximal between-class variance"""
+    counts, edges = np.histogram(values, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight = np.cumsum(counts)
+    total = weight[-1]
+    cumulative_mean = np.cumsum(counts * centers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (cumulative_mean[-1] * weight / total - cumulative_mean) ** 2 / (weight * (total - weight))
+    return centers[np.nanargmax(between)]
+
+
+def registration_qa_score(qa):
+    """Sort key of assess_registration() results: not suspect first, then NCC plus mask Dice"""
+    if qa is None:
+        return (False, -np.inf)
+    return (not qa['suspect'], qa['ncc'] + qa['mask_dice'])
+
 
 class ImageRegistration:
     def __init__(self):
@@ -10,15 +136,83 @@ class ImageRegistration:
         self.ImageType = itk.Image[self.PixelType, self.Dimension]
         
     def load_image(self, image_path):
-        reader = itk.ImageFileReader[self.ImageType].New()
-        reader.SetFileName(str(image_path))
-        reader.Update()
-        return reader.GetOutput()
+        return read_image(image_path, self.ImageType)
+    
+    def register_images(self, fixed_image_path, moving_image_path, output_path=None, resample=True):
+        with profile_step("load"):
+            fixed_image = fixed_image_path
+            if isinstance(fixed_image, (str, Path)):
+                fixed_image = self.load_image(fixed_image)
+            moving_image = moving_image_path
+            if isinstance(moving_image, (str, Path)):
+                moving_image = self.load_image(moving_image)
+        
+        registration = self._create_registration(
+            fixed_image, moving_image, PYRAMID_SHRINK_FACTORS, PYRAMID_SMOOTHING_SIGMAS
+        )
+        return self._run_registration(registration, fixed_image, moving_image, output_path, resample)
     
-    def register_images(self, fixed_image_path, moving_image_path, output_path=None):
-        fixed_image = self.load_image(fixed_image_path)
-        moving_image = self.load_image(moving_image_path)
+    def _run_registration(self, registration, fixed_image, moving_image, output_path=None, resample=True):
+        """Optimize, resample the moving image onto the fixed grid and write it.
+
+        With resample=False only the transform is computed: (None, transform).
+        """
+        # Time each pyramid level: the event fires when a new level starts
+        level_steps = []
+        
+        def on_level_start():
+            if level_steps:
+                level_steps[-1].__exit__(None, None, None)
+            step = profile_step(f"level_{registration.GetCurrentLevel()}")
+            step.__enter__()
+            level_steps.append(step)
+        
+        registration.AddObserver(itk.MultiResolutionIterationEvent(), on_level_start)
         
+        try:
+            with profile_step("optimize"):
+                try:
+                    registration.Update()
+                finally:
+                    if level_steps:
+                        level_steps[-1].__exit__(None, None, None)
+            final_transform = registration.GetTransform()
+            if not resample:
+                return None, final_transform
+            
+            # Apply transform to moving image
+            with profile_step("resample"):
+                resampler = itk.ResampleImageFilter[self.ImageType, self.ImageType].New()
+                resampler.SetInput(moving_image)
+                resampler.SetTransform(final_transform)
+                resampler.SetUseReferenceImage(True)
+                resampler.SetReferenceImage(fixed_image)
+                resampler.SetDefaultPixelValue(0)
+                resampler.Update()
+                
+                registered_image = resampler.GetOutput()
+            
+            if output_path:
+                with profile_step("write"):
+                    write_image(registered_image, output_path, self.ImageType)
+            
+            return registered_image, final_transform
+            
+        except Exception as e:
+            print(f"Registration failed: {e}")
+            return moving_image, None
+    
+    def _create_registration(self, fixed_image, moving_image, shrink_factors, smoothing_sigmas,
+                             sampling_percentage=None, iterations=200, initial_parameters=None,
+                             estimate_scales=False):
+        """Mattes MI, versor rigid registration over the given pyramid levels, initialized.
+
+        The transform starts from the image moments, or from
+        ``initial_parameters`` (fixed parameters, parameters) when given.
+        With ``estimate_scales``, optimizer steps are scaled to physical
+        shifts of about a quarter voxel, so rotations and translations move
+        alike.
+        """
         # Multi-resolution registration with rigid + affine transformations
         registration = itk.ImageRegistrationMethodv4[self.ImageType, self.ImageType].New()
         
@@ -32,8 +226,13 @@ class ImageRegistration:
         optimizer.SetLearningRate(4.0)
         optimizer.SetMinimumStepLength(0.001)
         optimizer.SetRelaxationFactor(0.5)
-        optimizer.SetNumberOfIterations(200)
+        optimizer.SetNumberOfIterations(iterations)
         registration.SetOptimizer(optimizer)
+        if estimate_scales:
+            scales_estimator = itk.RegistrationParameterScalesFromPhysicalShift[type(metric)].New()
+            scales_estimator.SetMetric(metric)
+            optimizer.SetScalesEstimator(scales_estimator)
+            optimizer.SetLearningRate(0.25)
         
         # Transform: Use VersorRigid3DTransform for better compatibility
         transform = itk.VersorRigid3DTransform[itk.D].New()
@@ -44,10 +243,28 @@ class ImageRegistration:
         registration.SetMovingImage(moving_image)
         
         # Shrink factors and smoothing sigmas for multi-resolution
-        registration.SetNumberOfLevels(3)
-        registration.SetShrinkFactorsPerLevel([4, 2, 1])
-        registration.SetSmoothingSigmasPerLevel([2.0, 1.0, 0.0])
+        registration.SetNumberOfLevels(len(shrink_factors))
+        registration.SetShrinkFactorsPerLevel(shrink_factors)
+        registration.SetSmoothingSigmasPerLevel(smoothing_sigmas)
+        
+        if sampling_percentage is not None:
+            registration.SetMetricSamplingStrategy(
+                itk.ImageRegistrationMethodv4Enums.MetricSamplingStrategy_RANDOM
+            )
+            registration.SetMetricSamplingPercentage(sampling_percentage)
+            # Fixed seed: the same preview for the same images
+            registration.MetricSamplingReinitializeSeed(42)
         
+        if initial_parameters is not None:
+            fixed_parameters, parameters = initial_parameters
+            transform.SetFixedParameters(_itk_parameters(fixed_parameters))
+            transform.SetParameters(_itk_parameters(parameters))
+        else:
+            self._initialize_transform(transform, fixed_image, moving_image)
+        
+        return registration
+    
+    def _initialize_transform(self, transform, fixed_image, moving_image):
         # Initialize with geometric center
         initializer = itk.CenteredTransformInitializer[
             itk.VersorRigid3DTransform[itk.D], self.ImageType, self.ImageType
@@ -56,37 +273,377 @@ class ImageRegistration:
         initializer.SetFixedImage(fixed_image)
         initializer.SetMovingImage(moving_image)
         initializer.MomentsOn()
-        initializer.InitializeTransform()
+        with profile_step("initialize"):
+            initializer.InitializeTransform()
+    
+    def multistart_parameters(self, fixed_image, moving_image, rotations_deg=None, translations_mm=None):
+        """(fixed parameters, parameters) of each start of register_multistart().
+
+        Starts are the moments-based initial transform rotated about its
+        center by each of ``rotations_deg`` ((axis, degrees) pairs, axis 0-2
+        for x, y, z), then shifted by each of ``translations_mm`` (mm
+        offsets; by default MULTISTART_TRANSLATION_FRACTION of the fixed
+        image extent, both ways along each axis). Rotations and translations
+        are separate starts, not combined.
+        """
+        rotations_deg = MULTISTART_ROTATIONS_DEG if rotations_deg is None else rotations_deg
+        if translations_mm is None:
+            size = np.array(fixed_image.GetLargestPossibleRegion().GetSize(), dtype=np.float64)
+            direction = itk.array_from_matrix(fixed_image.GetDirection())
+            extent = np.abs(direction @ (size * np.array(fixed_image.GetSpacing())))
+            translations_mm = [
+                sign * MULTISTART_TRANSLATION_FRACTION * extent[axis] * np.eye(3)[axis]
+                for axis in range(3) for sign in (-1, 1)
+            ]
+        transform = itk.VersorRigid3DTransform[itk.D].New()
+        self._initialize_transform(transform, fixed_image, moving_image)
+        fixed_parameters = list(transform.GetFixedParameters())
+        base = np.array(transform.GetParameters())
         
+        starts = []
+        for axis, degrees in rotations_deg:
+            parameters = base.copy()
+            # Versor part of the parameters: rotation axis times sin(angle / 2)
+            parameters[axis] = np.sin(np.radians(degrees) / 2)
+            starts.append((fixed_parameters, parameters.tolist()))
+        for offset in translations_mm:
+            parameters = base.copy()
+            parameters[3:] += np.asarray(offset, dtype=np.float64)
+            starts.append((fixed_parameters, parameters.tolist()))
+        return starts
+    
+    def register_multistart(self, fixed_image_path, moving_image_path, output_path=None,
+                            rotations_deg=None, translations_mm=None, workers=None):
+        """register_images() from several initial transforms run in parallel.
+
+        Each start (see multistart_parameters()) is optimized on the coarsest
+        pyramid level, with sampled metric, in a pool of ``workers``
+        processes. Starts whose metric is clearly worse than the best one
+        reached at the same iteration stop early. Only the best candidate continues to the finer
+        levels. Needs image paths, since workers read the images themselves.
+        Returns (registered image, transform) like register_images(), and
+        stores the coarse results of every start in ``self.multistart_results``.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        import os
+        
+        with profile_step("load"):
+            fixed_image = self.load_image(fixed_image_path)
+            moving_image = self.load_image(moving_image_path)
+        starts = self.multistart_parameters(fixed_image, moving_image, rotations_deg, translations_mm)
+        workers = min(len(starts), workers or os.cpu_count() or 1)
+        
+        with profile_step("coarse_starts"):
+            context = multiprocessing.get_context("spawn")
+            best_values = context.Array('d', [np.inf] * (MULTISTART_ITERATIONS + 1))
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                     initializer=_init_multistart, initargs=(best_values,)) as pool:
+                futures = [
+                    pool.submit(_coarse_start, str(fixed_image_path), str(moving_image_path), i, start)
+                    for i, start in enumerate(starts)
+                ]
+                self.multistart_results = [future.result() for future in futures]
+        
+        finished = [r for r in self.multistart_results if r['value'] is not None]
+        if not finished:
+            print("Registration failed: no start converged")
+            return moving_image, None
+        best = min(finished, key=lambda r: r['value'])
+        cancelled = sum(r['cancelled'] for r in self.multistart_results)
+        print(f"Multi-start: best of {len(starts)} starts is #{best['start']} "
+              f"(metric {best['value']:.4f}, {cancelled} stopped early)")
+        
+        # The best start continues on the finer levels only
+        registration = self._create_registration(
+            fixed_image, moving_image, PYRAMID_SHRINK_FACTORS[1:], PYRAMID_SMOOTHING_SIGMAS[1:],
+            initial_parameters=(best['fixed_parameters'], best['parameters']), estimate_scales=True
+        )
+        return self._run_registration(registration, fixed_image, moving_image, output_path)
+    
+    def resample_sequences(self, images, transform, reference_image):
+        """Resample several images with one transform onto reference_image's grid.
+        
+        ``images`` maps sequence names to ITK images or paths. Images sharing
+        a grid are stacked into vector images of up to MAX_SEQUENCES_PER_PASS
+        components and resampled in one multi-threaded pass, so the mapped
+        point and interpolation weights are computed once per voxel for all
+        of them. Returns a dict of float images, in the order of ``images``.
+        """
+        images = {
+            name: self.load_image(image) if isinstance(image, (str, Path)) else image
+            for name, image in images.items()
+        }
+        groups = []
+        for name, image in images.items():
+            for group in groups:
+                if len(group) < MAX_SEQUENCES_PER_PASS and _same_grid(images[group[0]], image):
+                    group.append(name)
+                    break
+            else:
+                groups.append([name])
+        
+        resampled = {}
+        with profile_step("resample_sequences"):
+            for group in groups:
+                source = images[group[0]]
+                if len(group) == 1:
+                    pixel_type = self.ImageType
+                    stack = source
+                else:
+                    pixel_type = itk.Image[itk.Vector[self.PixelType, len(group)], self.Dimension]
+                    channels = [itk.GetArrayViewFromImage(images[name]) for name in group]
+                    stack = itk.image_from_array(np.stack(channels, axis=-1), ttype=pixel_type)
+                    stack.SetOrigin(source.GetOrigin())
+                    stack.SetSpacing(source.GetSpacing())
+                    stack.SetDirection(source.GetDirection())
+                
+                resampler = itk.ResampleImageFilter[pixel_type, pixel_type].New()
+                resampler.SetInput(stack)
+                resampler.SetTransform(transform)
+                resampler.SetOutputParametersFromImage(reference_image)
+                resampler.SetDefaultPixelValue(0)
+                resampler.Update()
+                
+                if len(group) == 1:
+                    resampled[group[0]] = resampler.GetOutput()
+                    continue
+                array = itk.GetArrayViewFromImage(resampler.GetOutput())
+                for i, name in enumerate(group):
+                    image = itk.GetImageFromArray(np.ascontiguousarray(array[..., i]))
+                    image.CopyInformation(reference_image)
+                    resampled[name] = image
+        return {name: resampled[name] for name in images}
+    
+    def align_visit(self, images, reference):
+        """Sequences of one visit on the grid of its ``reference`` sequence.
+        
+        Sequences acquired in one session share the scanner coordinates, so
+        those on another grid are resampled with the identity transform.
+        Returns (images, names of the resampled sequences).
+        """
+        images = {
+            name: self.load_image(image) if isinstance(image, (str, Path)) else image
+            for name, image in images.items()
+        }
+        reference_image = images[reference]
+        off_grid = {name: image for name, image in images.items() if not _same_grid(image, reference_image)}
+        if off_grid:
+            identity = itk.IdentityTransform[itk.D, self.Dimension].New()
+            images.update(self.resample_sequences(off_grid, identity, reference_image))
+        return images, list(off_grid)
+    
+    def register_sequences(self, fixed_paths, moving_paths, reference, output_paths=None,
+                           fixed_output_paths=None, multistart=False, workers=None):
+        """Register a multi-sequence follow-up visit to the baseline visit.
+        
+        ``fixed_paths`` and ``moving_paths`` map sequence names (e.g. 'gre',
+        't1c', 'flair') to files. Only the ``reference`` sequences are
+        registered (with register_multistart() if ``multistart``), so the
+        cost does not grow with the number of sequences. The transform then
+        brings every follow-up sequence onto the baseline reference grid
+        through resample_sequences(). Baseline sequences off that grid are
+        aligned with align_visit(). Follow-up outputs go to
+        ``output_paths[name]`` and resampled baseline sequences to
+        ``fixed_output_paths[name]``.
+        
+        Returns (baseline, follow-up, transform), the first two being dicts
+        of images. When the registration fails the transform is None and the
+        follow-up sequences are only aligned on their own reference grid.
+        """
+        output_paths = output_paths or {}
+        fixed_output_paths = fixed_output_paths or {}
+        
+        with profile_step("load"):
+            baseline, resampled = self.align_visit(fixed_paths, reference)
+            moving_images = {name: self.load_image(path) for name, path in moving_paths.items()}
+        if multistart:
+            # Workers read the reference images themselves
+            _, transform = self.register_multistart(
+                fixed_paths[reference], moving_paths[reference], workers=workers
+            )
+        else:
+            _, transform = self.register_images(baseline[reference], moving_images[reference], resample=False)
+        
+        if transform is None:
+            followup, _ = self.align_visit(moving_images, reference)
+        else:
+            followup = self.resample_sequences(moving_images, transform, baseline[reference])
+        
+        with profile_step("write"):
+            for name in resampled:
+                if name in fixed_output_paths:
+                    write_image(baseline[name], fixed_output_paths[name], self.ImageType)
+            if transform is not None:
+                for name, image in followup.items():
+                    if name in output_paths:
+                        write_image(image, output_paths[name], self.ImageType)
+        return baseline, followup, transform
+    
+    def pyramid_level(self, image, shrink_factor):
+        """An image at one level of the registration pyramid: smoothed as the
+        level is in register_images(), then downsampled by shrink_factor"""
+        if shrink_factor not in PYRAMID_SHRINK_FACTORS:
+            raise ValueError(f"Shrink factor must be one of {PYRAMID_SHRINK_FACTORS}")
+        sigma = PYRAMID_SMOOTHING_SIGMAS[PYRAMID_SHRINK_FACTORS.index(shrink_factor)]
+        if shrink_factor == 1:
+            return image
+        
+        smoother = itk.DiscreteGaussianImageFilter[self.ImageType, self.ImageType].New()
+        smoother.SetInput(image)
+        smoother.SetVariance(sigma ** 2)
+        smoother.SetUseImageSpacing(True)
+        smoother.SetMaximumError(0.01)
+        shrinker = itk.ShrinkImageFilter[self.ImageType, self.ImageType].New()
+        shrinker.SetInput(smoother.GetOutput())
+        shrinker.SetShrinkFactors(shrink_factor)
+        shrinker.Update()
+        return shrinker.GetOutput()
+    
+    def register_preview(self, fixed_image_path, moving_image_path, shrink_factor=2):
+        """Quick-look registration on one coarse pyramid level only.
+
+        Returns the coarse fixed image, the coarse moving image resampled
+        onto it, and the transform (None when registration failed).
+        """
+        with profile_step("load"):
+            fixed_image = self.load_image(fixed_image_path)
+            moving_image = self.load_image(moving_image_path)
+        
+        with profile_step("pyramid"):
+            fixed_level = self.pyramid_level(fixed_image, shrink_factor)
+            moving_level = self.pyramid_level(moving_image, shrink_factor)
+        
+        # The images are already smoothed and shrunk: a single level at full rate
+        registration = self._create_registration(
+            fixed_level, moving_level, [1], [0.0],
+            sampling_percentage=PREVIEW_SAMPLING_PERCENTAGE, iterations=PREVIEW_ITERATIONS
+        )
         try:
-            registration.Update()
-            final_transform = registration.GetTransform()
-            
-            # Apply transform to moving image
+            with profile_step("optimize"):
+                registration.Update()
+            transform = registration.GetTransform()
+        except Exception as e:
+            print(f"Preview registration failed: {e}")
+            transform = None
+        
+        with profile_step("resample"):
             resampler = itk.ResampleImageFilter[self.ImageType, self.ImageType].New()
-            resampler.SetInput(moving_image)
-            resampler.SetTransform(final_transform)
+            resampler.SetInput(moving_level)
+            if transform is not None:
+                resampler.SetTransform(transform)
             resampler.SetUseReferenceImage(True)
-            resampler.SetReferenceImage(fixed_image)
+            resampler.SetReferenceImage(fixed_level)
             resampler.SetDefaultPixelValue(0)
             resampler.Update()
+        
+        return fixed_level, resampler.GetOutput(), transform
+    
+    def assess_registration(self, fixed_image, registered_image, sample_fraction=QA_SAMPLE_FRACTION,
+                            thresholds=None, seed=0):
+        """Cheap alignment check on a random sample of voxels.
+
+        Compares the fixed image with the moving image resampled onto its
+        grid (register_images() output): normalized cross-correlation,
+        mutual information from a joint histogram, and the Dice of the two
+        foreground masks (Otsu threshold of each image), all on the same
+        ``sample_fraction`` of the voxels. The alignment is ``suspect`` when
+        a metric falls below its threshold (QA_THRESHOLDS); ``reasons`` lists
+        which ones.
+        """
+        thresholds = dict(QA_THRESHOLDS, **(thresholds or {}))
+        if isinstance(fixed_image, (str, Path)):
+            fixed_image = self.load_image(fixed_image)
+        if isinstance(registered_image, (str, Path)):
+            registered_image = self.load_image(registered_image)
+        fixed_array = itk.GetArrayViewFromImage(fixed_image).ravel()
+        registered_array = itk.GetArrayViewFromImage(registered_image).ravel()
+        if fixed_array.shape != registered_array.shape:
+            raise ValueError("The registered image must be on the fixed image grid")
+        
+        with profile_step("registration_qa"):
+            rng = np.random.default_rng(seed)
+            samples = rng.integers(0, fixed_array.size, max(1000, int(fixed_array.size * sample_fraction)))
+            a = fixed_array[samples].astype(np.float64)
+            b = registered_array[samples].astype(np.float64)
             
-            registered_image = resampler.GetOutput()
+            ncc = float(np.corrcoef(a, b)[0, 1]) if a.std() > 0 and b.std() > 0 else 0.0
             
-            if output_path:
-                writer = itk.ImageFileWriter[self.ImageType].New()
-                writer.SetFileName(str(output_path))
-                writer.SetInput(registered_image)
-                writer.Update()
+            joint, _, _ = np.histogram2d(a, b, bins=QA_HISTOGRAM_BINS)
+            p = joint / joint.sum()
             
-            return registered_image, final_transform
+            def entropy(q):
+                q = q[q > 0]
+                return float(-np.sum(q * np.log(q)))
             
-        except Exception as e:
-            print(f"Registration failed: {e}")
-            return moving_image, None
+            h_joint = entropy(p)
+            h_fixed, h_registered = entropy(p.sum(axis=1)), entropy(p.sum(axis=0))
+            mutual_information = h_fixed + h_registered - h_joint
+            normalized_mi = (h_fixed + h_registered) / h_joint if h_joint > 0 else 1.0
+            
+            # Dice over the samples estimates the Dice of the full masks
+            mask_a = a > _otsu_threshold(a)
+            mask_b = b > _otsu_threshold(b)
+            total = np.count_nonzero(mask_a) + np.count_nonzero(mask_b)
+            mask_dice = float(2.0 * np.count_nonzero(mask_a & mask_b) / total) if total else 1.0
+        
+        metrics = {
+            'ncc': ncc,
+            'mutual_information': mutual_information,
+            'normalized_mutual_information': normalized_mi,
+            'mask_dice': mask_dice,
+        }
+        reasons = [
+            f"{name} {metrics[name]:.3f} < {limit}" for name, limit in thresholds.items()
+            if metrics[name] < limit
+        ]
+        return dict(metrics, samples=int(len(samples)), suspect=bool(reasons), reasons=reasons)
     
     def save_transform(self, transform, output_path):
         writer = itk.TransformFileWriterTemplate[itk.D].New()
         writer.SetFileName(str(output_path))
         writer.SetInput(transform)
         writer.Update()
+    
+    def warp_mask(self, mask, transform, reference_image, inverse=False, source_image=None):
+        """Resample a binary mask onto reference_image's grid (nearest neighbour).
+
+        The transform from register_images() maps fixed (baseline) points to
+        moving (follow-up) points, which is what bringing a follow-up mask into
+        baseline space needs. Use inverse=True to carry a baseline mask onto
+        the follow-up's own grid instead. NumPy masks take their geometry from
+        source_image. Returns an unsigned char ITK image.
+        """
+        MaskType = itk.Image[itk.UC, self.Dimension]
+        
+        if isinstance(mask, SparseMask):
+            mask_image = mask.to_itk()
+        else:
+            if isinstance(mask, np.ndarray):
+                if source_image is None:
+                    raise ValueError("source_image is required to warp a NumPy mask")
+                array = mask > 0
+                geometry = source_image
+            else:
+                array = itk.GetArrayViewFromImage(mask) > 0
+                geometry = mask
+            mask_image = itk.GetImageFromArray(array.astype(np.uint8))
+            mask_image.SetOrigin(geometry.GetOrigin())
+            mask_image.SetSpacing(geometry.GetSpacing())
+            mask_image.SetDirection(geometry.GetDirection())
+        
+        if isinstance(reference_image, (str, Path)):
+            reference_image = self.load_image(reference_image)
+        if inverse:
+            transform = transform.GetInverseTransform()
+        
+        with profile_step("warp_mask"):
+            resampler = itk.ResampleImageFilter[MaskType, MaskType].New()
+            resampler.SetInput(mask_image)
+            resampler.SetTransform(transform)
+            resampler.SetInterpolator(itk.NearestNeighborInterpolateImageFunction[MaskType, itk.D].New())
+            resampler.SetOutputParametersFromImage(reference_image)
+            resampler.SetDefaultPixelValue(0)
+            resampler.Update()
+        
+        return resampler.GetOutput()
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+DEFAULT_STORE_PATH = Path("results") / "results.sqlite"
+
+# Run identity: one row per patient, timepoint pair and parameter set
+KEY_COLUMNS = ['patient', 'baseline', 'followup', 'parameter_hash']
+
+# Indexed metric columns: name and where to find it in the compare_tumors results
+METRIC_COLUMNS = {
+    'volume1_mm3': ('tumor1', 'volume_mm3'),
+    'volume2_mm3': ('tumor2', 'volume_mm3'),
+    'volume_change_mm3': ('comparison', 'volume_change_mm3'),
+    'volume_change_percent': ('comparison', 'volume_change_percent'),
+    'dice_coefficient': ('comparison', 'dice_coefficient'),
+    'hausdorff_distance_mm': ('comparison', 'hausdorff_distance_mm'),
+    'grown_mm3': ('comparison', 'change_volumes_mm3', 'grown'),
+    'regressed_mm3': ('comparison', 'change_volumes_mm3', 'regressed'),
+    'stable_mm3': ('comparison', 'change_volumes_mm3', 'stable'),
+    'registration_ncc': ('registration_qa', 'ncc'),
+    'registration_mask_dice': ('registration_qa', 'mask_dice'),
+    'registration_suspect': ('registration_qa', 'suspect'),
+    'registration_retried': ('registration_qa', 'retried'),
+    'wall_time_s': ('profiling', 'total_wall_time_s'),
+}
+
+# Columns a cohort export holds (the full results stay in the database)
+EXPORT_COLUMNS = ['id'] + KEY_COLUMNS + ['created'] + list(METRIC_COLUMNS)
+
+
+def parameter_hash(parameters):
+    """Short, stable hash of a JSON-serializable parameter dict"""
+    text = json.dumps(parameters or {}, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def _lookup(results, path):
+    for key in path:
+        if not isinstance(results, dict) or results.get(key) is None:
+            return None
+        results = results[key]
+    return float(results)
+
+
+class ResultsStore:
+    """Indexed cohort results in a single SQLite file.
+
+    Each run is one row keyed by patient, baseline and follow-up timepoint
+    and the hash of the parameters it ran with; storing the same key again
+    replaces the row. The metrics cohort queries filter on are indexed
+    columns of a compact ``runs`` table; the full compare_tumors results are
+    kept as JSON in a separate table, so scans never read them. The database
+    runs in WAL mode, so readers never block and writers from several
+    processes wait for each other (up to ``timeout`` seconds).
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH, timeout=30.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path), timeout=timeout)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        metrics = ", ".join(f"{name} REAL" for name in METRIC_COLUMNS)
+        with self.connection:
+            self.connection.execute(f"""
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY,
+                    patient TEXT NOT NULL,
+                    baseline TEXT NOT NULL,
+                    followup TEXT NOT NULL,
+                    parameter_hash TEXT NOT NULL,
+                    parameters TEXT,
+                    created REAL NOT NULL,
+                    {metrics},
+                    UNIQUE (patient, baseline, followup, parameter_hash)
+                )
+            """)
+            # Stores created before a metric column existed get it added, empty
+            existing = {row[1] for row in self.connection.execute("PRAGMA table_info(runs)")}
+            for name in METRIC_COLUMNS:
+                if name not in existing:
+                    self.connection.execute(f"ALTER TABLE runs ADD COLUMN {name} REAL")
+            self.connection.execute(f"""
+                CREATE TABLE IF NOT EXISTS run_results (
+                    {', '.join(f'{c} TEXT NOT NULL' for c in KEY_COLUMNS)},
+                    results TEXT,
+                    PRIMARY KEY ({', '.join(KEY_COLUMNS)})
+                ) WITHOUT ROWID
+            """)
+            for column in ('volume_change_percent', 'dice_coefficient', 'created'):
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS runs_{column} ON runs ({column})")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def record(patient, baseline, followup, results, parameters=None):
+        """Row for one run; parameters default to results['parameters']"""
+        if parameters is None:
+            parameters = results.get('parameters', {})
+        row = {
+            'patient': str(patient),
+            'baseline': str(baseline),
+            'followup': str(followup),
+            'parameter_hash': parameter_hash(parameters),
+            'parameters': json.dumps(parameters, sort_keys=True, default=str),
+            'created': time.time(),
+            'results': json.dumps(results, default=str),
+        }
+        for name, path in METRIC_COLUMNS.items():
+            row[name] = _lookup(results, path)
+        return row
+
+    def add(self, patient, baseline, followup, results, parameters=None):
+        return self.add_many([self.record(patient, baseline, followup, results, parameters)])
+
+    def add_many(self, records):
+        """Insert or replace rows from record() in one transaction; returns their count"""
+        if not records:
+            return 0
+        columns = [c for c in records[0] if c != 'results']
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns if c not in KEY_COLUMNS)
+        statement = (
+            f"INSERT INTO runs ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT ({', '.join(KEY_COLUMNS)}) DO UPDATE SET {updates}"
+        )
+        results_columns = KEY_COLUMNS + ['results']
+        results_statement = (
+            f"INSERT OR REPLACE INTO run_results ({', '.join(results_columns)}) "
+            f"VALUES ({', '.join('?' * len(results_columns))})"
+        )
+        with self.connection:
+            self.connection.executemany(statement, [[r[c] for c in columns] for r in records])
+            self.connection.executemany(results_statement, [[r[c] for c in results_columns] for r in records])
+        return len(records)
+
+    def query(self, where=None, params=(), order_by='id', with_results=False):
+        """Rows matching an SQL condition on the run columns, as dicts.
+
+        For example ``query("volume_change_percent > ? AND dice_coefficient < ?",
+        (10, 0.3))``. Parameters and full results are only loaded with
+        ``with_results``.
+        """
+        columns = ", ".join(f"runs.{c}" for c in EXPORT_COLUMNS)
+        statement = f"SELECT {columns} FROM runs"
+        if with_results:
+            statement = (
+                f"SELECT {columns}, runs.parameters, run_results.results FROM runs "
+                f"LEFT JOIN run_results USING ({', '.join(KEY_COLUMNS)})"
+            )
+        if where:
+            statement += f" WHERE {where}"
+        if order_by:
+            statement += f" ORDER BY {order_by}"
+        rows = [dict(row) for row in self.connection.execute(statement, params)]
+        if with_results:
+            for row in rows:
+                row['parameters'] = json.loads(row['parameters']) if row['parameters'] else {}
+                row['results'] = json.loads(row['results']) if row['results'] else None
+        return rows
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def columns(self, where=None, params=()):
+        """Export columns of the matching rows as NumPy arrays"""
+        statement = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM runs"
+        if where:
+            statement += f" WHERE {where}"
+        rows = self.connection.execute(statement + " ORDER BY id", params).fetchall()
+        data = {}
+        for i, name in enumerate(EXPORT_COLUMNS):
+            values = [row[i] for row in rows]
+            if name in KEY_COLUMNS:
+                data[name] = np.array(values, dtype=str)
+            elif name == 'id':
+                data[name] = np.array(values, dtype=np.int64)
+            else:
+                data[name] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        return data
+
+    def export(self, path, where=None, params=()):
+        """Write the export columns to a columnar file: .parquet (needs pyarrow) or .npz"""
+        path = Path(path)
+        data = self.columns(where, params)
+        if path.suffix == '.parquet':
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError("Parquet export needs pyarrow (pip install pyarrow); use .npz instead") from None
+            pyarrow.parquet.write_table(pyarrow.table(data), path)
+        elif path.suffix == '.npz':
+            np.savez_compressed(path, **data)
+        else:
+            raise ValueError(f"Unsupported export format: {path.suffix} (use .parquet or .npz)")
+        return path
+
+
+def read_columns(path):
+    """Columns of an export() file as a dict of NumPy arrays"""
+    path = Path(path)
+    if path.suffix == '.parquet':
+        import pyarrow.parquet
+
+        table = pyarrow.parquet.read_table(path)
+        return {name: table.column(name).to_numpy() for name in table.column_names}
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
@@ -3,213 +3,751 @@ import numpy as np
 from pathlib import Path
 import scipy.ndimage as ndi
 
+from storage import read_image, write_image
+from sparse_mask import SparseMask
+from profiling import profile_step
+import parallel_filters
+
+
+# Tumor detection settings of segment_tumor_automatic
+DEFAULT_TUMOR_PARAMETERS = {
+    'std_factor': 3.0,            # threshold = brain mean + std_factor * std ...
+    'percentile': 99.5,           # ... or this inner-brain percentile, if higher
+    'min_size': 20,               # component size limits in voxels
+    'max_size': 2000,
+    'min_aspect_ratio': 0.4,      # shortest / longest bounding-box side
+    'min_compactness': 0.1,       # voxels / bounding-box volume
+    'max_center_distance': 0.7,   # fraction of the brain radius
+}
+
+# Default lower bound of the component tree, in inner-brain standard deviations
+TREE_STD_FACTOR = 2.0
+
+# Margin around the inner-brain bounding box, wider than the 2x2x2 refinement reach
+ROI_MARGIN = 3
+
+
+def expand_parameter_grid(parameter_grid):
+    """List of parameter dicts from a {name: values} grid or a list of dicts"""
+    import itertools
+    
+    if isinstance(parameter_grid, dict):
+        names = list(parameter_grid)
+        return [dict(zip(names, values))
+                for values in itertools.product(*(parameter_grid[n] for n in names))]
+    return [dict(p) for p in parameter_grid]
+
+
+def mask_to_array(mask, shape=None):
+    """Boolean (z, y, x) array from a NumPy array, ITK image or SparseMask"""
+    if isinstance(mask, SparseMask):
+        array = mask.to_array() > 0
+    elif isinstance(mask, np.ndarray):
+        array = mask > 0
+    else:
+        array = itk.GetArrayViewFromImage(mask) > 0
+    if shape is not None and array.shape != tuple(shape):
+        raise ValueError(f"Mask shape {array.shape} does not match image shape {tuple(shape)}")
+    return array
+
 
 class TumorSegmentation:
-    def __init__(self):
+    def __init__(self, workers=None, shrink_factor=1, smoothing_sigma=None):
         self.PixelType = itk.F
         self.Dimension = 3
         self.ImageType = itk.Image[self.PixelType, self.Dimension]
+        # Threads for smoothing and morphology (None = one per CPU)
+        self.workers = workers
+        # Images downsampled by this factor (preview): voxel-based sizes shrink with it
+        self.shrink_factor = shrink_factor
+        # Gaussian sigma in voxels of the processed image
+        self.smoothing_sigma = 1.5 / shrink_factor if smoothing_sigma is None else smoothing_sigma
         
     def load_image(self, image_path):
-        reader = itk.ImageFileReader[self.ImageType].New()
-        reader.SetFileName(str(image_path))
-        reader.Update()
-        return reader.GetOutput()
+        if not isinstance(image_path, (str, Path)):
+            return image_path
+        return read_image(image_path, self.ImageType)
     
-    def segment_tumor_automatic(self, image_path, output_path=None):
-        image = self.load_image(image_path)
+    def _structure(self, size):
+        """Cubic structuring element of size voxels at full resolution (kept odd when shrunk)"""
+        if self.shrink_factor != 1:
+            size = 2 * int((size - 1) / (2 * self.shrink_factor) + 0.5) + 1
+        return np.ones((size,) * 3)
+    
+    def segment_tumor_automatic(self, image_path, output_path=None, sparse=False, parameters=None,
+                                brain_masks=None, refine_brain_mask=False, return_brain_masks=False):
+        """Segment tumors; see prepare_segmentation() for reusing brain masks.
+
+        With ``return_brain_masks`` also returns the brain and inner-brain
+        masks used, ready to pass as ``brain_masks`` for a registered scan.
+        """
+        state = self.prepare_segmentation(image_path, brain_masks, refine_brain_mask)
+        
+        if return_brain_masks:
+            masks = {'brain_mask': state['brain_mask'], 'inner_brain_mask': state['inner_brain_mask']}
+            return self.segment_prepared(state, output_path, sparse, parameters), masks
+        return self.segment_prepared(state, output_path, sparse, parameters)
+    
+    def segment_prepared(self, state, output_path=None, sparse=False, parameters=None):
+        """Tumor mask of a prepare_segmentation() state for one parameter setting"""
+        image = state['image']
         
-        # Convert to numpy for processing
-        image_array = itk.GetArrayFromImage(image)
+        # Step 3: Tumor detection using statistical outlier analysis
+        if state['inner_voxel_count'] == 0:
+            print("Error: No valid brain tissue found")
+            # Return empty mask
+            mask_image = itk.GetImageFromArray(np.zeros(state['shape'], dtype=np.uint8))
+            mask_image.SetOrigin(image.GetOrigin())
+            mask_image.SetSpacing(image.GetSpacing())
+            mask_image.SetDirection(image.GetDirection())
+            if sparse:
+                mask_image = SparseMask.from_itk(mask_image)
+            
+            if output_path:
+                with profile_step("write"):
+                    write_image(mask_image, output_path, itk.Image[itk.UC, self.Dimension])
+            return mask_image
+        
+        roi_mask, detection = self.detect_tumors(state, parameters)
+        print(f"Brain mean: {state['brain_mean']:.1f}, std: {state['brain_std']:.1f}")
+        print(f"Tumor threshold: {detection['threshold']:.1f}")
+        print(f"Detected {detection['num_tumors']} validated tumor regions")
+        
+        if sparse:
+            # Keep only the bounding box of the detected regions
+            sparse_mask = self._sparse_from_roi(state, roi_mask)
+            if output_path:
+                with profile_step("write"):
+                    write_image(sparse_mask, output_path, itk.Image[itk.UC, self.Dimension])
+            return sparse_mask
+        
+        # Convert back to ITK image
+        final_mask = np.zeros(state['shape'], dtype=np.uint8)
+        final_mask[state['roi']] = roi_mask
+        mask_image = itk.GetImageFromArray(final_mask)
+        mask_image.SetOrigin(image.GetOrigin())
+        mask_image.SetSpacing(image.GetSpacing())
+        mask_image.SetDirection(image.GetDirection())
+        
+        if output_path:
+            with profile_step("write"):
+                write_image(mask_image, output_path, itk.Image[itk.UC, self.Dimension])
+        
+        return mask_image
+    
+    def prepare_segmentation(self, image_path, brain_masks=None, refine_brain_mask=False):
+        """Smoothing, skull stripping and brain statistics shared by every tumor threshold.
+
+        ``brain_masks`` skips the skull stripping: a dict with a
+        ``brain_mask`` and optionally an ``inner_brain_mask`` (NumPy arrays,
+        ITK images or SparseMasks on this image's grid), e.g. the masks of
+        the baseline for a follow-up registered into baseline space, or
+        masks warped with ImageRegistration.warp_mask(). With
+        ``refine_brain_mask`` voxels that are background in this image are
+        removed from them.
+
+        Returns a dict with the smoothed volume, the brain and inner-brain
+        masks, the inner-brain intensity statistics, the brain centre and
+        radius used by the location check, and ``roi``: the inner-brain
+        bounding box (plus a margin for the final refinement), outside of
+        which no tumor can be detected.
+        """
+        with profile_step("load"):
+            image = self.load_image(image_path)
+        
+            # Convert to numpy for processing
+            image_array = itk.GetArrayFromImage(image)
         
         # Preprocessing: Gaussian smoothing
-        smoothed = ndi.gaussian_filter(image_array, sigma=1.5)
+        with profile_step("smooth"):
+            smoothed = parallel_filters.gaussian_filter(image_array, sigma=self.smoothing_sigma, workers=self.workers)
+        
+        if brain_masks is None:
+            brain_mask = self._extract_brain(smoothed)
+            inner_brain_mask = self._erode_brain(brain_mask)
+        else:
+            # Reuse masks already in this image's space (e.g. from the baseline scan)
+            with profile_step("reuse_brain_mask"):
+                brain_mask = mask_to_array(brain_masks['brain_mask'], smoothed.shape)
+                inner_brain_mask = brain_masks.get('inner_brain_mask')
+                if inner_brain_mask is not None:
+                    inner_brain_mask = mask_to_array(inner_brain_mask, smoothed.shape)
+            if inner_brain_mask is None:
+                inner_brain_mask = self._erode_brain(brain_mask)
+            
+            if refine_brain_mask:
+                # Cheap refinement: drop voxels that are background in this scan
+                # (misregistration pushing the mask over air)
+                with profile_step("refine_brain_mask"):
+                    foreground = smoothed > np.percentile(smoothed[smoothed > 0], 5)
+                    brain_mask = brain_mask & foreground
+                    inner_brain_mask = inner_brain_mask & foreground
+        
+        state = {
+            'image': image,
+            'shape': image_array.shape,
+            'smoothed': smoothed,
+            'brain_mask': brain_mask,
+            'inner_brain_mask': inner_brain_mask,
+            'inner_voxel_count': int(np.sum(inner_brain_mask)),
+        }
+        if state['inner_voxel_count'] == 0:
+            return state
+        
+        with profile_step("brain_statistics"):
+            brain_intensities = smoothed[inner_brain_mask]
+            state['brain_intensities'] = brain_intensities
+            state['brain_mean'] = np.mean(brain_intensities)
+            state['brain_std'] = np.std(brain_intensities)
+        
+            # Brain centre and radius estimate for the location check
+            brain_coords = np.where(brain_mask)
+            state['brain_center'] = tuple(np.mean(c) for c in brain_coords)
+            brain_ranges = [c.max() - c.min() for c in brain_coords]
+            state['brain_radius'] = np.mean(brain_ranges) / 3
+        
+            # Candidates lie inside the inner brain; the margin keeps the 2x2x2
+            # refinement identical to running it on the full volume
+            inner_box = ndi.find_objects(inner_brain_mask.astype(np.uint8))[0]
+            state['roi'] = tuple(
+                slice(max(0, s.start - ROI_MARGIN), min(n, s.stop + ROI_MARGIN))
+                for s, n in zip(inner_box, image_array.shape)
+            )
         
+        return state
+    
+    def _extract_brain(self, smoothed):
+        """Skull stripping: intensity band, opening/closing, hole filling, largest component"""
         # Step 1: Advanced brain extraction with skull stripping
         # Remove background (air/noise)
-        background_mask = smoothed > np.percentile(smoothed[smoothed > 0], 5)
+        with profile_step("brain_thresholds"):
+            background_mask = smoothed > np.percentile(smoothed[smoothed > 0], 5)
         
-        # Detect skull using very high intensity threshold (top 1% of foreground)
-        foreground_intensities = smoothed[background_mask]
-        skull_threshold = np.percentile(foreground_intensities, 99)
-        skull_mask = smoothed > skull_threshold
+            # Detect skull using very high intensity threshold (top 1% of foreground)
+            foreground_intensities = smoothed[background_mask]
+            skull_threshold = np.percentile(foreground_intensities, 99)
+            skull_mask = smoothed > skull_threshold
         
-        # Brain tissue detection using histogram analysis
-        # Brain tissue typically has intermediate intensities
-        brain_low = np.percentile(foreground_intensities, 15)
-        brain_high = np.percentile(foreground_intensities, 85)
+            # Brain tissue detection using histogram analysis
+            # Brain tissue typically has intermediate intensities
+            brain_low = np.percentile(foreground_intensities, 15)
+            brain_high = np.percentile(foreground_intensities, 85)
         
-        # Initial brain mask: intermediate intensities, no skull
-        potential_brain = (smoothed >= brain_low) & (smoothed <= brain_high) & ~skull_mask
+            # Initial brain mask: intermediate intensities, no skull
+            potential_brain = (smoothed >= brain_low) & (smoothed <= brain_high) & ~skull_mask
         
         # Morphological operations to get clean brain region
-        from scipy.ndimage import binary_opening, binary_closing, binary_fill_holes, label, binary_erosion, binary_dilation
+        with profile_step("morphology"):
+            from scipy.ndimage import binary_fill_holes, label
         
-        # Clean up the brain mask
-        potential_brain = binary_opening(potential_brain, structure=np.ones((3,3,3)))
-        potential_brain = binary_closing(potential_brain, structure=np.ones((7,7,7)))
-        potential_brain = binary_fill_holes(potential_brain)
+            # Clean up the brain mask
+            potential_brain = parallel_filters.binary_opening(potential_brain, self._structure(3), self.workers)
+            potential_brain = parallel_filters.binary_closing(potential_brain, self._structure(7), self.workers)
+            potential_brain = binary_fill_holes(potential_brain)
         
         # Keep largest connected component (main brain)
-        labeled_brain, num_brain = label(potential_brain)
-        if num_brain > 0:
-            brain_sizes = [np.sum(labeled_brain == i) for i in range(1, num_brain + 1)]
-            largest_brain = np.argmax(brain_sizes) + 1
-            brain_mask = labeled_brain == largest_brain
-        else:
-            print("Warning: No brain tissue detected")
-            brain_mask = potential_brain
-        
+        with profile_step("brain_labeling"):
+            labeled_brain, num_brain = label(potential_brain)
+            if num_brain > 0:
+                brain_sizes = np.bincount(labeled_brain.ravel())[1:]
+                largest_brain = np.argmax(brain_sizes) + 1
+                brain_mask = labeled_brain == largest_brain
+            else:
+                print("Warning: No brain tissue detected")
+                brain_mask = potential_brain
+        
+        return brain_mask
+    
+    def _erode_brain(self, brain_mask):
         # Step 2: Aggressive skull stripping - erode deeply into brain
         # Use multiple erosion steps to ensure we're well inside brain tissue
-        inner_brain_mask = binary_erosion(brain_mask, structure=np.ones((9,9,9)))
-        
-        # If erosion is too aggressive, use smaller kernel
-        if np.sum(inner_brain_mask) < 0.1 * np.sum(brain_mask):
-            inner_brain_mask = binary_erosion(brain_mask, structure=np.ones((5,5,5)))
+        with profile_step("erosion"):
+            inner_brain_mask = parallel_filters.binary_erosion(brain_mask, self._structure(9), self.workers)
         
-        # Final safety check
-        if np.sum(inner_brain_mask) == 0:
-            print("Warning: Brain mask too restrictive, using moderate erosion")
-            inner_brain_mask = binary_erosion(brain_mask, structure=np.ones((3,3,3)))
+            # If erosion is too aggressive, use smaller kernel
+            if np.sum(inner_brain_mask) < 0.1 * np.sum(brain_mask):
+                inner_brain_mask = parallel_filters.binary_erosion(brain_mask, self._structure(5), self.workers)
         
-        # Step 3: Tumor detection using statistical outlier analysis
-        if np.sum(inner_brain_mask) == 0:
-            print("Error: No valid brain tissue found")
-            # Return empty mask
-            mask_image = itk.GetImageFromArray(np.zeros_like(image_array, dtype=np.uint8))
-            mask_image.SetOrigin(image.GetOrigin())
-            mask_image.SetSpacing(image.GetSpacing())
-            mask_image.SetDirection(image.GetDirection())
-            
-            if output_path:
-                writer = itk.ImageFileWriter[itk.Image[itk.UC, self.Dimension]].New()
-                writer.SetFileName(str(output_path))
-                writer.SetInput(mask_image)
-                writer.Update()
-            return mask_image
+            # Final safety check
+            if np.sum(inner_brain_mask) == 0:
+                print("Warning: Brain mask too restrictive, using moderate erosion")
+                inner_brain_mask = parallel_filters.binary_erosion(brain_mask, self._structure(3), self.workers)
         
-        brain_intensities = smoothed[inner_brain_mask]
-        brain_mean = np.mean(brain_intensities)
-        brain_std = np.std(brain_intensities)
+        return inner_brain_mask
+    
+    def detect_tumors(self, state, parameters=None, tree=None):
+        """Threshold, label and filter tumor candidates for one parameter setting.
+
+        Works on the ROI of a prepare_segmentation() state, which it does not
+        modify, so settings can be evaluated concurrently. With a component
+        tree from build_component_tree(), components are looked up in the
+        tree instead of labeled (thresholds below the tree minimum fall back
+        to labeling). Returns the boolean tumor mask over ``state['roi']``
+        and a dict with the threshold and number of validated regions.
+        """
+        params = self._tumor_parameters(parameters)
+        
+        with profile_step("tumor_threshold"):
+            final_threshold = self._tumor_threshold(state, params)
+        
+        if tree is not None and final_threshold >= tree.min_threshold:
+            # Step 4: size, shape and location filtering on the tree attributes
+            with profile_step("tree_query"):
+                nodes = tree.select(
+                    final_threshold,
+                    min_size=params['min_size'],
+                    max_size=params['max_size'],
+                    min_aspect_ratio=params['min_aspect_ratio'],
+                    min_compactness=params['min_compactness'],
+                    center=state['brain_center'],
+                    max_distance=params['max_center_distance'] * state['brain_radius'],
+                )
+                final_mask = tree.mask(final_threshold, nodes)
+                valid_tumors = len(nodes)
+        else:
+            final_mask, valid_tumors = self._label_and_filter(state, params, final_threshold)
         
-        # Very conservative tumor detection: 3 standard deviations above mean
+        # Step 5: Final morphological refinement
+        with profile_step("refinement"):
+            if np.any(final_mask):
+                # Light smoothing to remove jagged edges, on the detected regions'
+                # bounding box plus the same margin as the ROI
+                box = ndi.find_objects(final_mask.astype(np.uint8))[0]
+                box = tuple(
+                    slice(max(0, b.start - ROI_MARGIN), min(n, b.stop + ROI_MARGIN))
+                    for b, n in zip(box, final_mask.shape)
+                )
+                refined = ndi.binary_closing(final_mask[box], structure=np.ones((2,2,2)))
+                refined = ndi.binary_opening(refined, structure=np.ones((2,2,2)))
+                final_mask[box] = refined
+        
+        return final_mask, {'threshold': float(final_threshold), 'num_tumors': valid_tumors}
+    
+    def _tumor_parameters(self, parameters):
+        params = dict(DEFAULT_TUMOR_PARAMETERS)
+        if parameters:
+            unknown = set(parameters) - set(params)
+            if unknown:
+                raise ValueError(f"Unknown tumor parameters: {sorted(unknown)}")
+            params.update(parameters)
+        if self.shrink_factor != 1:
+            # Component sizes are voxel counts
+            voxels = self.shrink_factor ** 3
+            params['min_size'] = max(1, params['min_size'] / voxels)
+            params['max_size'] = params['max_size'] / voxels
+        return params
+    
+    def _tumor_threshold(self, state, params):
+        # Very conservative tumor detection: N standard deviations above mean
         # This should only catch truly abnormal tissue
-        tumor_threshold = brain_mean + 3.0 * brain_std
+        tumor_threshold = state['brain_mean'] + params['std_factor'] * state['brain_std']
         
-        # Also use top 0.5% of brain intensities as alternative threshold
-        percentile_threshold = np.percentile(brain_intensities, 99.5)
+        # Also use top percentile of brain intensities as alternative threshold
+        percentile_threshold = np.percentile(state['brain_intensities'], params['percentile'])
         
         # Use the more conservative (higher) threshold
-        final_threshold = max(tumor_threshold, percentile_threshold)
-        
-        print(f"Brain mean: {brain_mean:.1f}, std: {brain_std:.1f}")
-        print(f"Tumor threshold: {final_threshold:.1f}")
+        return max(tumor_threshold, percentile_threshold)
+    
+    def build_component_tree(self, state, min_threshold=None):
+        """Component tree of the inner-brain ROI for instant threshold queries.
+
+        Covers every threshold from ``min_threshold`` up (default: brain
+        mean + TREE_STD_FACTOR standard deviations, the lowest threshold a
+        setting with that std_factor can produce).
+        """
+        from component_tree import ComponentTree
+        
+        if min_threshold is None:
+            min_threshold = state['brain_mean'] + TREE_STD_FACTOR * state['brain_std']
+        roi = state['roi']
+        with profile_step("component_tree"):
+            return ComponentTree(
+                state['smoothed'][roi], state['inner_brain_mask'][roi], min_threshold,
+                offset=[s.start for s in roi]
+            )
+    
+    def _label_and_filter(self, state, params, final_threshold):
+        roi = state['roi']
+        roi_offset = [s.start for s in roi]
         
-        # Apply tumor detection only within deeply eroded brain mask
-        tumor_candidates = (smoothed > final_threshold) & inner_brain_mask
+        with profile_step("tumor_candidates"):
+            # Apply tumor detection only within deeply eroded brain mask
+            tumor_candidates = (state['smoothed'][roi] > final_threshold) & state['inner_brain_mask'][roi]
         
         # Step 4: Very strict size and shape filtering
-        labeled_tumors, num_features = label(tumor_candidates)
+        with profile_step("labeling"):
+            labeled_tumors, num_features = ndi.label(tumor_candidates)
+            component_sizes = np.bincount(labeled_tumors.ravel(), minlength=num_features + 1)
+            component_boxes = ndi.find_objects(labeled_tumors)
         
         # Realistic tumor size constraints
-        min_tumor_size = 20    # Minimum meaningful tumor size
-        max_tumor_size = 2000  # Maximum realistic tumor size
-        final_mask = np.zeros_like(labeled_tumors, dtype=bool)
-        
-        valid_tumors = 0
-        for i in range(1, num_features + 1):
-            component = labeled_tumors == i
-            component_size = np.sum(component)
-            
-            # Size filtering
-            if not (min_tumor_size <= component_size <= max_tumor_size):
-                continue
+        with profile_step("filtering"):
+            final_mask = np.zeros(tumor_candidates.shape, dtype=bool)
+            brain_z_center, brain_y_center, brain_x_center = state['brain_center']
+        
+            valid_tumors = 0
+            for i in range(1, num_features + 1):
+                component_size = component_sizes[i]
             
-            # Shape analysis
-            coords = np.where(component)
-            if len(coords[0]) == 0:
-                continue
-                
-            z_range = coords[0].max() - coords[0].min() + 1
-            y_range = coords[1].max() - coords[1].min() + 1
-            x_range = coords[2].max() - coords[2].min() + 1
+                # Size filtering
+                if not (params['min_size'] <= component_size <= params['max_size']):
+                    continue
             
-            # Avoid very elongated structures (vessels, artifacts)
-            ranges = [z_range, y_range, x_range]
-            max_range = max(ranges)
-            min_range = min(ranges)
+                # Shape analysis
+                box = component_boxes[i - 1]
+                ranges = [s.stop - s.start for s in box]
+                max_range = max(ranges)
+                min_range = min(ranges)
             
-            if max_range == 0:
-                continue
+                if max_range == 0:
+                    continue
                 
-            aspect_ratio = min_range / max_range
-            
-            # Stricter aspect ratio for tumor-like shapes
-            if aspect_ratio < 0.4:
-                continue
+                # Avoid very elongated structures (vessels, artifacts)
+                aspect_ratio = min_range / max_range
+                if aspect_ratio < params['min_aspect_ratio']:
+                    continue
             
-            # Additional compactness check
-            # Tumors should be relatively compact
-            bounding_volume = z_range * y_range * x_range
-            compactness = component_size / bounding_volume if bounding_volume > 0 else 0
+                # Additional compactness check
+                # Tumors should be relatively compact
+                bounding_volume = ranges[0] * ranges[1] * ranges[2]
+                compactness = component_size / bounding_volume if bounding_volume > 0 else 0
+                if compactness < params['min_compactness']:  # Too sparse/elongated
+                    continue
             
-            if compactness < 0.1:  # Too sparse/elongated
-                continue
+                # Check if region is near brain center (avoid peripheral artifacts)
+                component = labeled_tumors[box] == i
+                coords = np.where(component)
+                z_center = np.mean(coords[0] + (box[0].start + roi_offset[0]))
+                y_center = np.mean(coords[1] + (box[1].start + roi_offset[1]))
+                x_center = np.mean(coords[2] + (box[2].start + roi_offset[2]))
             
-            # Check if region is near brain center (avoid peripheral artifacts)
-            z_center = np.mean(coords[0])
-            y_center = np.mean(coords[1])
-            x_center = np.mean(coords[2])
+                # Distance from brain center
+                distance_from_center = np.sqrt(
+                    (z_center - brain_z_center)**2 + 
+                    (y_center - brain_y_center)**2 + 
+                    (x_center - brain_x_center)**2
+                )
             
-            # Get brain bounds
-            brain_coords = np.where(brain_mask)
-            brain_z_center = np.mean(brain_coords[0])
-            brain_y_center = np.mean(brain_coords[1])
-            brain_x_center = np.mean(brain_coords[2])
-            
-            # Distance from brain center
-            distance_from_center = np.sqrt(
-                (z_center - brain_z_center)**2 + 
-                (y_center - brain_y_center)**2 + 
-                (x_center - brain_x_center)**2
-            )
-            
-            # Brain radius estimate
-            brain_z_range = brain_coords[0].max() - brain_coords[0].min()
-            brain_y_range = brain_coords[1].max() - brain_coords[1].min()
-            brain_x_range = brain_coords[2].max() - brain_coords[2].min()
-            brain_radius = np.mean([brain_z_range, brain_y_range, brain_x_range]) / 3
+                # Reject regions too close to brain edge (likely artifacts)
+                if distance_from_center > params['max_center_distance'] * state['brain_radius']:
+                    continue
             
-            # Reject regions too close to brain edge (likely artifacts)
-            if distance_from_center > 0.7 * brain_radius:
-                continue
-            
-            # If all checks pass, add to final mask
-            final_mask |= component
-            valid_tumors += 1
-        
-        print(f"Detected {valid_tumors} validated tumor regions")
-        
-        # Step 5: Final morphological refinement
-        if np.sum(final_mask) > 0:
-            # Light smoothing to remove jagged edges
-            final_mask = binary_closing(final_mask, structure=np.ones((2,2,2)))
-            final_mask = binary_opening(final_mask, structure=np.ones((2,2,2)))
-        
-        # Convert back to ITK image
-        mask_image = itk.GetImageFromArray(final_mask.astype(np.uint8))
-        mask_image.SetOrigin(image.GetOrigin())
-        mask_image.SetSpacing(image.GetSpacing())
-        mask_image.SetDirection(image.GetDirection())
+                # If all checks pass, add to final mask
+                final_mask[box] |= component
+                valid_tumors += 1
         
+        return final_mask, valid_tumors
+    
+    def sweep_parameters(self, image_path, parameter_grid, workers=None, use_tree=True):
+        """Evaluate many tumor-detection settings on one preprocessed image.
+
+        ``parameter_grid`` is either a dict mapping parameter names (see
+        DEFAULT_TUMOR_PARAMETERS) to lists of values, expanded to their
+        Cartesian product, or a list of parameter dicts. Smoothing and skull
+        stripping run once, as does a component tree down to the lowest
+        threshold of the grid (unless use_tree is False); settings are
+        evaluated in a thread pool. Returns one dict per setting with its
+        parameters, threshold, number of tumors, voxel count, volume and a
+        SparseMask.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        
+        settings = expand_parameter_grid(parameter_grid)
+        with profile_step("prepare"):
+            state = self.prepare_segmentation(image_path)
+        
+        tree = None
+        if use_tree and settings and state['inner_voxel_count'] > 0:
+            thresholds = [self._tumor_threshold(state, self._tumor_parameters(p)) for p in settings]
+            tree = self.build_component_tree(state, min(thresholds))
+        
+        def evaluate(parameters):
+            if state['inner_voxel_count'] == 0:
+                roi_mask = np.zeros((0,) * len(state['shape']), dtype=bool)
+                detection = {'threshold': None, 'num_tumors': 0}
+            else:
+                roi_mask, detection = self.detect_tumors(state, parameters, tree)
+            mask = self._sparse_from_roi(state, roi_mask)
+            return {
+                'parameters': dict(DEFAULT_TUMOR_PARAMETERS, **parameters),
+                'threshold': detection['threshold'],
+                'num_tumors': detection['num_tumors'],
+                'voxel_count': mask.voxel_count,
+                'volume_mm3': mask.volume_mm3(),
+                'mask': mask,
+            }
+        
+        with profile_step("sweep"):
+            with ThreadPoolExecutor(max_workers=parallel_filters.resolve_workers(workers)) as pool:
+                return list(pool.map(evaluate, settings))
+    
+    def segment_tumor_streaming(self, source, output_path=None, parameters=None,
+                                slab_depth=None, work_dir=None):
+        """Out-of-core segment_tumor_automatic for volumes larger than memory.
+
+        ``source`` is an image path (raw chunked volumes and MetaImage files
+        are read slab by slab) or a (z, y, x) array or memmap. Every step
+        runs on z-slabs plus the halo its filter needs, with intermediate
+        volumes in disk-backed scratch files under ``work_dir`` (default: the
+        system temporary directory). Percentiles are accumulated exactly in
+        two passes; hole filling and connected components merge the slab
+        labels with union-find. Peak memory is a few slabs, and the mask
+        equals segment_tumor_automatic's up to the rounding of the brain
+        mean and std. Returns a SparseMask, written to output_path if given.
+        """
+        import tempfile
+        from streaming import VolumeSource, STREAMING_SLAB_DEPTH
+
+        params = self._tumor_parameters(parameters)
+        slab_depth = slab_depth or STREAMING_SLAB_DEPTH
+        volume = VolumeSource(source, self.ImageType)
+        geometry = (volume.origin, volume.spacing, volume.direction)
+
+        with tempfile.TemporaryDirectory(prefix="vitk_streaming_", dir=work_dir) as scratch:
+            smoothed, positive = self._stream_smooth(volume, slab_depth, scratch)
+            brain_mask = self._stream_extract_brain(smoothed, positive, slab_depth, scratch)
+            inner_brain_mask = self._stream_erode_brain(brain_mask, slab_depth, scratch)
+            statistics = self._stream_statistics(
+                smoothed, brain_mask, inner_brain_mask, params, slab_depth
+            )
+
+            if statistics is None:
+                print("Error: No valid brain tissue found")
+                mask = SparseMask.from_array(np.zeros((1,) * 3, dtype=bool), *geometry,
+                                             shape=volume.shape)
+            else:
+                print(f"Brain mean: {statistics['brain_mean']:.1f}, std: {statistics['brain_std']:.1f}")
+                print(f"Tumor threshold: {statistics['threshold']:.1f}")
+                crop, offset, num_tumors = self._stream_detect_tumors(
+                    smoothed, inner_brain_mask, statistics, params, slab_depth
+                )
+                print(f"Detected {num_tumors} validated tumor regions")
+                mask = SparseMask.from_array(crop, *geometry, offset=offset, shape=volume.shape)
+
         if output_path:
-            writer = itk.ImageFileWriter[itk.Image[itk.UC, self.Dimension]].New()
-            writer.SetFileName(str(output_path))
-            writer.SetInput(mask_image)
-            writer.Update()
-        
-        return mask_image
+            with profile_step("write"):
+                write_image(mask, output_path, itk.Image[itk.UC, self.Dimension])
+        return mask
+
+    def _stream_smooth(self, volume, slab_depth, scratch):
+        """Smoothed volume on disk, and the positive voxels counted for the background percentile"""
+        from streaming import StreamingPercentiles, iter_slabs, temporary_volume
+
+        with profile_step("smooth"):
+            smoothed = temporary_volume(scratch, "smoothed", volume.shape, np.float32)
+            positive = StreamingPercentiles([5])
+            # Halo of one Gaussian kernel radius (truncate 4)
+            halo = int(4.0 * self.smoothing_sigma + 0.5)
+            for start, stop, low, high in iter_slabs(volume.depth, slab_depth, halo):
+                slab = parallel_filters.gaussian_filter(volume.read(low, high), sigma=self.smoothing_sigma,
+                                                        workers=self.workers)
+                slab = slab[start - low:stop - low]
+                smoothed[start:stop] = slab
+                positive.add(slab[slab > 0])
+        return smoothed, positive
+
+    def _stream_extract_brain(self, smoothed, positive, slab_depth, scratch):
+        """_extract_brain() slab by slab"""
+        from streaming import StreamingPercentiles, SlabLabeler, iter_slabs, temporary_volume
+
+        depth = smoothed.shape[0]
+        with profile_step("brain_thresholds"):
+            for start, stop, _, _ in iter_slabs(depth, slab_depth):
+                slab = smoothed[start:stop]
+                positive.refine(slab[slab > 0])
+            background_threshold = positive.result()[0]
+
+            foreground = StreamingPercentiles([99, 15, 85])
+            for start, stop, _, _ in iter_slabs(depth, slab_depth):
+                slab = smoothed[start:stop]
+                foreground.add(slab[slab > background_threshold])
+            for start, stop, _, _ in iter_slabs(depth, slab_depth):
+                slab = smoothed[start:stop]
+                foreground.refine(slab[slab > background_threshold])
+            skull_threshold, brain_low, brain_high = foreground.result()
+
+        with profile_step("morphology"):
+            potential_brain = temporary_volume(scratch, "potential_brain", smoothed.shape, bool)
+            # Opening and closing each reach twice their radius: the halo covers both
+            opening, closing = self._structure(3), self._structure(7)
+            halo = 2 * (len(opening) // 2) + 2 * (len(closing) // 2)
+            for start, stop, low, high in iter_slabs(depth, slab_depth, halo):
+                slab = smoothed[low:high]
+                candidates = (slab >= brain_low) & (slab <= brain_high) & ~(slab > skull_threshold)
+                candidates = parallel_filters.binary_opening(candidates, opening, self.workers)
+                candidates = parallel_filters.binary_closing(candidates, closing, self.workers)
+                potential_brain[start:stop] = candidates[start - low:stop - low]
+
+            # Holes: background components that do not touch the volume border
+            background = SlabLabeler()
+            for start, stop, _, _ in iter_slabs(depth, slab_depth):
+                labels = background.add(~potential_brain[start:stop], start)
+                background.mark(labels[:, [0, -1], :])
+                background.mark(labels[:, :, [0, -1]])
+                if start == 0:
+                    background.mark(labels[0])
+                if stop == depth:
+                    background.mark(labels[-1])
+            background.finish()
+
+            components = SlabLabeler()
+            for index, (start, stop, _, _) in enumerate(iter_slabs(depth, slab_depth)):
+                slab = np.array(potential_brain[start:stop])
+                labels = background.labels(~slab, index)
+                slab |= (labels > 0) & ~background.touching[labels]
+                potential_brain[start:stop] = slab
+                components.add(slab, start)
+
+        # Keep largest connected component (main brain)
+        with profile_step("brain_labeling"):
+            num_brain = components.finish()
+            brain_mask = temporary_volume(scratch, "brain_mask", smoothed.shape, bool)
+            if num_brain > 0:
+                largest_brain = np.argmax(components.sizes[1:]) + 1
+            else:
+                print("Warning: No brain tissue detected")
+            for index, (start, stop, _, _) in enumerate(iter_slabs(depth, slab_depth)):
+                slab = potential_brain[start:stop]
+                if num_brain > 0:
+                    slab = components.labels(slab, index) == largest_brain
+                brain_mask[start:stop] = slab
+        return brain_mask
+
+    def _stream_erode_brain(self, brain_mask, slab_depth, scratch):
+        """_erode_brain() slab by slab"""
+        from streaming import iter_slabs, temporary_volume
+
+        depth = brain_mask.shape[0]
+        inner_brain_mask = temporary_volume(scratch, "inner_brain_mask", brain_mask.shape, bool)
+
+        def erode(size):
+            structure = self._structure(size)
+            count = 0
+            for start, stop, low, high in iter_slabs(depth, slab_depth, len(structure) // 2):
+                eroded = parallel_filters.binary_erosion(brain_mask[low:high], structure, self.workers)
+                inner_brain_mask[start:stop] = eroded[start - low:stop - low]
+                count += int(np.count_nonzero(eroded[start - low:stop - low]))
+            return count
+
+        with profile_step("erosion"):
+            brain_count = sum(int(np.count_nonzero(brain_mask[start:stop]))
+                              for start, stop, _, _ in iter_slabs(depth, slab_depth))
+            inner_count = erode(9)
+            if inner_count < 0.1 * brain_count:
+                inner_count = erode(5)
+            if inner_count == 0:
+                print("Warning: Brain mask too restrictive, using moderate erosion")
+                erode(3)
+        return inner_brain_mask
+
+    def _stream_statistics(self, smoothed, brain_mask, inner_brain_mask, params, slab_depth):
+        """Brain statistics and tumor threshold; None when the inner brain is empty"""
+        from streaming import StreamingPercentiles, iter_slabs
+
+        depth = smoothed.shape[0]
+        with profile_step("brain_statistics"):
+            percentile = StreamingPercentiles([params['percentile']])
+            count, total = 0, 0.0
+            brain_count = 0
+            brain_sums = np.zeros(3)
+            brain_low = np.full(3, np.iinfo(np.int64).max)
+            brain_high = np.full(3, -1)
+            for start, stop, _, _ in iter_slabs(depth, slab_depth):
+                values = smoothed[start:stop][inner_brain_mask[start:stop]]
+                percentile.add(values)
+                count += len(values)
+                total += float(np.sum(values, dtype=np.float64))
+
+                coords = np.nonzero(brain_mask[start:stop])
+                if len(coords[0]):
+                    coords = (coords[0] + start,) + coords[1:]
+                    brain_count += len(coords[0])
+                    brain_sums += [float(np.sum(c)) for c in coords]
+                    brain_low = np.minimum(brain_low, [c.min() for c in coords])
+                    brain_high = np.maximum(brain_high, [c.max() for c in coords])
+            if count == 0:
+                return None
+
+            mean = total / count
+            squares = 0.0
+            for start, stop, _, _ in iter_slabs(depth, slab_depth):
+                values = smoothed[start:stop][inner_brain_mask[start:stop]]
+                percentile.refine(values)
+                squares += float(np.sum((values.astype(np.float64) - mean) ** 2))
+
+            # Same dtypes as np.mean/np.std on the float32 intensities
+            brain_mean = np.float32(mean)
+            brain_std = np.float32(np.sqrt(squares / count))
+            tumor_threshold = brain_mean + params['std_factor'] * brain_std
+        return {
+            'brain_mean': brain_mean,
+            'brain_std': brain_std,
+            'threshold': max(tumor_threshold, percentile.result()[0]),
+            'brain_center': tuple(brain_sums / brain_count),
+            'brain_radius': np.mean(brain_high - brain_low) / 3,
+        }
+
+    def _stream_detect_tumors(self, smoothed, inner_brain_mask, statistics, params, slab_depth):
+        """Streaming detect_tumors(): (refined mask crop, crop offset, number of tumors)"""
+        from streaming import SlabLabeler, iter_slabs
+
+        depth = smoothed.shape[0]
+        threshold = statistics['threshold']
+
+        def candidates(start, stop):
+            return (smoothed[start:stop] > threshold) & inner_brain_mask[start:stop]
+
+        with profile_step("labeling"):
+            labeler = SlabLabeler(attributes=True)
+            for start, stop, _, _ in iter_slabs(depth, slab_depth):
+                labeler.add(candidates(start, stop), start)
+            num_features = labeler.finish()
+
+        # Same size, shape and location filters as _label_and_filter()
+        with profile_step("filtering"):
+            sizes = labeler.sizes[1:]
+            ranges = labeler.bbox_high[1:] - labeler.bbox_low[1:] + 1
+            keep = (sizes >= params['min_size']) & (sizes <= params['max_size'])
+            keep &= ranges.min(axis=1) / ranges.max(axis=1) >= params['min_aspect_ratio']
+            keep &= sizes / np.prod(ranges, axis=1) >= params['min_compactness']
+            offsets = labeler.coord_sums[1:] / sizes[:, None] - np.array(statistics['brain_center'])
+            distance = np.sqrt(offsets[:, 0]**2 + offsets[:, 1]**2 + offsets[:, 2]**2)
+            keep &= distance <= params['max_center_distance'] * statistics['brain_radius']
+            selected = np.flatnonzero(keep) + 1
+
+        if len(selected) == 0:
+            return np.zeros((1,) * 3, dtype=bool), (0, 0, 0), 0
+
+        # Step 5: Final morphological refinement, on the bounding box of the tumors
+        with profile_step("refinement"):
+            low = labeler.bbox_low[selected].min(axis=0)
+            high = labeler.bbox_high[selected].max(axis=0) + 1
+            box = tuple(
+                slice(max(0, int(l) - ROI_MARGIN), min(n, int(h) + ROI_MARGIN))
+                for l, h, n in zip(low, high, smoothed.shape)
+            )
+            crop = np.zeros(tuple(b.stop - b.start for b in box), dtype=bool)
+            for index, (start, stop, _, _) in enumerate(iter_slabs(depth, slab_depth)):
+                z_start, z_stop = max(start, box[0].start), min(stop, box[0].stop)
+                if z_start >= z_stop:
+                    continue
+                labels = labeler.labels(candidates(start, stop), index)
+                crop[z_start - box[0].start:z_stop - box[0].start] = np.isin(
+                    labels[z_start - start:z_stop - start, box[1], box[2]], selected
+                )
+            crop = ndi.binary_closing(crop, structure=np.ones((2,2,2)))
+            crop = ndi.binary_opening(crop, structure=np.ones((2,2,2)))
+        return crop, tuple(b.start for b in box), len(selected)
+
+    def _sparse_from_roi(self, state, roi_mask):
+        """SparseMask of the full volume from a mask covering state['roi']"""
+        image = state['image']
+        roi = state.get('roi')
+        return SparseMask.from_array(
+            roi_mask, image.GetOrigin(), image.GetSpacing(),
+            itk.array_from_matrix(image.GetDirection()),
+            offset=[s.start for s in roi] if roi else None, shape=state['shape']
+        )
     
     def segment_tumor_region_growing(self, image_path, seed_points, output_path=None):
         image = self.load_image(image_path)
@@ -249,13 +787,41 @@ class TumorSegmentation:
         mask_image = segmenter.GetOutput()
         
         if output_path:
-            writer = itk.ImageFileWriter[self.ImageType].New()
-            writer.SetFileName(str(output_path))
-            writer.SetInput(mask_image)
-            writer.Update()
+            write_image(mask_image, output_path, self.ImageType)
         
         return mask_image
     
+    def create_region_grower(self, image_path, **options):
+        """RegionGrower over an image for interactive or batched seeding.
+
+        Options: radius of the seed neighbourhood (default 1), std_factor
+        (default 2.0), max_extent in voxels around the seeds and
+        max_volume in voxels.
+        """
+        from region_growing import RegionGrower
+        
+        with profile_step("load"):
+            image = self.load_image(image_path)
+        return RegionGrower.from_itk(image, **options)
+    
+    def segment_tumor_region_growing_batch(self, image_path, seed_sets, output_paths=None,
+                                           workers=None, **options):
+        """Grow one region per seed set with neighbourhood seed statistics.
+
+        Returns one dict per seed set (mask as a SparseMask, lower/upper
+        thresholds, voxel count, whether a limit stopped the growth);
+        masks are written as unsigned char images when output_paths is set.
+        """
+        grower = self.create_region_grower(image_path, **options)
+        with profile_step("region_growing"):
+            results = grower.grow_many(seed_sets, workers)
+        
+        if output_paths:
+            with profile_step("write"):
+                for result, output_path in zip(results, output_paths):
+                    write_image(result['mask'], output_path, itk.Image[itk.UC, self.Dimension])
+        return results
+    
     def refine_segmentation(self, mask_image, original_image):
         # Post-processing to refine segmentation
         mask_array = itk.GetArrayFromImage(mask_image)
@@ -0,0 +1,298 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from storage import ChunkedVolume, is_chunked_volume
+from sparse_mask import SparseMask, SPARSE_SUFFIX
+
+
+# Slice orientations: array axis (z, y, x) each one cuts along
+ORIENTATIONS = {'axial': 0, 'coronal': 1, 'sagittal': 2}
+
+# Rendered slices kept in memory (RGB, uint8)
+SLICE_CACHE_MB = 256
+
+# Slices rendered ahead of the scroll position, in the scroll direction
+PREFETCH_DEPTH = 8
+
+# Mask overlay colors and opacity, as in the 3D scene
+OVERLAY_COLORS = [(255, 51, 51), (51, 255, 51)]
+OVERLAY_OPACITY = 0.5
+
+
+def load_volume(path):
+    """(volume, spacing) for the viewer: anything indexable like a (z, y, x) array.
+
+    Raw chunked volumes are memory-mapped and compressed ones decode only
+    the chunks a slice touches; other files are read into memory.
+    """
+    if is_chunked_volume(path):
+        volume = ChunkedVolume(path)
+        return (volume.memmap() if volume.compression == 'raw' else volume), volume.spacing
+    if Path(path).suffix == SPARSE_SUFFIX:
+        mask = SparseMask.load(path)
+        return mask.to_array(), mask.spacing
+
+    import itk
+
+    image = itk.imread(str(path))
+    return itk.array_from_image(image), tuple(image.GetSpacing())
+
+
+def window_range(volume, samples=16):
+    """Display intensity range (0.5 and 99.5 percentiles) from a few axial slices"""
+    indexes = np.linspace(0, volume.shape[0] - 1, min(samples, volume.shape[0])).astype(int)
+    values = np.concatenate([np.asarray(volume[int(i)], dtype=np.float32).ravel() for i in indexes])
+    low, high = np.percentile(values, [0.5, 99.5])
+    return float(low), float(max(high, low + 1e-6))
+
+
+class SliceCache:
+    """Rendered slices of one image and mask, cached and prefetched.
+
+    get() reslices the image along an orientation, maps it to gray levels
+    and blends the mask on top; the RGB result is kept in an LRU cache of
+    ``max_bytes``. prefetch() renders slices on a background thread, so
+    that scrolling finds them ready.
+    """
+
+    def __init__(self, volume, mask=None, color=OVERLAY_COLORS[0], intensity_range=None,
+                 max_bytes=SLICE_CACHE_MB * 2**20):
+        self.volume = volume
+        self.mask = mask
+        self.color = np.array(color, dtype=np.float32)
+        self.low, self.high = intensity_range or window_range(volume)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._slices = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1)
+
+    def count(self, orientation):
+        return self.volume.shape[ORIENTATIONS[orientation]]
+
+    def _render(self, orientation, index):
+        region = [slice(None)] * 3
+        region[ORIENTATIONS[orientation]] = int(index)
+        region = tuple(region)
+        values = np.asarray(self.volume[region], dtype=np.float32)
+        gray = np.clip((values - self.low) * (255.0 / (self.high - self.low)), 0, 255)
+        rgb = np.repeat(gray[..., None], 3, axis=2)
+        if self.mask is not None:
+            inside = np.asarray(self.mask[region]) > 0
+            rgb[inside] = (1 - OVERLAY_OPACITY) * rgb[inside] + OVERLAY_OPACITY * self.color
+        return rgb.astype(np.uint8)
+
+    def _store(self, key, rgb):
+        with self._lock:
+            self._pending.discard(key)
+            if key in self._slices:
+                return
+            self._slices[key] = rgb
+            self.nbytes += rgb.nbytes
+            while self.nbytes > self.max_bytes and len(self._slices) > 1:
+                _, evicted = self._slices.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def get(self, orientation, index):
+        key = (orientation, int(index))
+        with self._lock:
+            rgb = self._slices.get(key)
+            if rgb is not None:
+                self._slices.move_to_end(key)
+                self.hits += 1
+                return rgb
+            self.misses += 1
+        rgb = self._render(orientation, index)
+        self._store(key, rgb)
+        return rgb
+
+    def _prefetch_one(self, key):
+        try:
+            self._store(key, self._render(*key))
+        except Exception:
+            with self._lock:
+                self._pending.discard(key)
+
+    def prefetch(self, orientation, index, step=1, depth=PREFETCH_DEPTH):
+        """Render the next ``depth`` slices in the ``step`` direction, then one behind"""
+        count = self.count(orientation)
+        indexes = [index + step * i for i in range(1, depth + 1)] + [index - step]
+        for i in indexes:
+            key = (orientation, int(i))
+            if not 0 <= i < count:
+                continue
+            with self._lock:
+                if key in self._slices or key in self._pending:
+                    continue
+                self._pending.add(key)
+            self._pool.submit(self._prefetch_one, key)
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ComparativeSliceViewer:
+    """Baseline and follow-up slices side by side, with their tumor masks.
+
+    Both panes share one camera and one slice position: scrolling
+    (mouse wheel, Up/Down, Page Up/Down), zooming, panning and switching
+    between axial, coronal and sagittal (keys a, c, s) apply to both.
+    Slices come from a SliceCache per pane, with neighbours prefetched in
+    the scroll direction. The images must be on the same grid (registered
+    follow-up).
+    """
+
+    def __init__(self, image1, image2, mask1=None, mask2=None, spacing=(1.0, 1.0, 1.0),
+                 titles=("Baseline", "Follow-up"), offscreen=False):
+        if image1.shape != image2.shape:
+            raise ValueError("Both images must be on the same grid (use the registered follow-up)")
+        # ITK (x, y, z) spacing to array (z, y, x) order
+        self.spacing = tuple(reversed(spacing))
+        self.caches = [
+            SliceCache(image1, mask1, OVERLAY_COLORS[0]),
+            SliceCache(image2, mask2, OVERLAY_COLORS[1]),
+        ]
+        self.titles = titles
+        self.orientation = 'axial'
+        self.index = image1.shape[0] // 2
+        self.step = 1
+
+        self.render_window = vtk.vtkRenderWindow()
+        self.render_window.SetSize(1200, 600)
+        if offscreen:
+            self.render_window.SetOffScreenRendering(1)
+        self.interactor = vtk.vtkRenderWindowInteractor()
+        self.interactor.SetRenderWindow(self.render_window)
+
+        self.renderers = []
+        self.images = []
+        self.labels = []
+        # Slices currently shown: VTK shares their memory
+        self._shown = [None, None]
+        camera = None
+        for pane in range(2):
+            renderer = vtk.vtkRenderer()
+            renderer.SetViewport(0.5 * pane, 0.0, 0.5 * (pane + 1), 1.0)
+            renderer.SetBackground(0.0, 0.0, 0.0)
+            if camera is None:
+                camera = renderer.GetActiveCamera()
+                camera.ParallelProjectionOn()
+            else:
+                renderer.SetActiveCamera(camera)
+
+            image = vtk.vtkImageData()
+            actor = vtk.vtkImageActor()
+            actor.GetMapper().SetInputData(image)
+            actor.InterpolateOff()
+            renderer.AddActor(actor)
+
+            label = vtk.vtkTextActor()
+            label.SetPosition(10, 10)
+            label.GetTextProperty().SetFontSize(14)
+            label.GetTextProperty().SetColor(1, 1, 1)
+            renderer.AddViewProp(label)
+
+            self.render_window.AddRenderer(renderer)
+            self.renderers.append(renderer)
+            self.images.append(image)
+            self.labels.append(label)
+        self.camera = camera
+
+        self.show(self.index, reset_camera=True)
+
+    def slice_count(self):
+        return self.caches[0].count(self.orientation)
+
+    def _slice_geometry(self):
+        # In-plane (column, row) spacing of the current orientation
+        axes = [a for a in range(3) if a != ORIENTATIONS[self.orientation]]
+        return self.spacing[axes[1]], self.spacing[axes[0]]
+
+    def show(self, index, reset_camera=False):
+        """Show slice ``index`` of the current orientation in both panes"""
+        self.index = int(np.clip(index, 0, self.slice_count() - 1))
+        column_spacing, row_spacing = self._slice_geometry()
+        for pane, cache in enumerate(self.caches):
+            rgb = cache.get(self.orientation, self.index)
+            self._shown[pane] = rgb
+            image = self.images[pane]
+            # VTK rows run bottom-up: row 0 of the slice is drawn at the bottom
+            image.SetDimensions(rgb.shape[1], rgb.shape[0], 1)
+            image.SetSpacing(column_spacing, row_spacing, 1.0)
+            scalars = numpy_support.numpy_to_vtk(rgb.reshape(-1, 3), deep=False)
+            image.GetPointData().SetScalars(scalars)
+            image.Modified()
+            self.labels[pane].SetInput(
+                f"{self.titles[pane]} - {self.orientation} {self.index + 1}/{self.slice_count()}"
+            )
+            cache.prefetch(self.orientation, self.index, self.step)
+        if reset_camera:
+            self.renderers[0].ResetCamera()
+        self.render_window.Render()
+
+    def scroll(self, delta):
+        if delta:
+            self.step = 1 if delta > 0 else -1
+        self.show(self.index + delta)
+
+    def set_orientation(self, orientation):
+        if orientation not in ORIENTATIONS:
+            raise ValueError(f"Unknown orientation: {orientation} (use {', '.join(ORIENTATIONS)})")
+        self.orientation = orientation
+        self.step = 1
+        self.show(self.slice_count() // 2, reset_camera=True)
+
+    def cache_stats(self):
+        return [
+            {'hits': cache.hits, 'misses': cache.misses, 'cached_mb': cache.nbytes / 2**20}
+            for cache in self.caches
+        ]
+
+    def save_screenshot(self, output_path):
+        window_to_image = vtk.vtkWindowToImageFilter()
+        window_to_image.SetInput(self.render_window)
+        window_to_image.Update()
+        writer = vtk.vtkPNGWriter()
+        writer.SetFileName(str(output_path))
+        writer.SetInputConnection(window_to_image.GetOutputPort())
+        writer.Write()
+
+    def start_interaction(self):
+        style = vtk.vtkInteractorStyleImage()
+        self.interactor.SetInteractorStyle(style)
+
+        # Observers on the style replace its own wheel and key handling
+        style.AddObserver("MouseWheelForwardEvent", lambda obj, event: self.scroll(1))
+        style.AddObserver("MouseWheelBackwardEvent", lambda obj, event: self.scroll(-1))
+
+        def on_key_press(obj, event):
+            key = self.interactor.GetKeySym()
+            if key in ('Up', 'Down'):
+                self.scroll(1 if key == 'Up' else -1)
+            elif key in ('Prior', 'Next'):
+                self.scroll(10 if key == 'Prior' else -10)
+            elif key in ('a', 'c', 's'):
+                self.set_orientation({'a': 'axial', 'c': 'coronal', 's': 'sagittal'}[key])
+            elif key in ('r', 'R'):
+                self.renderers[0].ResetCamera()
+                self.render_window.Render()
+            elif key in ('q', 'Q', 'e', 'E'):
+                self.interactor.TerminateApp()
+
+        style.AddObserver("KeyPressEvent", on_key_press)
+        # The default key bindings (wireframe, fly-to, ...) do not apply to slices
+        style.AddObserver("CharEvent", lambda obj, event: None)
+
+        self.render_window.Render()
+        self.interactor.Start()
+        for cache in self.caches:
+            cache.close()
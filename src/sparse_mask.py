@@ -0,0 +1,169 @@
+import numpy as np
+from pathlib import Path
+
+
+SPARSE_SUFFIX = ".npz"
+
+
+class SparseMask:
+    """Binary mask stored as a bounding box plus a bit-packed bitmap.
+
+    Tumor masks are almost entirely background, so only the bounding box of
+    the foreground is kept, packed at one bit per voxel. Offsets and shapes
+    use NumPy (z, y, x) order, geometry uses ITK (x, y, z) order.
+    """
+
+    def __init__(self, shape, offset, bbox_shape, bits, voxel_count,
+                 origin=None, spacing=None, direction=None):
+        self.shape = tuple(int(s) for s in shape)
+        self.offset = tuple(int(o) for o in offset)
+        self.bbox_shape = tuple(int(s) for s in bbox_shape)
+        self.bits = bits
+        self.voxel_count = int(voxel_count)
+        self.origin = tuple(origin) if origin is not None else (0.0,) * len(self.shape)
+        self.spacing = tuple(spacing) if spacing is not None else (1.0,) * len(self.shape)
+        self.direction = (np.asarray(direction, dtype=np.float64)
+                          if direction is not None else np.eye(len(self.shape)))
+
+    @classmethod
+    def from_array(cls, array, origin=None, spacing=None, direction=None,
+                   offset=None, shape=None):
+        """Build from a dense array, or from a crop of a larger volume.
+
+        When ``array`` only covers part of the volume, ``offset`` is the
+        index of its first voxel and ``shape`` the full volume shape.
+        """
+        foreground = np.asarray(array) > 0
+        coords = np.nonzero(foreground)
+        crop_offset = offset if offset is not None else (0,) * foreground.ndim
+        shape = shape if shape is not None else foreground.shape
+
+        if len(coords[0]) == 0:
+            offset = (0,) * foreground.ndim
+            bbox_shape = (0,) * foreground.ndim
+            bits = np.zeros(0, dtype=np.uint8)
+        else:
+            start = tuple(int(c.min()) for c in coords)
+            bbox_shape = tuple(int(c.max()) - o + 1 for c, o in zip(coords, start))
+            roi = tuple(slice(o, o + s) for o, s in zip(start, bbox_shape))
+            bits = np.packbits(foreground[roi].ravel())
+            offset = tuple(int(o) + c for o, c in zip(start, crop_offset))
+
+        return cls(shape, offset, bbox_shape, bits, len(coords[0]),
+                   origin, spacing, direction)
+
+    @classmethod
+    def from_itk(cls, mask_image):
+        import itk
+
+        return cls.from_array(
+            itk.GetArrayViewFromImage(mask_image),
+            origin=mask_image.GetOrigin(),
+            spacing=mask_image.GetSpacing(),
+            direction=itk.array_from_matrix(mask_image.GetDirection()),
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['shape'], data['offset'], data['bbox_shape'], data['bits'],
+                   data['voxel_count'], data['origin'], data['spacing'], data['direction'])
+
+    def save(self, path):
+        # savez_compressed appends .npz when it is missing
+        np.savez_compressed(
+            path,
+            shape=np.array(self.shape),
+            offset=np.array(self.offset),
+            bbox_shape=np.array(self.bbox_shape),
+            bits=self.bits,
+            voxel_count=np.array(self.voxel_count),
+            origin=np.array(self.origin),
+            spacing=np.array(self.spacing),
+            direction=self.direction,
+        )
+        path = Path(path)
+        return path if path.suffix == SPARSE_SUFFIX else Path(f"{path}{SPARSE_SUFFIX}")
+
+    @property
+    def is_empty(self):
+        return self.voxel_count == 0
+
+    @property
+    def bbox(self):
+        """Bounding box as a tuple of slices into the full volume"""
+        return tuple(slice(o, o + s) for o, s in zip(self.offset, self.bbox_shape))
+
+    def crop(self):
+        """Dense boolean array covering the bounding box only"""
+        size = int(np.prod(self.bbox_shape))
+        return np.unpackbits(self.bits, count=size).astype(bool).reshape(self.bbox_shape)
+
+    def to_array(self, dtype=np.uint8):
+        array = np.zeros(self.shape, dtype=dtype)
+        if not self.is_empty:
+            array[self.bbox] = self.crop()
+        return array
+
+    def to_itk(self):
+        import itk
+
+        mask_image = itk.GetImageFromArray(self.to_array(np.uint8))
+        mask_image.SetOrigin(self.origin)
+        mask_image.SetSpacing(self.spacing)
+        mask_image.SetDirection(itk.matrix_from_array(self.direction))
+        return mask_image
+
+    def index_to_physical(self, index):
+        """Physical (x, y, z) position of a (z, y, x) voxel index"""
+        scaled = np.asarray(index, dtype=np.float64)[::-1] * np.asarray(self.spacing)
+        return np.asarray(self.origin) + self.direction @ scaled
+
+    def voxel_volume(self):
+        return self.spacing[0] * self.spacing[1] * self.spacing[2]
+
+    def volume_mm3(self):
+        return self.voxel_count * self.voxel_volume()
+
+    def points(self):
+        """(N, 3) array of foreground voxel indices in (z, y, x) order"""
+        if self.is_empty:
+            return np.zeros((0, len(self.shape)), dtype=np.int64)
+        return np.array(np.nonzero(self.crop())).T + np.array(self.offset)
+
+    def surface_points(self):
+        """Foreground voxels with at least one face neighbour in the background"""
+        if self.is_empty:
+            return np.zeros((0, len(self.shape)), dtype=np.int64)
+        from scipy.ndimage import binary_erosion
+
+        padded = np.pad(self.crop(), 1)
+        interior = binary_erosion(padded)
+        surface = padded & ~interior
+        return np.array(np.nonzero(surface)).T - 1 + np.array(self.offset)
+
+    def intersection_count(self, other):
+        """Number of voxels set in both masks, computed on the overlapping boxes"""
+        if self.shape != other.shape:
+            raise ValueError(f"Mask shapes differ: {self.shape} vs {other.shape}")
+        if self.is_empty or other.is_empty:
+            return 0
+
+        start = [max(a, b) for a, b in zip(self.offset, other.offset)]
+        stop = [min(a + s, b + t) for a, s, b, t in
+                zip(self.offset, self.bbox_shape, other.offset, other.bbox_shape)]
+        if any(e <= s for s, e in zip(start, stop)):
+            return 0
+
+        crop1 = self.crop()[tuple(slice(s - o, e - o) for s, e, o in zip(start, stop, self.offset))]
+        crop2 = other.crop()[tuple(slice(s - o, e - o) for s, e, o in zip(start, stop, other.offset))]
+        return int(np.sum(crop1 & crop2))
+
+    def dice(self, other):
+        total = self.voxel_count + other.voxel_count
+        if total == 0:
+            return 1.0
+        return float(2.0 * self.intersection_count(other) / total)
+
+    def nbytes(self):
+        return self.bits.nbytes
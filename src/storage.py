@@ -0,0 +1,340 @@
+import numpy as np
+from pathlib import Path
+import json
+import os
+import shutil
+import uuid
+import zlib
+
+from sparse_mask import SparseMask, SPARSE_SUFFIX
+
+
+CHUNKED_SUFFIX = ".vol"
+HEADER_NAME = "header.json"
+RAW_DATA_NAME = "data.raw"
+FORMAT_NAME = "vitk-chunked"
+FORMAT_VERSION = 1
+
+# Geometry keys are stored explicitly, not as free-form metadata
+GEOMETRY_KEYS = ('origin', 'spacing', 'direction')
+
+# ITK pixel type names; itk itself is only imported when an image is converted
+PIXEL_DTYPES = {
+    'F': np.float32,
+    'D': np.float64,
+    'UC': np.uint8,
+    'SS': np.int16,
+    'US': np.uint16,
+}
+
+
+def is_chunked_volume(path):
+    """Return True if path points to a chunked volume directory"""
+    path = Path(path)
+    return path.is_dir() and (path / HEADER_NAME).exists()
+
+
+def resolve_result_path(results_dir, stem):
+    """Prefer the chunked or sparse version of a pipeline output when it exists"""
+    chunked_path = Path(results_dir) / f"{stem}{CHUNKED_SUFFIX}"
+    if is_chunked_volume(chunked_path):
+        return chunked_path
+    sparse_path = Path(results_dir) / f"{stem}{SPARSE_SUFFIX}"
+    if sparse_path.exists():
+        return sparse_path
+    return Path(results_dir) / f"{stem}.nrrd"
+
+
+class ChunkedVolume:
+    """Chunked on-disk volume with an ITK geometry header.
+
+    A volume is a directory holding ``header.json`` plus either one
+    zlib-compressed file per chunk (``compression='zlib'``) or a single
+    C-ordered ``data.raw`` file that is memory-mapped on read
+    (``compression='raw'``), so that pages are shared across processes.
+    Arrays use NumPy (z, y, x) order, geometry uses ITK (x, y, z) order.
+    Writing over an existing volume replaces its directory as a whole.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / HEADER_NAME, 'r') as f:
+            header = json.load(f)
+
+        if header.get('format') != FORMAT_NAME:
+            raise ValueError(f"Not a chunked volume: {self.path}")
+
+        self.header = header
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.chunk_shape = tuple(header['chunk_shape'])
+        self.compression = header['compression']
+        self.origin = tuple(header['origin'])
+        self.spacing = tuple(header['spacing'])
+        self.direction = np.array(header['direction'], dtype=np.float64)
+        self.metadata = header.get('metadata', {})
+        self._memmap = None
+
+    @classmethod
+    def write(cls, path, data, chunk_shape=(32, 64, 64), compression='zlib',
+              compression_level=1, origin=None, spacing=None, direction=None, metadata=None):
+        """Write an ITK image or NumPy array as a chunked volume"""
+        if compression not in ('zlib', 'raw'):
+            raise ValueError(f"Unknown compression: {compression}")
+
+        if isinstance(data, np.ndarray):
+            array = np.ascontiguousarray(data)
+            origin = origin if origin is not None else (0.0,) * array.ndim
+            spacing = spacing if spacing is not None else (1.0,) * array.ndim
+            direction = direction if direction is not None else np.eye(array.ndim)
+            metadata = metadata or {}
+        else:
+            import itk
+            
+            array = itk.GetArrayViewFromImage(data)
+            origin = tuple(data.GetOrigin())
+            spacing = tuple(data.GetSpacing())
+            direction = itk.array_from_matrix(data.GetDirection())
+            metadata = dict(metadata or {})
+            for key in data.keys():
+                value = data[key]
+                if key not in GEOMETRY_KEYS and isinstance(value, str):
+                    metadata.setdefault(key, value)
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        chunk_shape = tuple(min(c, s) for c, s in zip(chunk_shape, array.shape))
+
+        header = {
+            'format': FORMAT_NAME,
+            'version': FORMAT_VERSION,
+            'shape': list(array.shape),
+            'dtype': array.dtype.str,
+            'chunk_shape': list(chunk_shape),
+            'compression': compression,
+            'origin': [float(v) for v in origin],
+            'spacing': [float(v) for v in spacing],
+            'direction': np.asarray(direction, dtype=np.float64).tolist(),
+            'metadata': metadata,
+        }
+
+        # The volume is written into a sibling directory and swapped in whole, so a
+        # reader never pairs an old header with new data and no old chunks remain
+        token = uuid.uuid4().hex[:8]
+        staging = path.with_name(f".{path.name}.{token}.tmp")
+        previous = path.with_name(f".{path.name}.{token}.old")
+        staging.mkdir()
+        try:
+            if compression == 'raw':
+                target = np.memmap(staging / RAW_DATA_NAME, dtype=array.dtype, mode='w+', shape=array.shape)
+                target[...] = array
+                target.flush()
+                del target
+            else:
+                chunk_dir = staging / "chunks"
+                chunk_dir.mkdir()
+                for chunk_index in np.ndindex(*cls._grid_shape(array.shape, chunk_shape)):
+                    region = cls._chunk_region(chunk_index, chunk_shape, array.shape)
+                    block = np.ascontiguousarray(array[region])
+                    with open(chunk_dir / cls._chunk_name(chunk_index), 'wb') as f:
+                        f.write(zlib.compress(block.tobytes(), compression_level))
+
+            with open(staging / HEADER_NAME, 'w') as f:
+                json.dump(header, f, indent=2)
+
+            # A directory cannot be replaced while it holds files: move the old one aside first
+            if path.exists():
+                os.replace(path, previous)
+            os.replace(staging, path)
+        except BaseException:
+            if previous.exists() and not path.exists():
+                os.replace(previous, path)
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        shutil.rmtree(previous, ignore_errors=True)
+
+        return cls(path)
+
+    @staticmethod
+    def _grid_shape(shape, chunk_shape):
+        return tuple(-(-s // c) for s, c in zip(shape, chunk_shape))
+
+    @staticmethod
+    def _chunk_region(chunk_index, chunk_shape, shape):
+        return tuple(
+            slice(i * c, min((i + 1) * c, s))
+            for i, c, s in zip(chunk_index, chunk_shape, shape)
+        )
+
+    @staticmethod
+    def _chunk_name(chunk_index):
+        return ".".join(str(i) for i in chunk_index)
+
+    def _normalize_region(self, region):
+        if region is None:
+            region = ()
+        if not isinstance(region, tuple):
+            region = (region,)
+        region = region + (slice(None),) * (len(self.shape) - len(region))
+
+        normalized = []
+        for axis_slice, size in zip(region, self.shape):
+            if isinstance(axis_slice, (int, np.integer)):
+                index = int(axis_slice) + size if axis_slice < 0 else int(axis_slice)
+                axis_slice = slice(index, index + 1)
+            start, stop, step = axis_slice.indices(size)
+            if step != 1:
+                raise ValueError("Chunked volumes only support contiguous regions")
+            normalized.append(slice(start, max(start, stop)))
+        return tuple(normalized)
+
+    def memmap(self):
+        """Return the whole volume as a read-only memory map (raw storage only)"""
+        if self.compression != 'raw':
+            raise ValueError("Only raw chunked volumes can be memory-mapped")
+        if self._memmap is None:
+            self._memmap = np.memmap(self.path / RAW_DATA_NAME, dtype=self.dtype,
+                                     mode='r', shape=self.shape)
+        return self._memmap
+
+    def read(self, region=None):
+        """Read a (z, y, x) region, decoding only the chunks it touches"""
+        region = self._normalize_region(region)
+
+        if self.compression == 'raw':
+            return np.array(self.memmap()[region])
+
+        out_shape = tuple(r.stop - r.start for r in region)
+        out = np.empty(out_shape, dtype=self.dtype)
+        if 0 in out_shape:
+            return out
+
+        first = [r.start // c for r, c in zip(region, self.chunk_shape)]
+        last = [(r.stop - 1) // c for r, c in zip(region, self.chunk_shape)]
+
+        for chunk_index in np.ndindex(*[l - f + 1 for f, l in zip(first, last)]):
+            chunk_index = tuple(f + i for f, i in zip(first, chunk_index))
+            chunk_region = self._chunk_region(chunk_index, self.chunk_shape, self.shape)
+            block = self._read_chunk(chunk_index, chunk_region)
+
+            # Intersection of the requested region and this chunk
+            src = []
+            dst = []
+            for r, c in zip(region, chunk_region):
+                start = max(r.start, c.start)
+                stop = min(r.stop, c.stop)
+                src.append(slice(start - c.start, stop - c.start))
+                dst.append(slice(start - r.start, stop - r.start))
+            out[tuple(dst)] = block[tuple(src)]
+
+        return out
+
+    def _read_chunk(self, chunk_index, chunk_region):
+        block_shape = tuple(r.stop - r.start for r in chunk_region)
+        with open(self.path / "chunks" / self._chunk_name(chunk_index), 'rb') as f:
+            data = zlib.decompress(f.read())
+        return np.frombuffer(data, dtype=self.dtype).reshape(block_shape)
+
+    def __getitem__(self, region):
+        # Integer indices drop their axis, as they would on a NumPy array
+        if not isinstance(region, tuple):
+            region = (region,)
+        data = self.read(region)
+        dropped = tuple(i for i, r in enumerate(region) if isinstance(r, (int, np.integer)))
+        return data.squeeze(axis=dropped) if dropped else data
+
+    def read_slice(self, index, axis=0):
+        """Read a single 2-D slice along the given array axis"""
+        region = [slice(None)] * len(self.shape)
+        region[axis] = slice(index, index + 1)
+        return np.take(self.read(tuple(region)), 0, axis=axis)
+
+    def to_itk(self, pixel_type=None):
+        """Load the full volume as an ITK image with geometry and metadata"""
+        import itk
+        
+        array = self.read()
+        if pixel_type is not None:
+            names = {getattr(itk, name): name for name in PIXEL_DTYPES}
+            array = array.astype(PIXEL_DTYPES[names[pixel_type]], copy=False)
+        image = itk.GetImageFromArray(np.ascontiguousarray(array))
+        image.SetOrigin(self.origin)
+        image.SetSpacing(self.spacing)
+        image.SetDirection(itk.matrix_from_array(self.direction))
+        for key, value in self.metadata.items():
+            image[key] = value
+        return image
+
+
+def read_image(path, image_type):
+    """Read an NRRD (or any ITK-readable) file, a chunked volume or a sparse mask.
+
+    Goes through the active AsyncImageIO, if any, to use prefetched images.
+    """
+    from async_io import active_io
+
+    io = active_io()
+    if io is not None:
+        return io.read(path, image_type)
+    return read_image_file(path, image_type)
+
+
+def read_image_file(path, image_type):
+    """read_image() without the asynchronous I/O layer"""
+    import itk
+    
+    if is_chunked_volume(path):
+        pixel_type = itk.template(image_type)[1][0]
+        return ChunkedVolume(path).to_itk(pixel_type)
+    
+    if Path(path).suffix == SPARSE_SUFFIX:
+        return SparseMask.load(path).to_itk()
+
+    reader = itk.ImageFileReader[image_type].New()
+    reader.SetFileName(str(path))
+    reader.Update()
+    return reader.GetOutput()
+
+
+def write_image(image, path, image_type, **chunk_options):
+    """Write an image, choosing the format from the suffix (.vol, .npz or ITK).
+
+    With an active AsyncImageIO the write is queued and happens in the
+    background: the image must not be modified afterwards.
+    """
+    from async_io import active_io
+
+    io = active_io()
+    if io is not None:
+        return io.write(image, path, image_type, **chunk_options)
+    return write_image_file(image, path, image_type, **chunk_options)
+
+
+def wait_for_write(path):
+    """Wait for a queued write of path, for readers that bypass read_image()"""
+    from async_io import active_io
+
+    io = active_io()
+    if io is not None:
+        io.wait_for_write(path)
+
+
+def write_image_file(image, path, image_type, **chunk_options):
+    """write_image() without the asynchronous I/O layer"""
+    if Path(path).suffix == CHUNKED_SUFFIX:
+        return ChunkedVolume.write(path, image, **chunk_options)
+    
+    if Path(path).suffix == SPARSE_SUFFIX:
+        if not isinstance(image, SparseMask):
+            image = SparseMask.from_itk(image)
+        return image.save(path)
+    
+    if isinstance(image, SparseMask):
+        image = image.to_itk()
+    
+    import itk
+
+    writer = itk.ImageFileWriter[image_type].New()
+    writer.SetFileName(str(path))
+    writer.SetInput(image)
+    writer.Update()
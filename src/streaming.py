@@ -0,0 +1,295 @@
+import numpy as np
+import scipy.ndimage as ndi
+from pathlib import Path
+
+
+# Slices per slab: bounds memory to a few slab-sized temporaries
+STREAMING_SLAB_DEPTH = 32
+
+# Suffixes ITK reads region by region; other formats are read once as a whole
+STREAMABLE_SUFFIXES = ('.mha', '.mhd')
+
+
+class VolumeSource:
+    """Read-only (z, y, x) volume read slab by slab, as float32.
+
+    Accepts a NumPy array or memmap, a chunked volume (only the chunks of
+    a slab are decoded; raw volumes are memory-mapped) or any ITK-readable
+    file. ITK streams MetaImage files region by region; formats it cannot
+    stream (NRRD, NIfTI) are read whole on the first slab.
+    """
+
+    def __init__(self, source, image_type=None):
+        from storage import ChunkedVolume, is_chunked_volume
+
+        self._reader = None
+        if isinstance(source, np.ndarray):
+            self._array = source
+            self.shape = source.shape
+            self.origin = (0.0,) * source.ndim
+            self.spacing = (1.0,) * source.ndim
+            self.direction = np.eye(source.ndim)
+        elif is_chunked_volume(source):
+            volume = ChunkedVolume(source)
+            self._array = volume.memmap() if volume.compression == 'raw' else volume
+            self.shape = volume.shape
+            self.origin, self.spacing, self.direction = volume.origin, volume.spacing, volume.direction
+        else:
+            import itk
+
+            if Path(source).suffix.lower() not in STREAMABLE_SUFFIXES:
+                print(f"Warning: {Path(source).name} cannot be streamed, it is read into memory whole")
+            image_type = image_type or itk.Image[itk.F, 3]
+            self._reader = itk.ImageFileReader[image_type].New(FileName=str(source))
+            self._reader.UpdateOutputInformation()
+            image = self._reader.GetOutput()
+            self.shape = tuple(reversed(image.GetLargestPossibleRegion().GetSize()))
+            self.origin = tuple(image.GetOrigin())
+            self.spacing = tuple(image.GetSpacing())
+            self.direction = itk.array_from_matrix(image.GetDirection())
+
+    @property
+    def depth(self):
+        return self.shape[0]
+
+    def read(self, start, stop):
+        if self._reader is None:
+            return np.asarray(self._array[start:stop], dtype=np.float32)
+
+        import itk
+
+        image = self._reader.GetOutput()
+        region = itk.ImageRegion[3]()
+        region.SetIndex([0, 0, int(start)])
+        region.SetSize([int(self.shape[2]), int(self.shape[1]), int(stop - start)])
+        image.SetRequestedRegion(region)
+        self._reader.Update()
+        # Non-streaming readers buffer the whole image: cut the slab out of it
+        buffered_start = image.GetBufferedRegion().GetIndex()[2]
+        array = itk.GetArrayViewFromImage(image)
+        return np.array(array[start - buffered_start:stop - buffered_start], dtype=np.float32)
+
+
+def iter_slabs(depth, slab_depth=STREAMING_SLAB_DEPTH, halo=0):
+    """(start, stop, low, high) of each z-slab; low:high adds the halo, clipped to the volume"""
+    for start in range(0, depth, slab_depth):
+        stop = min(start + slab_depth, depth)
+        yield start, stop, max(0, start - halo), min(depth, stop + halo)
+
+
+def _sort_keys(values):
+    """uint32 keys ordered like the float32 values"""
+    bits = np.ascontiguousarray(values, dtype=np.float32).view(np.uint32)
+    return np.where(bits & 0x80000000, ~bits, bits | 0x80000000)
+
+
+def _key_value(key):
+    bits = np.uint32(key & 0x7FFFFFFF) if key & 0x80000000 else np.uint32(~np.uint32(key))
+    return np.array([bits], dtype=np.uint32).view(np.float32)[0]
+
+
+class StreamingPercentiles:
+    """Exact np.percentile (linear method) of float32 values seen in chunks.
+
+    Two passes over the data with bounded memory: add() counts the values
+    by the high 16 bits of their order-preserving bit pattern, refine()
+    counts the low 16 bits inside the few bins holding the order statistics
+    the percentiles need. The result then interpolates between those order
+    statistics exactly as NumPy does.
+    """
+
+    def __init__(self, percentiles):
+        self.percentiles = list(percentiles)
+        self.count = 0
+        self._high = np.zeros(1 << 16, dtype=np.int64)
+        self._targets = None
+        self._low = {}
+
+    def add(self, values):
+        keys = _sort_keys(values[~np.isnan(values)])
+        self.count += len(keys)
+        self._high += np.bincount(keys >> 16, minlength=1 << 16)
+
+    def _indexes(self, percentile):
+        """Order statistics and interpolation weight, following np.percentile"""
+        n = self.count
+        q = np.true_divide(percentile, 100)
+        virtual = n * q + (1 + q * (1 - 1 - 1)) - 1
+        if virtual >= n - 1:
+            previous, following = n - 1, n - 1
+        elif virtual < 0:
+            previous, following = 0, 0
+        else:
+            previous = int(np.floor(virtual))
+            following = previous + 1
+        return previous, following, float(virtual - np.floor(virtual))
+
+    def _prepare(self):
+        if self.count == 0:
+            raise ValueError("No values to compute percentiles of")
+        cumulative = np.cumsum(self._high)
+        self._targets = {}
+        for percentile in self.percentiles:
+            for rank in self._indexes(percentile)[:2]:
+                high = int(np.searchsorted(cumulative, rank, side='right'))
+                before = int(cumulative[high - 1]) if high > 0 else 0
+                self._targets[rank] = (high, rank - before)
+        self._low = {high: np.zeros(1 << 16, dtype=np.int64) for high, _ in self._targets.values()}
+
+    def refine(self, values):
+        if self._targets is None:
+            self._prepare()
+        keys = _sort_keys(values[~np.isnan(values)])
+        high_bits = keys >> 16
+        for high, counts in self._low.items():
+            counts += np.bincount(keys[high_bits == high] & 0xFFFF, minlength=1 << 16)
+
+    def _order_statistic(self, rank):
+        high, rank_in_bin = self._targets[rank]
+        low = int(np.searchsorted(np.cumsum(self._low[high]), rank_in_bin, side='right'))
+        return _key_value((high << 16) | low)
+
+    def result(self):
+        """One np.float32 per percentile, equal to np.percentile on all values"""
+        if self._targets is None:
+            self._prepare()
+        results = []
+        for percentile in self.percentiles:
+            previous, following, gamma = self._indexes(percentile)
+            a = self._order_statistic(previous)
+            b = self._order_statistic(following)
+            difference = b - a
+            value = a + difference * gamma
+            if gamma >= 0.5:
+                value = b - difference * (1 - gamma)
+            results.append(value)
+        return results
+
+
+class SlabLabeler:
+    """Face-connected components of a mask streamed in z-slabs.
+
+    Each slab is labeled with ndi.label; components touching across a slab
+    boundary are merged with a union-find over the slab labels. Labels are
+    numbered in raster order, as ndi.label would number them on the whole
+    volume. A second pass calls labels() on the same slabs to get final
+    labels per voxel. With ``attributes``, the bounding box and coordinate
+    sums of every component are accumulated too.
+    """
+
+    def __init__(self, attributes=False):
+        self.attributes = attributes
+        self.count = 0
+        self._offsets = []
+        self._sizes = [np.zeros(1, dtype=np.int64)]
+        self._low = [np.zeros((1, 3), dtype=np.int64)]
+        self._high = [np.zeros((1, 3), dtype=np.int64)]
+        self._sums = [np.zeros((1, 3), dtype=np.int64)]
+        self._touching = []
+        self._pairs = []
+        self._previous = None
+        self._stop = None
+        self.roots = None
+
+    @staticmethod
+    def _offset_labels(local, offset):
+        labels = local.astype(np.int64)
+        labels[local > 0] += offset
+        return labels
+
+    def add(self, mask, start):
+        """Label the slab starting at z=start; returns its provisional labels"""
+        if self._stop is not None and start != self._stop:
+            raise ValueError("Slabs must be added in order, without gaps")
+        local, count = ndi.label(mask)
+        self._offsets.append(self.count)
+
+        self._sizes.append(np.bincount(local.ravel(), minlength=count + 1)[1:])
+        if self.attributes:
+            low = np.zeros((count, 3), dtype=np.int64)
+            high = np.zeros((count, 3), dtype=np.int64)
+            for i, box in enumerate(ndi.find_objects(local)):
+                low[i] = [b.start for b in box]
+                high[i] = [b.stop - 1 for b in box]
+            coords = np.nonzero(local)
+            index = local[coords] - 1
+            sums = np.stack([
+                np.bincount(index, weights=c, minlength=count) for c in coords
+            ], axis=1).astype(np.int64)
+            # Slab coordinates to volume coordinates
+            shift = np.array([start, 0, 0])
+            self._low.append(low + shift)
+            self._high.append(high + shift)
+            self._sums.append(sums + np.outer(self._sizes[-1], shift))
+
+        labels = self._offset_labels(local, self.count)
+        if self._previous is not None:
+            both = (self._previous > 0) & (labels[0] > 0)
+            if np.any(both):
+                self._pairs.append(np.unique(
+                    np.stack([self._previous[both], labels[0][both]], axis=1), axis=0
+                ))
+        self._previous = labels[-1].copy()
+        self._stop = start + mask.shape[0]
+        self.count += count
+        return labels
+
+    def mark(self, labels):
+        """Flag the provisional labels present in ``labels`` (e.g. on the volume border)"""
+        self._touching.append(np.unique(labels[labels > 0]))
+
+    def finish(self):
+        """Merge components across slabs; returns the number of components"""
+        parent = np.arange(self.count + 1)
+
+        def find(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        for pairs in self._pairs:
+            for a, b in pairs.tolist():
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    # The smallest label stays root, which keeps raster order
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+
+        # Renumber the roots 1..n in raster order
+        is_root = parent == np.arange(self.count + 1)
+        is_root[0] = False
+        number = np.zeros(self.count + 1, dtype=np.int64)
+        number[is_root] = np.arange(1, np.count_nonzero(is_root) + 1)
+        self.roots = number[parent]
+        components = int(np.count_nonzero(is_root))
+
+        roots = self.roots[1:]
+        self.sizes = np.bincount(roots, weights=np.concatenate(self._sizes)[1:],
+                                 minlength=components + 1).astype(np.int64)
+        self.touching = np.zeros(components + 1, dtype=bool)
+        if self._touching:
+            self.touching[self.roots[np.concatenate(self._touching)]] = True
+        if self.attributes:
+            self.bbox_low = np.full((components + 1, 3), np.iinfo(np.int64).max)
+            self.bbox_high = np.full((components + 1, 3), -1)
+            self.coord_sums = np.zeros((components + 1, 3), dtype=np.int64)
+            np.minimum.at(self.bbox_low, roots, np.concatenate(self._low)[1:])
+            np.maximum.at(self.bbox_high, roots, np.concatenate(self._high)[1:])
+            np.add.at(self.coord_sums, roots, np.concatenate(self._sums)[1:])
+        self._pairs = []
+        return components
+
+    def labels(self, mask, index):
+        """Final labels of the index-th slab (the same mask that was passed to add())"""
+        local, _ = ndi.label(mask)
+        return self.roots[self._offset_labels(local, self._offsets[index])]
+
+
+def temporary_volume(directory, name, shape, dtype):
+    """Disk-backed scratch volume (np.memmap) in directory"""
+    return np.memmap(Path(directory) / f"{name}.raw", dtype=dtype, mode='w+', shape=tuple(shape))
@@ -0,0 +1,234 @@
+import json
+import os
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+
+
+DEFAULT_TRANSFORM_DIR = Path("results") / "transforms"
+
+# Margin (mm) kept around the region of interest by cropped resampling
+RESAMPLE_MARGIN_MM = 5.0
+
+
+def matrix_from_itk(transform):
+    """4x4 homogeneous matrix of an ITK matrix-offset transform (rigid, affine)"""
+    import itk
+
+    # Registration methods return the base Transform class
+    transform = itk.down_cast(transform)
+    matrix = np.eye(4)
+    matrix[:3, :3] = itk.array_from_matrix(transform.GetMatrix())
+    matrix[:3, 3] = np.asarray(transform.GetOffset(), dtype=np.float64)
+    return matrix
+
+
+def matrix_to_itk(matrix):
+    """ITK AffineTransform applying a 4x4 matrix (exact for rigid matrices too)"""
+    import itk
+
+    transform = itk.AffineTransform[itk.D, 3].New()
+    transform.SetMatrix(itk.matrix_from_array(np.ascontiguousarray(matrix[:3, :3])))
+    transform.SetOffset([float(v) for v in matrix[:3, 3]])
+    return transform
+
+
+def is_rigid(matrix, tolerance=1e-6):
+    rotation = matrix[:3, :3]
+    return (np.allclose(rotation.T @ rotation, np.eye(3), atol=tolerance)
+            and abs(np.linalg.det(rotation) - 1.0) < tolerance)
+
+
+def invert(matrix):
+    """Inverse of a 4x4 transform: transposed rotation for rigid ones, else a matrix inverse"""
+    if not is_rigid(matrix):
+        return np.linalg.inv(matrix)
+    inverse = np.eye(4)
+    inverse[:3, :3] = matrix[:3, :3].T
+    inverse[:3, 3] = -matrix[:3, :3].T @ matrix[:3, 3]
+    return inverse
+
+
+def compose(*matrices):
+    """One matrix applying ``matrices`` in order (the first is applied first)"""
+    result = np.eye(4)
+    for matrix in matrices:
+        result = matrix @ result
+    return result
+
+
+def map_points(matrix, points):
+    """(N, 3) physical points mapped by a 4x4 matrix"""
+    points = np.asarray(points, dtype=np.float64)
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def map_bounds(matrix, low, high):
+    """Axis-aligned [low, high] box containing the mapped box [low, high]"""
+    corners = np.array([[(low, high)[c][axis] for axis, c in enumerate(bits)]
+                        for bits in np.ndindex(2, 2, 2)], dtype=np.float64)
+    mapped = map_points(matrix, corners)
+    return mapped.min(axis=0).tolist(), mapped.max(axis=0).tolist()
+
+
+def map_polydata(matrix, polydata):
+    """A copy of a vtkPolyData surface with its points (and normals) mapped"""
+    import vtk
+
+    vtk_matrix = vtk.vtkMatrix4x4()
+    for row in range(4):
+        for column in range(4):
+            vtk_matrix.SetElement(row, column, float(matrix[row, column]))
+    transform = vtk.vtkTransform()
+    transform.SetMatrix(vtk_matrix)
+    transformer = vtk.vtkTransformPolyDataFilter()
+    transformer.SetInputData(polydata)
+    transformer.SetTransform(transform)
+    transformer.Update()
+    return transformer.GetOutput()
+
+
+def resample_region(image, matrix, reference_image, bounds=None, margin_mm=RESAMPLE_MARGIN_MM, nearest=False):
+    """Resample ``image`` onto the grid of ``reference_image``, cropped to ``bounds``.
+
+    ``matrix`` maps points of the reference space to points of the image's
+    space (ITK resampling convention). ``bounds`` is a physical [low, high]
+    box in the reference space, grown by ``margin_mm``; without it the whole
+    reference grid is used. Use ``nearest`` for masks.
+    """
+    import itk
+
+    image_type = type(image)
+    resampler = itk.ResampleImageFilter[image_type, image_type].New()
+    resampler.SetInput(image)
+    resampler.SetTransform(matrix_to_itk(matrix))
+    resampler.SetOutputParametersFromImage(reference_image)
+    if nearest:
+        resampler.SetInterpolator(itk.NearestNeighborInterpolateImageFunction[image_type, itk.D].New())
+    resampler.SetDefaultPixelValue(0)
+
+    if bounds is not None:
+        low = np.asarray(bounds[0], dtype=np.float64) - margin_mm
+        high = np.asarray(bounds[1], dtype=np.float64) + margin_mm
+        size = np.asarray(reference_image.GetLargestPossibleRegion().GetSize())
+        corners = np.array([[(low, high)[c][axis] for axis, c in enumerate(bits)]
+                            for bits in np.ndindex(2, 2, 2)])
+        indexes = np.array([
+            reference_image.TransformPhysicalPointToContinuousIndex([float(v) for v in corner])
+            for corner in corners
+        ])
+        start = np.clip(np.floor(indexes.min(axis=0)), 0, size - 1).astype(int)
+        stop = np.clip(np.ceil(indexes.max(axis=0)), 0, size - 1).astype(int)
+        origin = reference_image.TransformIndexToPhysicalPoint([int(v) for v in start])
+        resampler.SetOutputOrigin(origin)
+        resampler.SetSize([int(v) for v in stop - start + 1])
+
+    resampler.Update()
+    return resampler.GetOutput()
+
+
+class TransformService:
+    """Per-patient transform chains, composed and inverted without resampling.
+
+    Each patient has a JSON file in ``root`` listing transforms between
+    named spaces (timepoints such as ``case6_gre1``) as 4x4 matrices. A
+    transform added as (fixed, moving) maps fixed-space points to
+    moving-space points, the convention of the registration transforms.
+    chain() finds a path between any two spaces of a patient. It composes
+    the transforms along it and inverts those walked backwards, which is
+    exact and analytic for rigid transforms. Lesion centroids, bounding
+    boxes and surfaces are then mapped directly; volumes are resampled only
+    through resample_region(), cropped to a region of interest.
+    """
+
+    def __init__(self, root=DEFAULT_TRANSFORM_DIR):
+        self.root = Path(root)
+
+    def _path(self, patient):
+        return self.root / f"{patient}.json"
+
+    def transforms(self, patient):
+        path = self._path(patient)
+        if not path.exists():
+            return []
+        with open(path, 'r') as f:
+            return json.load(f)['transforms']
+
+    def add(self, patient, fixed, moving, transform, source=None):
+        """Store the transform from space ``fixed`` to space ``moving`` (ITK transform or 4x4)"""
+        matrix = np.asarray(transform if isinstance(transform, np.ndarray) else matrix_from_itk(transform))
+        transforms = [t for t in self.transforms(patient) if (t['fixed'], t['moving']) != (fixed, moving)]
+        transforms.append({
+            'fixed': fixed,
+            'moving': moving,
+            'matrix': matrix.tolist(),
+            'rigid': bool(is_rigid(matrix)),
+            'source': str(source) if source else None,
+        })
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Written aside and renamed, so readers never see a partial file
+        temporary = self._path(patient).with_suffix(".json.tmp")
+        with open(temporary, 'w') as f:
+            json.dump({'patient': patient, 'transforms': transforms}, f, indent=2)
+        os.replace(temporary, self._path(patient))
+        return matrix
+
+    def spaces(self, patient):
+        return sorted({t[key] for t in self.transforms(patient) for key in ('fixed', 'moving')})
+
+    def chain(self, patient, source, target):
+        """4x4 matrix mapping points of space ``source`` to space ``target``"""
+        if source == target:
+            return np.eye(4)
+        edges = {}
+        for t in self.transforms(patient):
+            matrix = np.asarray(t['matrix'], dtype=np.float64)
+            edges.setdefault(t['fixed'], []).append((t['moving'], matrix, False))
+            edges.setdefault(t['moving'], []).append((t['fixed'], matrix, True))
+
+        # Breadth-first: the chain with the fewest transforms
+        previous = {source: None}
+        queue = deque([source])
+        while queue:
+            space = queue.popleft()
+            if space == target:
+                break
+            for neighbour, matrix, inverse in edges.get(space, []):
+                if neighbour not in previous:
+                    previous[neighbour] = (space, matrix, inverse)
+                    queue.append(neighbour)
+        if target not in previous:
+            raise KeyError(f"No transform chain from {source} to {target} for patient {patient}")
+
+        steps = []
+        space = target
+        while previous[space] is not None:
+            space, matrix, inverse = previous[space]
+            steps.append(invert(matrix) if inverse else matrix)
+        return compose(*reversed(steps))
+
+    def map_lesions(self, lesions, matrix):
+        """Add ``native_centroid_mm`` and ``native_bbox_mm`` to lesion dicts
+        that have ``centroid_mm`` and ``bbox_mm``, mapped by ``matrix``"""
+        for lesion in lesions or []:
+            if 'centroid_mm' not in lesion:
+                continue
+            lesion['native_centroid_mm'] = map_points(matrix, [lesion['centroid_mm']])[0].tolist()
+            lesion['native_bbox_mm'] = list(map_bounds(matrix, *lesion['bbox_mm']))
+        return lesions
+
+    def add_native_coordinates(self, analysis_results, patient, baseline, followup):
+        """Follow-up lesions of compare_tumors results in the follow-up's native space.
+
+        The lesions were measured on the registered follow-up, i.e. in the
+        baseline space. Returns False when the patient has no chain between
+        the two spaces.
+        """
+        try:
+            matrix = self.chain(patient, baseline, followup)
+        except KeyError:
+            return False
+        self.map_lesions(analysis_results['tumor2'].get('lesions'), matrix)
+        analysis_results['tumor2']['native_space'] = followup
+        return True
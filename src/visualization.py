@@ -2,14 +2,139 @@ import vtk
 import itk
 import numpy as np
 from pathlib import Path
+from vtk.util import numpy_support
 
+from storage import ChunkedVolume, is_chunked_volume, wait_for_write
+from sparse_mask import SparseMask, SPARSE_SUFFIX
+from profiling import profile_step
+
+
+# Change map region colors, by label (see analysis.CHANGE_LABELS)
+CHANGE_COLORS = {
+    1: (1.0, 0.2, 0.2),  # Regressed: red
+    2: (0.2, 1.0, 0.2),  # Grown: green
+    3: (1.0, 0.9, 0.2),  # Stable: yellow
+}
+
+
+class VTKImageConverter:
+    """ITK images, arrays, chunked volumes and sparse masks as vtkImageData.
+
+    Needs no render window. Arrays and ITK images shared with VTK without a
+    copy are kept alive as long as the converter.
+    """
 
-class TumorVisualization:
     def __init__(self):
+        self._shared_buffers = []
+    
+    def load_image_as_vtk(self, image):
+        """vtkImageData from a file path, an ITK image or a (z, y, x) NumPy array.
+        
+        In-memory images are wrapped without copying. Files are read through
+        ITK too: vtkNrrdReader drops the direction cosines.
+        """
+        if isinstance(image, np.ndarray):
+            return self.array_to_vtk(image, (0.0, 0.0, 0.0), (1.0, 1.0, 1.0))
+        if not isinstance(image, (str, Path)):
+            return self.itk_to_vtk(image)
+        wait_for_write(image)
+        if is_chunked_volume(image):
+            return self.chunked_volume_to_vtk(ChunkedVolume(image))
+        return self.itk_to_vtk(itk.imread(str(image)))
+    
+    def itk_to_vtk(self, image):
+        # The array view shares the ITK buffer; the image itself must stay alive
+        self._shared_buffers.append(image)
+        return self.array_to_vtk(
+            itk.GetArrayViewFromImage(image), image.GetOrigin(), image.GetSpacing(),
+            itk.array_from_matrix(image.GetDirection())
+        )
+    
+    def chunked_volume_to_vtk(self, volume):
+        return self.array_to_vtk(volume.read(), volume.origin, volume.spacing, volume.direction)
+    
+    def sparse_mask_to_vtk(self, mask, padding=1):
+        # Only the (padded) bounding box is handed to VTK
+        crop = np.pad(mask.crop().astype(np.uint8), padding)
+        origin = mask.index_to_physical(np.asarray(mask.offset) - padding)
+        return self.array_to_vtk(crop, origin, mask.spacing, mask.direction)
+    
+    def mask_to_vtk(self, mask):
+        """vtkImageData of a mask: a path, or a SparseMask, ITK image or array in memory"""
+        if isinstance(mask, SparseMask):
+            return self.sparse_mask_to_vtk(mask)
+        if isinstance(mask, (str, Path)) and Path(mask).suffix == SPARSE_SUFFIX:
+            wait_for_write(mask)
+            return self.sparse_mask_to_vtk(SparseMask.load(mask))
+        return self.load_image_as_vtk(mask)
+    
+    def array_to_vtk(self, array, origin, spacing, direction=None):
+        """Wrap a (z, y, x) array as vtkImageData without copying it.
+        
+        The VTK scalars share the array's memory (non-contiguous arrays are
+        copied once), so the array must not be modified while VTK uses it.
+        The converter keeps the array alive as long as itself.
+        """
+        image_data = vtk.vtkImageData()
+        # VTK dimensions are (x, y, z), NumPy arrays are (z, y, x)
+        image_data.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+        image_data.SetOrigin(*(float(o) for o in origin))
+        image_data.SetSpacing(*(float(s) for s in spacing))
+        if direction is not None:
+            image_data.SetDirectionMatrix(*np.asarray(direction, dtype=np.float64).ravel())
+        
+        if array.dtype == bool:
+            # Same layout as uint8, which VTK understands
+            array = array.view(np.uint8)
+        array = np.ascontiguousarray(array).ravel()
+        self._shared_buffers.append(array)
+        scalars = numpy_support.numpy_to_vtk(array, deep=False)
+        image_data.GetPointData().SetScalars(scalars)
+        return image_data
+
+
+def tumor_surface(mask, smoothing=True):
+    """Smoothed marching-cubes surface (vtkPolyData) of a tumor mask.
+
+    Needs no render window, so headless exports can use it. The mask is a
+    path, or a SparseMask, ITK image or array in memory.
+    """
+    # The converter holds the mask's memory until the surface is extracted
+    converter = VTKImageConverter()
+    mask_data = converter.mask_to_vtk(mask)
+    
+    # Marching cubes to create surface
+    marching_cubes = vtk.vtkMarchingCubes()
+    marching_cubes.SetInputData(mask_data)
+    marching_cubes.SetValue(0, 0.5)
+    marching_cubes.Update()
+    
+    surface = marching_cubes.GetOutput()
+    
+    if smoothing and surface.GetNumberOfPoints() > 0:
+        # Smooth the surface for better appearance
+        smoother = vtk.vtkSmoothPolyDataFilter()
+        smoother.SetInputData(surface)
+        smoother.SetNumberOfIterations(30)  # Reduced for less aggressive smoothing
+        smoother.SetRelaxationFactor(0.15)  # Slightly more relaxation
+        smoother.Update()
+        surface = smoother.GetOutput()
+    
+    return surface
+
+
+class TumorVisualization(VTKImageConverter):
+    def __init__(self, offscreen=False):
+        # Arrays and ITK images shared with VTK without a copy must outlive the scene
+        super().__init__()
         self.renderer = vtk.vtkRenderer()
         self.render_window = vtk.vtkRenderWindow()
         self.render_window_interactor = vtk.vtkRenderWindowInteractor()
         
+        # Offscreen windows render without a display (batch jobs, benchmarks)
+        if offscreen:
+            self.render_window.SetOffScreenRendering(1)
+        
         self.render_window.AddRenderer(self.renderer)
         self.render_window_interactor.SetRenderWindow(self.render_window)
         
@@ -23,12 +148,6 @@ class TumorVisualization:
         # Store references for dynamic adjustment
         self.brain_volume = None
         self.tumor_actors = []
-        
-    def load_image_as_vtk(self, image_path):
-        reader = vtk.vtkNrrdReader()
-        reader.SetFileName(str(image_path))
-        reader.Update()
-        return reader.GetOutput()
     
     def create_brain_volume_rendering(self, image_path, opacity=0.02):
         volume_data = self.load_image_as_vtk(image_path)
@@ -73,29 +192,12 @@ class TumorVisualization:
         
         return volume
     
+    def tumor_surface(self, mask_path, smoothing=True):
+        """Smoothed marching-cubes surface (vtkPolyData) of a tumor mask, see tumor_surface()"""
+        return tumor_surface(mask_path, smoothing)
+    
     def create_tumor_surface(self, mask_path, color=(1.0, 0.0, 0.0), smoothing=True):
-        # Load mask as VTK
-        reader = vtk.vtkNrrdReader()
-        reader.SetFileName(str(mask_path))
-        reader.Update()
-        mask_data = reader.GetOutput()
-        
-        # Marching cubes to create surface
-        marching_cubes = vtk.vtkMarchingCubes()
-        marching_cubes.SetInputData(mask_data)
-        marching_cubes.SetValue(0, 0.5)
-        marching_cubes.Update()
-        
-        surface = marching_cubes.GetOutput()
-        
-        if smoothing and surface.GetNumberOfPoints() > 0:
-            # Smooth the surface for better appearance
-            smoother = vtk.vtkSmoothPolyDataFilter()
-            smoother.SetInputData(surface)
-            smoother.SetNumberOfIterations(30)  # Reduced for less aggressive smoothing
-            smoother.SetRelaxationFactor(0.15)  # Slightly more relaxation
-            smoother.Update()
-            surface = smoother.GetOutput()
+        surface = self.tumor_surface(mask_path, smoothing)
         
         # Create mapper and actor
         mapper = vtk.vtkPolyDataMapper()
@@ -121,6 +223,60 @@ class TumorVisualization:
         
         return actor
     
+    def create_change_surface(self, change_map, smoothing=True):
+        """One mesh for all regions of a change map (see TumorAnalysis.compute_change_map).
+        
+        Surface nets contour every label at once: regions share their
+        common faces instead of overlapping like separate marching-cubes
+        surfaces, and the mesh is smoothed with the region boundaries kept.
+        """
+        change_data = self.load_image_as_vtk(change_map)
+        
+        nets = vtk.vtkSurfaceNets3D()
+        nets.SetInputData(change_data)
+        for i, label in enumerate(CHANGE_COLORS):
+            nets.SetValue(i, label)
+        nets.SetOutputMeshTypeToTriangles()
+        nets.SetSmoothing(smoothing)
+        nets.Update()
+        surface = nets.GetOutput()
+        
+        # Faces carry the labels on both sides: color by the tumor side (0 is background)
+        boundary_labels = surface.GetCellData().GetArray("BoundaryLabels")
+        region = np.zeros(surface.GetNumberOfCells(), dtype=np.uint8)
+        if boundary_labels is not None and surface.GetNumberOfCells() > 0:
+            region = numpy_support.vtk_to_numpy(boundary_labels).max(axis=1).astype(np.uint8)
+        region_array = numpy_support.numpy_to_vtk(region, deep=True)
+        region_array.SetName("ChangeRegion")
+        surface.GetCellData().SetScalars(region_array)
+        
+        lookup = vtk.vtkLookupTable()
+        lookup.SetNumberOfTableValues(len(CHANGE_COLORS) + 1)
+        lookup.SetTableRange(0, len(CHANGE_COLORS))
+        lookup.SetTableValue(0, 0.5, 0.5, 0.5, 1.0)
+        for label, color in CHANGE_COLORS.items():
+            lookup.SetTableValue(label, *color, 1.0)
+        lookup.Build()
+        
+        mapper = vtk.vtkPolyDataMapper()
+        mapper.SetInputData(surface)
+        mapper.SetLookupTable(lookup)
+        mapper.SetScalarModeToUseCellData()
+        mapper.SetScalarRange(0, len(CHANGE_COLORS))
+        
+        actor = vtk.vtkActor()
+        actor.SetMapper(mapper)
+        
+        property = actor.GetProperty()
+        property.SetOpacity(0.95)
+        property.SetAmbient(0.3)
+        property.SetDiffuse(0.7)
+        property.SetSpecular(0.4)
+        property.SetSpecularPower(20)
+        property.SetInterpolationToPhong()
+        
+        return actor
+    
     def create_slice_view(self, image_path, slice_number=None):
         volume_data = self.load_image_as_vtk(image_path)
         
@@ -157,11 +313,11 @@ class TumorVisualization:
         text_actor.GetTextProperty().SetColor(color)
         text_actor.GetTextProperty().SetFontFamilyToArial()
         
-        self.renderer.AddActor2D(text_actor)
+        self.renderer.AddViewProp(text_actor)
         return text_actor
     
     def visualize_tumor_evolution(self, brain_image_path, tumor1_mask_path, 
-                                 tumor2_mask_path, analysis_results):
+                                 tumor2_mask_path, analysis_results, change_map=None):
         # Clear previous actors
         self.renderer.RemoveAllViewProps()
         
@@ -169,18 +325,23 @@ class TumorVisualization:
         self.renderer.SetBackground(0.05, 0.05, 0.1)  # Very dark blue background
         
         # Add brain volume with very low opacity to let tumors stand out
-        self.brain_volume = self.create_brain_volume_rendering(brain_image_path, opacity=0.01)
+        with profile_step("volume_rendering"):
+            self.brain_volume = self.create_brain_volume_rendering(brain_image_path, opacity=0.01)
         self.renderer.AddVolume(self.brain_volume)
         
-        # Add tumor surfaces with enhanced visibility and brighter colors
-        tumor1_actor = self.create_tumor_surface(tumor1_mask_path, color=(1.0, 0.2, 0.2))  # Bright red
-        tumor2_actor = self.create_tumor_surface(tumor2_mask_path, color=(0.2, 1.0, 0.2))  # Bright green
-        
-        # Store tumor actors for potential future use
-        self.tumor_actors = [tumor1_actor, tumor2_actor]
+        # With a change map, one mesh shows stable, grown and regressed regions;
+        # otherwise the two tumor surfaces overlap
+        with profile_step("surfaces"):
+            if change_map is not None:
+                self.tumor_actors = [self.create_change_surface(change_map)]
+            else:
+                self.tumor_actors = [
+                    self.create_tumor_surface(tumor1_mask_path, color=(1.0, 0.2, 0.2)),  # Bright red
+                    self.create_tumor_surface(tumor2_mask_path, color=(0.2, 1.0, 0.2)),  # Bright green
+                ]
         
-        self.renderer.AddActor(tumor1_actor)
-        self.renderer.AddActor(tumor2_actor)
+        for actor in self.tumor_actors:
+            self.renderer.AddActor(actor)
         
         # Enhanced lighting for better tumor visibility
         light1 = vtk.vtkLight()
@@ -207,8 +368,17 @@ class TumorVisualization:
         dice_score = analysis_results['comparison']['dice_coefficient']
         
         self.add_text_annotation(f"Tumor Evolution Analysis", (10, 580), color=(1, 1, 0.8))
-        self.add_text_annotation(f"Rouge: Scan initial", (10, 550), color=(1.0, 0.6, 0.6))
-        self.add_text_annotation(f"Vert: Scan de suivi", (10, 520), color=(0.6, 1.0, 0.6))
+        change_volumes = analysis_results['comparison'].get('change_volumes_mm3')
+        if change_map is not None and change_volumes:
+            self.add_text_annotation(f"Rouge: Regression {change_volumes['regressed']:.0f} mm3, "
+                                     f"Jaune: Stable {change_volumes['stable']:.0f} mm3", (10, 550), color=(1.0, 0.8, 0.6))
+            self.add_text_annotation(f"Vert: Croissance {change_volumes['grown']:.0f} mm3", (10, 520), color=(0.6, 1.0, 0.6))
+        elif change_map is not None:
+            self.add_text_annotation(f"Rouge: Regression, Jaune: Stable", (10, 550), color=(1.0, 0.8, 0.6))
+            self.add_text_annotation(f"Vert: Croissance", (10, 520), color=(0.6, 1.0, 0.6))
+        else:
+            self.add_text_annotation(f"Rouge: Scan initial", (10, 550), color=(1.0, 0.6, 0.6))
+            self.add_text_annotation(f"Vert: Scan de suivi", (10, 520), color=(0.6, 1.0, 0.6))
         self.add_text_annotation(f"Changement de volume: {volume_change:.1f}%", (10, 490), color=(1, 1, 1))
         self.add_text_annotation(f"Coefficient Dice: {dice_score:.3f}", (10, 460), color=(1, 1, 1))
         self.add_text_annotation(f"Controles: Clic gauche=rotation, Molette=zoom", (10, 430), color=(0.8, 0.8, 0.8))
@@ -296,14 +466,16 @@ class TumorVisualization:
         self.render_window_interactor.Start()
     
     def save_screenshot(self, output_path):
-        window_to_image = vtk.vtkWindowToImageFilter()
-        window_to_image.SetInput(self.render_window)
-        window_to_image.Update()
-        
-        writer = vtk.vtkPNGWriter()
-        writer.SetFileName(str(output_path))
-        writer.SetInputConnection(window_to_image.GetOutputPort())
-        writer.Write()
+        with profile_step("render"):
+            window_to_image = vtk.vtkWindowToImageFilter()
+            window_to_image.SetInput(self.render_window)
+            window_to_image.Update()
+        
+        with profile_step("write"):
+            writer = vtk.vtkPNGWriter()
+            writer.SetFileName(str(output_path))
+            writer.SetInputConnection(window_to_image.GetOutputPort())
+            writer.Write()
     
     def adjust_brain_transparency(self, opacity_factor):
         """Adjust brain volume transparency dynamically"""
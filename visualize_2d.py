@@ -6,16 +6,33 @@ Script pour visualiser les coupes 2D des tumeurs
 from pathlib import Path
 import sys
 import json
-import matplotlib.pyplot as plt
-import itk
 import numpy as np
 
 # Add src directory to path
 sys.path.append(str(Path(__file__).parent / "src"))
 
+from storage import ChunkedVolume, is_chunked_volume, resolve_result_path
+from sparse_mask import SparseMask, SPARSE_SUFFIX
+
 
 def load_nrrd_slice(image_path, slice_index=None):
-    """Load a specific slice from a NRRD file"""
+    """Load a specific slice from a NRRD file or a chunked volume"""
+    if is_chunked_volume(image_path):
+        # Only the chunks crossing this slice are decoded
+        volume = ChunkedVolume(image_path)
+        if slice_index is None:
+            slice_index = volume.shape[0] // 2
+        return volume.read_slice(slice_index), slice_index
+    
+    if Path(image_path).suffix == SPARSE_SUFFIX:
+        array = SparseMask.load(image_path).to_array()
+        if slice_index is None:
+            slice_index = array.shape[0] // 2
+        return array[slice_index], slice_index
+    
+    # ITK is only needed for NRRD files, so it is imported on first use
+    import itk
+    
     image = itk.imread(str(image_path))
     array = itk.array_from_image(image)
     
@@ -33,9 +50,9 @@ def visualize_2d_comparison():
     
     # Input files
     image1_path = data_dir / "case6_gre1.nrrd"
-    image2_path = results_dir / "registered_case6_gre2.nrrd"
-    tumor1_mask_path = results_dir / "tumor_mask_scan1.nrrd"
-    tumor2_mask_path = results_dir / "tumor_mask_scan2.nrrd"
+    image2_path = resolve_result_path(results_dir, "registered_case6_gre2")
+    tumor1_mask_path = resolve_result_path(results_dir, "tumor_mask_scan1")
+    tumor2_mask_path = resolve_result_path(results_dir, "tumor_mask_scan2")
     analysis_file = results_dir / "tumor_analysis.json"
     
     # Check if files exist
@@ -57,8 +74,15 @@ def visualize_2d_comparison():
     print("Chargement des images...")
     
     # Find a slice with tumor for better visualization
-    tumor1_mask = itk.imread(str(tumor1_mask_path))
-    tumor1_array = itk.array_from_image(tumor1_mask)
+    if is_chunked_volume(tumor1_mask_path):
+        tumor1_array = ChunkedVolume(tumor1_mask_path).read()
+    elif tumor1_mask_path.suffix == SPARSE_SUFFIX:
+        tumor1_array = SparseMask.load(tumor1_mask_path).to_array()
+    else:
+        import itk
+        
+        tumor1_mask = itk.imread(str(tumor1_mask_path))
+        tumor1_array = itk.array_from_image(tumor1_mask)
     
     # Find slice with maximum tumor area
     tumor_areas = [np.sum(tumor1_array[i] > 0) for i in range(tumor1_array.shape[0])]
@@ -71,6 +95,8 @@ def visualize_2d_comparison():
     mask2_slice, _ = load_nrrd_slice(tumor2_mask_path, best_slice)
     
     # Create visualization
+    import matplotlib.pyplot as plt
+    
     fig, axes = plt.subplots(2, 2, figsize=(12, 10))
     fig.suptitle('Analyse Longitudinale de Tumeur - Coupe 2D', fontsize=16, fontweight='bold')
     
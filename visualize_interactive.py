@@ -11,6 +11,7 @@ import json
 sys.path.append(str(Path(__file__).parent / "src"))
 
 from visualization import TumorVisualization
+from storage import resolve_result_path
 
 
 def main():
@@ -20,9 +21,10 @@ def main():
     
     # Input files (results from the pipeline)
     brain_image = project_root / "Data" / "case6_gre1.nrrd"
-    tumor1_mask = results_dir / "tumor_mask_scan1.nrrd"
-    tumor2_mask = results_dir / "tumor_mask_scan2.nrrd"
+    tumor1_mask = resolve_result_path(results_dir, "tumor_mask_scan1")
+    tumor2_mask = resolve_result_path(results_dir, "tumor_mask_scan2")
     analysis_file = results_dir / "tumor_analysis.json"
+    change_map = results_dir / "tumor_change_map.nrrd"
     
     # Check if all files exist
     missing_files = []
@@ -70,8 +72,13 @@ def main():
     print("   - Fermer la fenetre pour quitter")
     
     print("\nLegende des couleurs :")
-    print("   - Rouge brillant : Tumeur scan initial")
-    print("   - Vert brillant : Tumeur scan de suivi")
+    if change_map.exists():
+        print("   - Rouge : Regression (scan initial seulement)")
+        print("   - Vert : Croissance (scan de suivi seulement)")
+        print("   - Jaune : Tumeur stable")
+    else:
+        print("   - Rouge brillant : Tumeur scan initial")
+        print("   - Vert brillant : Tumeur scan de suivi")
     print("   - Gris tres transparent : Cerveau")
     
     # Create and start visualization
@@ -80,7 +87,8 @@ def main():
         
         # Setup the 3D scene
         visualizer.visualize_tumor_evolution(
-            brain_image, tumor1_mask, tumor2_mask, analysis_results
+            brain_image, tumor1_mask, tumor2_mask, analysis_results,
+            change_map=change_map if change_map.exists() else None
         )
         
         print("\nFenetre de visualisation ouverte !")
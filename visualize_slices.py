@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Script pour comparer les coupes des deux scans cote a cote, de maniere interactive
+"""
+
+from pathlib import Path
+import sys
+
+import numpy as np
+
+# Add src directory to path
+sys.path.append(str(Path(__file__).parent / "src"))
+
+from slice_viewer import ComparativeSliceViewer, load_volume
+from storage import resolve_result_path
+
+
+def main():
+    # Setup paths
+    project_root = Path(__file__).parent
+    results_dir = project_root / "results"
+
+    # Input files: the follow-up must be the registered one, on the baseline grid
+    image1_path = project_root / "Data" / "case6_gre1.nrrd"
+    image2_path = resolve_result_path(results_dir, "registered_case6_gre2")
+    tumor1_mask_path = resolve_result_path(results_dir, "tumor_mask_scan1")
+    tumor2_mask_path = resolve_result_path(results_dir, "tumor_mask_scan2")
+
+    missing_files = [str(p) for p in [image1_path, image2_path] if not p.exists()]
+    if missing_files:
+        print("ERREUR: Fichiers manquants. Executez d'abord le pipeline principal :")
+        print("   python main.py")
+        for file in missing_files:
+            print(f"   - {file}")
+        return
+
+    print("Chargement des images...")
+    image1, spacing = load_volume(image1_path)
+    image2, _ = load_volume(image2_path)
+    mask1 = load_volume(tumor1_mask_path)[0] if tumor1_mask_path.exists() else None
+    mask2 = load_volume(tumor2_mask_path)[0] if tumor2_mask_path.exists() else None
+
+    viewer = ComparativeSliceViewer(
+        image1, image2, mask1, mask2, spacing=spacing, titles=("Scan initial", "Scan de suivi")
+    )
+    # Start on the axial slice with the largest initial tumor area
+    if mask1 is not None:
+        areas = [np.count_nonzero(mask1[i]) for i in range(mask1.shape[0])]
+        viewer.show(int(np.argmax(areas)))
+
+    print("\nControles de la visualisation :")
+    print("   - Molette, fleches haut/bas : Coupe suivante/precedente")
+    print("   - Page haut/bas : 10 coupes")
+    print("   - Touches a, c, s : Coupes axiales, coronales, sagittales")
+    print("   - Clic droit + glisser : Zoom, clic milieu + glisser : Translation")
+    print("   - Touche r : Reinitialiser la vue")
+    print("   - Touche q : Quitter")
+    print("\nLegende : tumeur initiale en rouge, tumeur de suivi en vert")
+
+    viewer.start_interaction()
+
+
+if __name__ == "__main__":
+    main()